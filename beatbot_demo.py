@@ -11,7 +11,7 @@ if __name__ == "__main__":
     device = prompt_device_selection()
 
     # Load a file to build on previous recordings, or start fresh if you don't have any.
-    my_recordings = load_noise_samples('demo_recordings.npy') or {}
+    my_recordings = load_noise_samples('demo_recordings.noises') or {}
 
     # Record noises and train a model. Set skip_testing_model to True to use
     # 100% of samples for training instead of 80%. Try recording just a few
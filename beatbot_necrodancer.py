@@ -1,7 +1,7 @@
 from src.audio.device_settings import prompt_device_selection
 from src.main.build_run_beatbot import build_beatbot, run_beatbot
 from src.audio.save_load import load_noise_samples
-from src.model.save_load import load_model
+from src.model.numpy_runtime import load_numpy_model
 from src.response.keyboard_control import KEYBOARD_MAPPING, press_key
 
 # This runs a specific model for basic keyboard control:
@@ -14,12 +14,20 @@ if __name__ == "__main__":
     # First select the right microphone. This model was recorded on my Sennheiser.
     device = prompt_device_selection()
 
-    # Load the model.
-    necrodancer_model = load_model('necrodancer_100each_t-k-p-tsk-cluck')
-
-    # Now we make it run for 20 min, switch over to the game, and play!
+    # Load the model. This one was exported for the NumPy runtime, with
+    # export_numpy_model(load_model('necrodancer_100each_t-k-p-tsk-cluck'), 44100, ...),
+    # so playing doesn't need to import torch, which starts up much faster.
+    necrodancer_model = load_numpy_model('necrodancer_100each_t-k-p-tsk-cluck')
+    # Or, to load the torch model itself:
+    # from src.model.save_load import load_model
+    # necrodancer_model = load_model('necrodancer_100each_t-k-p-tsk-cluck')
+    # Or an int8 variant saved with save_quantized_model (or build_beatbot(..., save_quantized=True)):
+    # necrodancer_model = load_model('necrodancer_100each_t-k-p-tsk-cluck_int8', quantized=True)
+
+    # Now we make it run for 20 min, switch over to the game, and play! Key presses
+    # are dispatched to a worker thread, so they don't hold up recognition.
     minutes = 20
-    run_beatbot(necrodancer_model, press_key, device, duration=60*minutes)
+    run_beatbot(necrodancer_model, press_key, device, duration=60*minutes, dispatch=True)
 
 
     ########## Code used to build the model ##########
@@ -37,5 +45,4 @@ if __name__ == "__main__":
     # mapped to keys.
 
     # my_recordings = load_noise_samples(...)
-    # my_recordings_subset = {k: v for k, v in my_recordings.items() if k in
-    #                         KEYBOARD_MAPPING.keys()}
+    # my_recordings_subset = my_recordings.subset(KEYBOARD_MAPPING.keys())
@@ -0,0 +1,384 @@
+# --------- Pretend we're in the root directory ---------
+import sys
+import os
+
+ROOT_DIR = '../..'
+os.chdir(ROOT_DIR)
+sys.path.insert(0, os.getcwd())
+# -------------------------------------------------------
+
+from src.audio.listen import (listen, callback, process_noises, time_elapsed, adc_time,
+                              listen_and_process, MAX_NOISES_IN_FLIGHT,
+                              BATCH_DURATION, BATCHES_PER_NOISE, THRESHOLD_ABSOLUTE,
+                              THRESHOLD_MULTIPLIER)
+from src.audio.make_spectrograms import N_MELS, get_front_end
+from src.audio.sources import FileSource, synthetic_recording
+from src.audio.capture_process import SharedMemorySource
+import numpy as np
+import queue
+import threading
+import time
+import torch
+import tracemalloc
+import torchaudio.transforms
+
+# Benchmarks for the audio code. These need no microphone: synthetic audio is
+# fed through the same callback the sounddevice input stream uses.
+
+SAMPLERATE = 44100
+
+
+def synthetic_blocks(duration, noise_every=0.5, samplerate=SAMPLERATE):
+    """ Quiet background audio in BATCH_DURATION blocks, with a click every noise_every seconds. """
+    blocksize = int(samplerate * BATCH_DURATION)
+    audio = synthetic_recording(duration, samplerate, noise_every)
+    for i in range(len(audio) // blocksize):
+        yield audio[i * blocksize:(i + 1) * blocksize, None]
+
+
+class queued:
+    """ The state of the previous callback, kept here as a baseline """
+
+    def reset():
+        queued.prev_max = 1.
+        queued.batches_to_collect = 0
+        queued.q_batches = queue.Queue()
+        queued.q_times = queue.Queue()
+
+
+def queue_callback(indata, frames, time_pa, status):
+    """ The previous callback, kept here as a baseline: copies every batch, and puts
+    the batches of each noise on a queue.Queue. """
+    if any(indata):
+        indata_copy = indata.copy()
+        new_max = np.absolute(indata_copy).max()
+
+        if queued.batches_to_collect > 0:
+            queued.q_batches.put_nowait(indata_copy)
+            queued.batches_to_collect -= 1
+
+        elif (new_max > THRESHOLD_ABSOLUTE and
+              new_max > THRESHOLD_MULTIPLIER * queued.prev_max):
+            now = time.perf_counter()
+            queued.q_times.put_nowait({'adc': adc_time(time_pa, now), 'onset': now})
+            queued.q_batches.put_nowait(indata_copy)
+            queued.batches_to_collect = BATCHES_PER_NOISE - 1
+
+        queued.prev_max = new_max
+
+
+def busy_poll_noises(processing_function, stop_condition):
+    """ The previous consumer loop, kept here as a baseline: poll the queue of
+    queue_callback without blocking, and concatenate the batches of each noise. """
+    data = []
+    while True:
+        if queued.q_batches.qsize() + len(data) >= BATCHES_PER_NOISE:
+            while len(data) < BATCHES_PER_NOISE:
+                data.append(queued.q_batches.get_nowait())
+            processing_function(np.concatenate(data, axis=None))
+            data = []
+        if stop_condition():
+            break
+
+
+def benchmark_consumer(consumer, stream_callback, duration=5, noise_every=0.5):
+    """ Feed duration (sec) of synthetic audio through stream_callback in real time,
+    and report the CPU used by the process and the latency from the final batch of
+    each noise arriving to its processing by the consumer. """
+
+    listen.reset(SAMPLERATE, int(SAMPLERATE * BATCH_DURATION))
+    queued.reset()
+    last_fed = [0.]
+    latencies = []
+
+    def feed():
+        for block in synthetic_blocks(duration, noise_every):
+            stream_callback(block, len(block), None, None)
+            last_fed[0] = time.perf_counter()
+            time.sleep(BATCH_DURATION)
+
+    def processing_function(noise_sample):
+        latencies.append(time.perf_counter() - last_fed[0])
+
+    feeder = threading.Thread(target=feed, daemon=True)
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    feeder.start()
+    consumer(processing_function, time_elapsed(duration))
+    cpu, wall = time.process_time() - cpu_start, time.perf_counter() - wall_start
+    feeder.join()
+
+    latencies_ms = 1000 * np.array(latencies)
+    print('{:>12s}: CPU {:5.1f}% of one core, {:3d} noises, latency median {:.2f} ms, max {:.2f} ms'.format(
+        consumer.__name__, 100 * cpu / wall, len(latencies),
+        np.median(latencies_ms), latencies_ms.max()))
+
+
+def benchmark_callback(duration=30, noise_every=0.25, load=False):
+    """ Run duration (sec) of synthetic audio through the callback, as fast as possible,
+    and report the time per call and the memory allocated per call (traced with
+    tracemalloc), for the previous queue_callback and the ring buffer callback. If load
+    is True, a thread computes spectrograms meanwhile, as recognition would. The
+    noises are taken off the queue (or ring buffer) after every call. """
+    blocks = list(synthetic_blocks(duration, noise_every))
+    front_end = get_front_end(SAMPLERATE)
+    loading = threading.Event()
+
+    def load_cpu():
+        noise_sample = np.random.rand(BATCHES_PER_NOISE * len(blocks[0])).astype(np.float32)
+        while loading.is_set():
+            front_end(noise_sample)
+
+    def drain():
+        while listen.pending:
+            listen.take_noise()
+            listen.done_with_noise()
+        while not queued.q_batches.empty():
+            queued.q_batches.get_nowait()
+
+    for stream_callback in [queue_callback, callback]:
+        listen.reset(SAMPLERATE, len(blocks[0]))
+        queued.reset()
+        if load:
+            loading.set()
+            threading.Thread(target=load_cpu, daemon=True).start()
+
+        call_times = []
+        for block in blocks:
+            start = time.perf_counter()
+            stream_callback(block, len(block), None, None)
+            call_times.append(time.perf_counter() - start)
+            drain()
+
+        allocated = []
+        tracemalloc.start()
+        for block in blocks:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+            stream_callback(block, len(block), None, None)
+            allocated.append(tracemalloc.get_traced_memory()[1] - before)
+            drain()
+        tracemalloc.stop()
+        loading.clear()
+
+        call_us = 1e6 * np.array(call_times)
+        print('{:>15s}{}: {:5.1f} us mean, {:6.1f} us p99, {:7.1f} us max per call, '
+              '{:6.0f} bytes mean, {:6.0f} max allocated per call'.format(
+                  stream_callback.__name__, ' (under load)' if load else '', call_us.mean(),
+                  np.percentile(call_us, 99), call_us.max(), np.mean(allocated), np.max(allocated)))
+
+
+def detected_noises(audio, max_in_flight, samplerate=SAMPLERATE):
+    """ The noises detected in audio by the listener, replayed as fast as possible """
+    noises = []
+    listen_and_process(lambda noise_sample: noises.append(noise_sample.copy()), device=None,
+                       stop_condition=time_elapsed(None), source=FileSource(audio, samplerate),
+                       max_in_flight=max_in_flight)
+    return noises
+
+
+def benchmark_dense_onsets(spacings=(0.04, 0.05, 0.1), duration=10):
+    """ For hits every spacing (sec), count the noises detected per second of audio,
+    collecting one noise at a time versus several at once. Also check that isolated
+    hits still get exactly the same windows. """
+    for spacing in spacings:
+        audio = synthetic_recording(duration, SAMPLERATE, spacing)
+        hits = len(range(int(spacing * SAMPLERATE), len(audio) - int(0.02 * SAMPLERATE),
+                         int(spacing * SAMPLERATE)))
+        one, several = [len(detected_noises(audio, n)) for n in [1, MAX_NOISES_IN_FLIGHT]]
+        print('Hits every {:.0f} ms: {} hits, one at a time {} detected ({:.1f}/sec), '
+              '{} at a time {} detected ({:.1f}/sec)'.format(
+                  1000 * spacing, hits, one, one / duration, MAX_NOISES_IN_FLIGHT, several, several / duration))
+
+    audio = synthetic_recording(duration, SAMPLERATE, 0.5)
+    one, several = [detected_noises(audio, n) for n in [1, MAX_NOISES_IN_FLIGHT]]
+    same = len(one) == len(several) and all(np.array_equal(a, b) for a, b in zip(one, several))
+    print('Isolated hits: {} noises, identical windows: {}'.format(len(several), same))
+
+
+def benchmark_onset_alignment(batch_durations=(0.02, 0.01, 0.005), duration=60, noise_every=0.13):
+    """ Feed duration (sec) of synthetic audio through the callback in batches of each
+    batch_duration, with noises aligned to their onsets or not. Report the CPU time of
+    the callback per second of audio, how far into each noise window its onset falls
+    (the spread is the misalignment), and how long after its onset a noise's audio is
+    all in (the audio the listener has to wait for). """
+    audio = synthetic_recording(duration, SAMPLERATE, noise_every)
+
+    for batch_duration, align_onsets in [(BATCH_DURATION, False)] + [(d, True) for d in batch_durations]:
+        blocksize = int(SAMPLERATE * batch_duration)
+        blocks = [audio[i:i + blocksize, None] for i in range(0, len(audio) - blocksize + 1, blocksize)]
+        listen.reset(SAMPLERATE, blocksize, align_onsets=align_onsets)
+
+        onsets, waits = [], []
+        cpu_start = time.process_time()
+        for block in blocks:
+            callback(block, blocksize, None, None)
+            while listen.pending:
+                start, _, _ = listen.take_noise()
+                noise_sample = listen.ring[start % listen.capacity:][:listen.noise_length]
+                onsets.append(np.argmax(np.abs(noise_sample) > 10 * THRESHOLD_ABSOLUTE))
+                waits.append(listen.written - start - onsets[-1])
+                listen.done_with_noise()
+        cpu = time.process_time() - cpu_start
+
+        print('{:2.0f} ms batches, {:>9s}: callback CPU {:5.2f} ms per sec of audio, '
+              'onset at sample {}-{} of the noise, audio all in {:.1f} ms after the onset ({} noises)'.format(
+                  1000 * batch_duration, 'aligned' if align_onsets else 'unaligned', 1000 * cpu / duration,
+                  min(onsets), max(onsets), 1000 * np.mean(waits) / SAMPLERATE, len(onsets)))
+
+
+def check_noise_order(partial_batches=1):
+    """ Check that noises (and partial noises of partial_batches batches) are handed to
+    the consumer in the order they started, for two onsets one batch apart: all of the
+    first noise's windows come before any of the second's. """
+    blocksize = int(SAMPLERATE * BATCH_DURATION)
+    audio = 1e-4 * np.ones(10 * blocksize, dtype=np.float32)
+    audio[2 * blocksize:2 * blocksize + 100] = 0.1   # the first noise, in batch 2
+    audio[3 * blocksize:3 * blocksize + 100] = 1.    # the second, in batch 3
+    listen.reset(SAMPLERATE, blocksize, align_onsets=False, partial_lengths=[partial_batches * blocksize])
+
+    windows = []
+    for i in range(0, len(audio), blocksize):
+        callback(audio[i:i + blocksize, None], blocksize, None, None)
+        while listen.pending:
+            start, _, length = listen.take_noise()
+            windows.append((start // blocksize, length // blocksize))
+            listen.done_with_noise()
+
+    expected = [(2, partial_batches), (2, BATCHES_PER_NOISE), (3, partial_batches), (3, BATCHES_PER_NOISE)]
+    print('Windows (batch of the start, batches long): {}, in order: {}'.format(windows, windows == expected))
+
+
+def check_concurrent_listening(duration=60, noise_every=0.04, partial_batches=1):
+    """ Listen to duration (sec) of dense synthetic hits, with partial noises, as fast
+    as possible, so the callback and the consumer keep changing the noises waiting to
+    be processed at once. Check that the stream gets through all the audio. """
+    audio = synthetic_recording(duration, SAMPLERATE, noise_every)
+    source = FileSource(audio, SAMPLERATE)
+    blocksize = int(SAMPLERATE * BATCH_DURATION)
+    processed = []
+    start = time.perf_counter()
+    listen_and_process(lambda noise_sample: processed.append(len(noise_sample)), device=None,
+                       stop_condition=lambda: time.perf_counter() - start > 4 * duration, source=source,
+                       partial_lengths=[partial_batches * blocksize])
+    print('Dense hits: {} noises and partial noises processed, stream finished: {}'.format(
+        len(processed), source.finished()))
+
+
+def hold_gil(sec):
+    """ Hold the GIL for about sec, as inference code that doesn't release it would:
+    sum over a range runs in C, without letting other threads in """
+    n = 10**6
+    start = time.perf_counter()
+    sum(range(n))
+    per_item = (time.perf_counter() - start) / n
+    return lambda *args: sum(range(int(sec / per_item)))
+
+
+def benchmark_capture_process(duration=20, noise_every=0.15, hold_sec=0.06, device_buffer=1):
+    """ Replay duration (sec) of synthetic audio at real-time pace, through a stream
+    that loses audio if the callback waits longer than device_buffer batches, while
+    processing each noise holds the GIL for hold_sec. Compare the input overflows
+    and noises processed with capture in the same process, and in a capture process. """
+    audio = synthetic_recording(duration, SAMPLERATE, noise_every)
+    processing_function = hold_gil(hold_sec)
+
+    for capture_process in [False, True]:
+        source = FileSource(audio, SAMPLERATE, realtime=True, device_buffer=device_buffer)
+        if capture_process:
+            source = SharedMemorySource(source)
+        processed = []
+        listen_and_process(lambda noise: processed.append(processing_function()), None,
+                           stop_condition=lambda: False, source=source)
+        overflows = source.overflows if capture_process else listen.overflows
+        print('{}: {} input overflows, {} noises processed'.format(
+            'capture process' if capture_process else 'single process', overflows, len(processed)))
+
+
+def rebuilt_spectrogram(noise_sample, samplerate, n_mels=N_MELS):
+    """ The previous generate_spectrogram, kept here as a baseline: builds a new
+    MelSpectrogram transform for every noise. """
+    normed_sample = torch.from_numpy(noise_sample) / noise_sample.mean()
+    mel = torchaudio.transforms.MelSpectrogram(
+        sample_rate=samplerate, n_mels=n_mels)(normed_sample)
+    return mel.log2()
+
+
+def benchmark_spectrograms(repeats=1000, samplerate=SAMPLERATE):
+    """ Time the per-noise cost of a spectrogram, rebuilding the transform each
+    time versus reusing the front end. (The old per-noise sounddevice query for
+    the sample rate is not included, since it needs a device.) """
+    blocksize = int(samplerate * BATCH_DURATION)
+    rng = np.random.default_rng(0)
+    noise_sample = 0.1 * rng.standard_normal(BATCHES_PER_NOISE * blocksize, dtype=np.float32)
+    front_end = get_front_end(samplerate)
+
+    def per_noise_us(spectrogram_function):
+        spectrogram_function(noise_sample)  # warm up
+        start = time.perf_counter()
+        for _ in range(repeats):
+            spectrogram_function(noise_sample)
+        return 1e6 * (time.perf_counter() - start) / repeats
+
+    rebuilt = per_noise_us(lambda s: rebuilt_spectrogram(s, samplerate))
+    reused = per_noise_us(front_end)
+    print('Spectrogram of a {}-frame noise: rebuilt transform {:.0f} us, front end {:.0f} us ({:.1f}x)'.format(
+        BATCHES_PER_NOISE * blocksize, rebuilt, reused, rebuilt / reused))
+
+
+def benchmark_batched_spectrograms(num_samples=500, samplerate=SAMPLERATE):
+    """ Time the spectrograms for a dataset of num_samples noises, one at a time
+    versus batched. """
+    blocksize = int(samplerate * BATCH_DURATION)
+    rng = np.random.default_rng(0)
+    noise_samples = [0.1 * rng.standard_normal(BATCHES_PER_NOISE * blocksize, dtype=np.float32)
+                     for _ in range(num_samples)]
+    front_end = get_front_end(samplerate)
+
+    start = time.perf_counter()
+    torch.stack([front_end(s) for s in noise_samples])
+    one_at_a_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    front_end.batch(noise_samples)
+    batched = time.perf_counter() - start
+
+    print('Spectrograms of {} noises: one at a time {:.3f} sec, batched {:.3f} sec ({:.1f}x)'.format(
+        num_samples, one_at_a_time, batched, one_at_a_time / batched))
+
+
+if __name__ == "__main__":
+
+    ###################### BENCHMARKING AUDIO ######################
+
+    # audio/listen.py: idle CPU and detection latency of the consumer loop
+
+    # mostly idle: a noise every 2 sec
+    benchmark_consumer(busy_poll_noises, queue_callback, noise_every=2)
+    benchmark_consumer(process_noises, callback, noise_every=2)
+
+    # audio/listen.py: cost and allocations of the callback, in the real-time audio thread
+
+    benchmark_callback()
+    benchmark_callback(load=True)
+
+    # audio/listen.py: noises detected in rapid succession
+
+    benchmark_dense_onsets()
+
+    # audio/listen.py: noise windows aligned to their onsets, with shorter batches
+
+    benchmark_onset_alignment()
+
+    # audio/listen.py: noises handed to the consumer in order, while it takes them concurrently
+
+    check_noise_order()
+    check_concurrent_listening()
+
+    # audio/capture_process.py: input overflows while recognition holds the GIL
+
+    benchmark_capture_process()
+
+    # audio/make_spectrograms.py: per-noise spectrogram cost
+
+    benchmark_spectrograms()
+    benchmark_batched_spectrograms()
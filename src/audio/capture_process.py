@@ -0,0 +1,188 @@
+# Capture audio in a separate process, and pass it to the listener through
+# shared memory.
+
+# In one process, the stream's callback competes for the GIL with recognition:
+# while a spectrogram or forward pass holds the GIL, the callback waits, and if
+# it waits longer than the device buffers, audio is lost (an input overflow).
+# A SharedMemorySource moves the stream to a capture process of its own, which
+# only copies each block into a ring of batches in shared memory. The listener
+# (in the inference process, with the model and the responses) reads the ring
+# through the same callback as for any source. Each counter in the ring's header
+# is written by only one of the two processes, so they need no locks: the
+# capture process publishes a batch by counting it as written after copying it,
+# and the inference process frees a batch by counting it as read.
+
+# The capture process is spawned (started in a fresh interpreter) on every
+# platform, rather than forked: PortAudio has already been initialized in the
+# inference process (e.g., to get the samplerate), and isn't safe to fork. So the
+# script that starts listening must be guarded by if __name__ == "__main__", and
+# the source must be picklable.
+
+from src.audio.listen import adc_time
+from src.audio.sources import TimeInfo
+from multiprocessing import shared_memory
+import multiprocessing as mp
+import numpy as np
+import threading
+import time
+
+SHARED_RING_DURATION = 2   # sec of audio the shared ring holds
+POLL_INTERVAL = 0.0005     # how often (sec) each process checks on the other
+JOIN_TIMEOUT = 2           # sec to wait for the capture process to stop
+
+# the header of the shared memory: counters, each written by one process only
+WRITTEN, OVERFLOWS, DROPPED, FINISHED = 0, 1, 2, 3   # by the capture process
+READ, STOP = 4, 5                                    # by the inference process
+HEADER_LENGTH = 8
+
+
+def shared_ring_size(ring_batches, blocksize):
+    """ The size (bytes) of the shared memory for the ring """
+    return 8 * HEADER_LENGTH + 8 * ring_batches + 4 * ring_batches * blocksize
+
+
+def shared_ring(buffer, ring_batches, blocksize):
+    """ Views of the shared memory: the header, the ADC time of each batch, and the
+    audio of each batch """
+    header = np.ndarray(HEADER_LENGTH, dtype=np.int64, buffer=buffer)
+    adc_times = np.ndarray(ring_batches, dtype=np.float64, buffer=buffer, offset=header.nbytes)
+    audio = np.ndarray((ring_batches, blocksize), dtype=np.float32, buffer=buffer,
+                       offset=header.nbytes + adc_times.nbytes)
+    return header, adc_times, audio
+
+
+def capture(source, blocksize, name, ring_batches):
+    """ Run in the capture process: stream audio from source into the shared ring
+    (the shared memory called name), until asked to stop or the source runs out """
+    memory = shared_memory.SharedMemory(name=name)
+    header, adc_times, audio = shared_ring(memory.buf, ring_batches, blocksize)
+
+    def has_room():
+        return header[WRITTEN] - header[READ] < ring_batches
+
+    def callback(indata, frames, time_pa, status):
+        now = time.perf_counter()
+        if status and status.input_overflow:
+            header[OVERFLOWS] += 1
+        if not has_room():
+            header[DROPPED] += 1
+            return
+        written = header[WRITTEN]
+        slot = written % ring_batches
+        audio[slot] = indata[:, 0]
+        adc_times[slot] = adc_time(time_pa, now)
+        header[WRITTEN] = written + 1
+
+    try:
+        with source.stream(callback, blocksize, ready=has_room):
+            while not header[STOP] and not source.finished():
+                time.sleep(POLL_INTERVAL)
+    finally:
+        header[FINISHED] = 1
+        del header, adc_times, audio
+        memory.close()
+
+
+class SharedMemorySource:
+    """ Audio from another source (e.g., a DeviceSource), captured in a separate
+    process and read from shared memory. The shared ring holds ring_duration (sec)
+    of audio: if the listener falls further behind than that, batches are dropped.
+    After streaming, the capture process's input overflows and dropped batches are
+    in overflows and dropped_batches. """
+
+    def __init__(self, source, ring_duration=SHARED_RING_DURATION):
+        self.source = source
+        self.samplerate = source.samplerate
+        self.ring_duration = ring_duration
+        self.done = threading.Event()
+        self.overflows = 0
+        self.dropped_batches = 0
+
+    def finished(self):
+        """ True once the capture process has stopped, and all its audio has been sent. """
+        return self.done.is_set()
+
+    def stream(self, callback, blocksize, ready=None):
+        """ A context manager that sends audio to callback while open. If given,
+        ready() is checked before each batch is sent, and the batch waits in the
+        shared ring until it's True. """
+        return _SharedMemoryStream(self, callback, blocksize, ready)
+
+
+class _SharedMemoryStream:
+    """ Starts the capture process, and sends the batches it writes to the shared
+    ring to callback, from a separate thread, as a sounddevice stream would. """
+
+    def __init__(self, source, callback, blocksize, ready=None):
+        self.source = source
+        self.callback = callback
+        self.blocksize = blocksize
+        self.ready = ready
+        self.ring_batches = max(2, int(source.ring_duration * source.samplerate / blocksize))
+        self.closing = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        header, adc_times, audio = self.header, self.adc_times, self.audio
+
+        while not self.closing.is_set():
+            # check for the end of capture before the counts, so no batch is missed.
+            # Capture has also ended if the process died (or was killed) without saying so.
+            finished = header[FINISHED]
+            read = header[READ]
+            if read == header[WRITTEN] or (self.ready is not None and not self.ready()):
+                if read == header[WRITTEN] and (finished or not self.process.is_alive()):
+                    if not header[FINISHED]:
+                        print('The capture process stopped unexpectedly (exit code {}).'.format(
+                            self.process.exitcode))
+                    break
+                time.sleep(POLL_INTERVAL)
+                continue
+
+            slot = read % self.ring_batches
+            now = time.perf_counter()
+            self.callback(audio[slot, :, None], self.blocksize,
+                          TimeInfo(adc_times[slot], now, 0), None)
+            header[READ] = read + 1
+
+        self.source.done.set()
+
+    def __enter__(self):
+        self.memory = shared_memory.SharedMemory(
+            create=True, size=shared_ring_size(self.ring_batches, self.blocksize))
+        self.header, self.adc_times, self.audio = shared_ring(
+            self.memory.buf, self.ring_batches, self.blocksize)
+        self.header[:] = 0
+
+        self.source.done.clear()
+        self.process = mp.get_context('spawn').Process(
+            target=capture, daemon=True,
+            args=(self.source.source, self.blocksize, self.memory.name, self.ring_batches))
+        self.process.start()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.header[STOP] = 1
+        self.closing.set()
+        self.thread.join()
+        self.process.join(JOIN_TIMEOUT)
+        if self.process.is_alive():
+            self.process.terminate()
+
+        self.source.overflows = int(self.header[OVERFLOWS])
+        self.source.dropped_batches = int(self.header[DROPPED])
+        if self.source.overflows or self.source.dropped_batches:
+            print('The capture process had {} input overflows, and dropped {} batches.'.format(
+                self.source.overflows, self.source.dropped_batches))
+
+        # the views must go before the shared memory can be closed
+        del self.header, self.adc_times, self.audio
+        self.memory.close()
+        self.memory.unlink()
+        return False
+
+
+# # TESTING
+# my_source = SharedMemorySource(DeviceSource(device=0))
+# listen_recognize_and_respond(my_model, print_noise, device=None, duration=20, source=my_source)
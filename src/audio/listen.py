@@ -2,127 +2,356 @@
 
 # Functions to continuously listen for noises, and pass them to a processing function.
 
-from src.audio.device_settings import get_samplerate
-import sounddevice as sd
+from src.audio.sources import DeviceSource
+from src.audio.noise_settings import BATCH_DURATION, BATCHES_PER_NOISE
+from collections import deque
 import numpy as np
-import queue
+import threading
 import time
 
 ########### CONSTANTS ###########
 
-# listen for noises BATCH_DURATION (seconds) at a time
-BATCH_DURATION = 0.02
+# BATCH_DURATION and BATCHES_PER_NOISE, the length of a noise: see src/audio/noise_settings.py
 # detect a spike when the next batch is at least THRESHOLD_MULTIPLIER times bigger
 THRESHOLD_MULTIPLIER = 5
 # ignore any spikes that don't rise above THRESHOLD_ABSOLUTE. Too many false positives without this
 THRESHOLD_ABSOLUTE = 0.005
-# collect BATCHES_PER_NOISE batches of audio input per detected noise
-BATCHES_PER_NOISE = 3
+# start each noise at its onset within the batch, rather than at the start of the batch.
+# Off until it's checked against the accuracy of models trained on real recordings,
+# whose windows started at the start of the batch
+ALIGN_ONSETS = False
+# collect up to MAX_NOISES_IN_FLIGHT noises at once, so a noise can start while the
+# previous one is still being collected (1: ignore onsets while collecting a noise)
+MAX_NOISES_IN_FLIGHT = BATCHES_PER_NOISE
+# ignore onsets within MIN_ONSET_INTERVAL (seconds) of the previous one: with short
+# batches, the rising edge of a noise can span two of them
+MIN_ONSET_INTERVAL = 0.015
+# keep PRE_ONSET_DURATION (seconds) of audio from before each noise (see ListenerSession.current_context)
+PRE_ONSET_DURATION = 0.02
+# keep at least the most recent RING_DURATION (seconds) of audio in the ring buffer
+RING_DURATION = 1.
+# while waiting for audio, wake up every STOP_CHECK_INTERVAL (seconds) to check the stop condition
+STOP_CHECK_INTERVAL = 0.05
 
 
 ########### Functions for continuous listening and processing ###########
 
-class listen:
-    """ Helper variables for processing continuous audio input """
-
-    def reset():
-        listen.prev_max = 1.
-        listen.batches_to_collect = 0
-        listen.batches_collected = 0
-        listen.current_noise = None
-        listen.start = time.time()
-
-        listen.processing_start = 0  # for timing the total processing time
-        listen.processing_end = 0
-
-        listen.q_batches = queue.Queue()  # a FIFO queue
+# The callback runs in the real-time audio thread, so it shouldn't allocate arrays
+# or wait on locks. It writes each block into a ring buffer allocated up front, and once all
+# the audio of a noise is in, tells the consumer where the noise starts. The
+# consumer then processes a view of the ring buffer, without copying the audio.
+# The ring buffer is followed by a mirror of its first few batches, so that every
+# noise (with its pre-onset context) is a contiguous view, even across the wrap.
+# Noises (and partial noises) are handed to the consumer in the order they
+# started, so the oldest audio yet to be processed is that of the noise the
+# consumer took last, or of the first it hasn't taken. The callback reads only
+# these numbers, never the queue the consumer takes noises from.
+
+# A noise is detected when a batch's peak jumps above the previous batch's. The
+# onset is then located to the sample: the first sample in the batch whose
+# amplitude is over the threshold. This only runs for batches with a noise, so
+# it costs nothing per batch, and the batches can be made shorter (with the
+# batch_duration of listen_and_process) to respond sooner, without changing
+# the length of the noises.
+
+class ListenerSession:
+    """ The state of one listener: its ring buffer, and the noises detected in the
+    audio from its stream. Each session has its own thresholds for detecting noises
+    (see THRESHOLD_MULTIPLIER and THRESHOLD_ABSOLUTE), so several can listen at once
+    in one process, e.g., to different input devices. """
+
+    def __init__(self, threshold_multiplier=THRESHOLD_MULTIPLIER, threshold_absolute=THRESHOLD_ABSOLUTE):
+        self.threshold_multiplier = threshold_multiplier
+        self.threshold_absolute = threshold_absolute
+        self.start = time.time()
+        self.pending = deque()
+        self.all_audio = []
+        self.all_noises = []
+
+    def reset(self, samplerate, blocksize, max_in_flight=MAX_NOISES_IN_FLIGHT, align_onsets=ALIGN_ONSETS,
+              partial_lengths=()):
+        self.prev_max = 1.
+        self.max_in_flight = max_in_flight
+        self.align_onsets = align_onsets
+        self.samplerate = samplerate
+        self.current_noise = None
+        self.current_context = None
+        self.start = time.time()
+
+        self.processing_start = 0  # for timing the total processing time
+        self.processing_end = 0
+
+        # the length of noises and their context, in samples
+        self.noise_length = get_noise_length(samplerate)
+        self.context_length = int(PRE_ONSET_DURATION * samplerate)
+        self.partial_lengths = sorted(partial_lengths)
+        self.min_onset_interval = int(MIN_ONSET_INTERVAL * samplerate)
+        self.last_onset = -self.min_onset_interval
+
+        # the ring buffer, its mirror (long enough for any noise and its context,
+        # starting anywhere in a batch), and a view of each batch in them
+        self.blocksize = blocksize
+        ring_batches = -(-int(RING_DURATION * samplerate) // blocksize)
+        mirror_batches = -(-(self.context_length + self.noise_length) // blocksize) + 1
+        self.ring_batches = ring_batches
+        self.capacity = ring_batches * blocksize
+        self.ring = np.zeros(self.capacity + mirror_batches * blocksize, dtype=np.float32)
+        self.batch_views = list(self.ring[:self.capacity].reshape(ring_batches, blocksize, 1))
+        self.mirror_views = list(self.ring[self.capacity:].reshape(mirror_batches, blocksize, 1))
+        self.write_index = 0       # the batch of the ring buffer to write next
+        self.written = 0           # the number of samples written so far
+        self.dropped_batches = 0   # batches dropped because the consumer fell behind
+        self.overflows = 0         # input overflows reported by the stream
+
+        # noises being collected, as [sample where the noise starts, timestamps from
+        # the onset onwards (see src/main/latency.py), sample where the noise ends,
+        # number of partial noises handed to the consumer so far]
+        self.collecting = deque()
+        # noises (or partial noises) whose audio is all in, as (sample where the
+        # noise starts, timestamps, length), in the order they started
+        self.pending = deque()
+        self.handed_off = 0           # the number of noises handed to the consumer (by callback)
+        self.first_unprocessed = 0    # the start of the first noise handed off since all were processed
+        self.processed = 0            # the number of noises the consumer is done with
+        self.taken_start = 0          # the start of the noise the consumer took last
+        # the starts of noises that were done with at a partial noise
+        self.done_early = set()
+        self.noise_ready = threading.Event()
+        self.current_times = None
         # could use this to collect all audio (uncomment line in callback)
-        listen.all_audio = []
+        self.all_audio = []
         # could use this to collect all noises. Use the processing_function to append
-        listen.all_noises = []
-
-
-# The callback function for the sounddevice input stream
-def callback(indata, frames, time_pa, status):
-    """ Detect if a noise has been made, and add audio to the queue. """
-    if status:
-        print('STATUS: ', str(status))
-    if any(indata):
-        indata_copy = indata.copy()
-        new_max = np.absolute(indata_copy).max()
-        # listen.all_audio.append(indata_copy)
-
-        # Gather audio data if more is required. Make sure to *copy* the input data.
-        if listen.batches_to_collect > 0:
-            listen.q_batches.put_nowait(indata_copy)
-            listen.batches_collected += 1
-            listen.batches_to_collect -= 1
-
-        # Otherwise, see if a new noise has been detected
-        elif (new_max > THRESHOLD_ABSOLUTE and
-              new_max > THRESHOLD_MULTIPLIER * listen.prev_max):
-
-            listen.processing_start = time.time()
-
-            listen.q_batches.put_nowait(indata_copy)
-            listen.batches_collected += 1
-            listen.batches_to_collect = BATCHES_PER_NOISE - 1  # get more batches
-
-        listen.prev_max = new_max
-
-    else:
-        print('no input')
+        self.all_noises = []
+
+    def ring_has_room(self, frames):
+        """ True if frames more samples can be written to the ring buffer without
+        overwriting audio (and pre-onset context) of a noise that is yet to be processed """
+        oldest = self.written
+        if self.collecting and self.collecting[0][0] < oldest:
+            oldest = self.collecting[0][0]
+        if self.processed < self.handed_off:
+            # noises are handed off in the order they started, and processed in that order
+            unprocessed = max(self.first_unprocessed, self.taken_start)
+            if unprocessed < oldest:
+                oldest = unprocessed
+        return self.written + frames - (oldest - self.context_length) <= self.capacity
+
+    def hand_off(self, start, times, length):
+        """ Hand a noise (or partial noise) whose audio is all in to the consumer """
+        if self.processed == self.handed_off:
+            self.first_unprocessed = start
+        self.pending.append((start, times, length))
+        self.handed_off += 1
+        self.noise_ready.set()
+
+    def take_noise(self):
+        """ Take the next noise handed to the consumer, as (start, times, length). Its
+        audio isn't overwritten until done_with_noise is called. """
+        start, times, length = self.pending[0]
+        self.taken_start = start
+        self.pending.popleft()
+        return start, times, length
+
+    def done_with_noise(self):
+        """ Let the callback overwrite the audio of the noise taken last """
+        self.processed += 1
+
+    def ring_view(self, start, length):
+        """ A view of length samples of the ring buffer, from sample number start """
+        position = start % self.capacity
+        return self.ring[position:position + length]
+
+    # The callback function for the sounddevice input stream
+    def callback(self, indata, frames, time_pa, status):
+        """ Detect if a noise has been made, and write the audio to the ring buffer.
+        Expects blocks of self.blocksize frames, one channel. """
+        if status:
+            print('STATUS: ', str(status))
+            if status.input_overflow:
+                self.overflows += 1
+
+        # the peak amplitude, without an array for the absolute values
+        new_max = max(indata.max(), -indata.min())
+
+        if new_max > 0:
+            # drop the batch if writing it would overwrite a noise yet to be processed
+            if not self.ring_has_room(frames):
+                self.dropped_batches += 1
+                return
+
+            # Write the batch to the ring buffer (and its mirror)
+            np.copyto(self.batch_views[self.write_index], indata)
+            if self.write_index < len(self.mirror_views):
+                np.copyto(self.mirror_views[self.write_index], indata)
+            # self.all_audio.append(indata.copy())
+
+            # See if a new noise has been detected, even while others are being collected
+            if (len(self.collecting) < self.max_in_flight and
+                    new_max > self.threshold_absolute and
+                    new_max > self.threshold_multiplier * self.prev_max):
+
+                self.processing_start = time.time()
+                now = time.perf_counter()
+                offset = onset_offset(indata[:, 0], self.prev_max, self.threshold_multiplier,
+                                      self.threshold_absolute) if self.align_onsets else 0
+                start = self.written + offset
+                if start - self.last_onset >= self.min_onset_interval:
+                    times = {'adc': adc_time(time_pa, now) + offset / self.samplerate, 'onset': now}
+                    self.collecting.append([start, times, start + self.noise_length, 0])
+                    self.last_onset = start
+
+            self.written += frames
+            self.write_index = (self.write_index + 1) % self.ring_batches
+            self.prev_max = new_max
+
+            # hand noises to the consumer once all their audio is in, and partial noises
+            # (if wanted) as it comes in, in the order the noises started: the partial
+            # noises of a noise wait until every noise before it is handed off
+            while self.collecting:
+                noise = self.collecting[0]
+                while (noise[3] < len(self.partial_lengths) and
+                       noise[0] + self.partial_lengths[noise[3]] <= self.written):
+                    self.hand_off(noise[0], noise[1], self.partial_lengths[noise[3]])
+                    noise[3] += 1
+                if noise[2] > self.written:
+                    break
+                self.collecting.popleft()
+                self.hand_off(noise[0], noise[1], self.noise_length)
+
+        else:
+            print('no input')
+
+    # The consumer side of listening: wait for noises from callback and process them
+    def process_noises(self, processing_function, stop_condition, print_after_processing=None):
+        """ Wait for noises from callback, and process each as a view of the ring buffer
+        once all its audio has arrived. The view is only valid
+        during processing: the processing_function must copy it to keep it. Sleeps while
+        there is no audio to process, waking every STOP_CHECK_INTERVAL to check stop_condition().
+        Partial noises (if listening for them) are processed the same way: if the
+        processing_function returns True for one, the rest of that noise is skipped. """
+
+        while not stop_condition():
+
+            # wait for the next noise, without spinning the CPU
+            if not self.pending:
+                self.noise_ready.wait(STOP_CHECK_INTERVAL)
+                self.noise_ready.clear()
+                continue
+
+            # its audio isn't overwritten until done_with_noise
+            start, times, length = self.take_noise()
+
+            # skip the rest of a noise that was done with early
+            if start in self.done_early:
+                if length == self.noise_length:
+                    self.done_early.discard(start)
+                self.done_with_noise()
+                continue
+
+            context_length = min(start, self.context_length)
+            self.current_context = self.ring_view(start - context_length, context_length)
+            self.current_noise = self.ring_view(start, length)
+            self.current_times = times
+            self.current_times['window'] = time.perf_counter()
+
+            done = processing_function(self.current_noise)
+            if done and length < self.noise_length:
+                self.done_early.add(start)
+            self.done_with_noise()
+
+            # print something after processing, if desired
+            print_after_processing() if print_after_processing else None
+
+
+# The default session, for listening to one stream at a time. Its methods can be
+# used as functions (e.g., callback), as before sessions were objects.
+listen = ListenerSession()
+callback = listen.callback
+process_noises = listen.process_noises
+ring_has_room = listen.ring_has_room
+ring_view = listen.ring_view
+
+
+def get_noise_length(samplerate):
+    """ The number of samples in a noise """
+    return BATCHES_PER_NOISE * int(samplerate * BATCH_DURATION)
+
+
+def adc_time(time_pa, now):
+    """ When the first frame of a block was captured, on the time.perf_counter() clock,
+    given the stream's time info. Estimated if the stream doesn't provide it. """
+    if time_pa is not None and time_pa.inputBufferAdcTime > 0:
+        return now - (time_pa.currentTime - time_pa.inputBufferAdcTime)
+    return now - BATCH_DURATION
+
+
+def onset_offset(block, prev_max, threshold_multiplier=THRESHOLD_MULTIPLIER,
+                 threshold_absolute=THRESHOLD_ABSOLUTE):
+    """ The index of the first sample in the block whose amplitude is above the
+    threshold for a noise, given the peak of the previous batch """
+    level = max(threshold_absolute, threshold_multiplier * prev_max)
+    return int(np.argmax(np.abs(block) > level))
 
 
 # Used as a condition to stop recording.
-def time_elapsed(duration):
-    """ Returns a function, which returns True if enough time has elapsed. """
+def time_elapsed(duration, session=None):
+    """ Returns a function, which returns True if enough time has elapsed since the
+    session (default: listen) started listening (or never, if duration is None). """
     def _time_elapsed():
-        return time.time() - listen.start > duration
+        return duration is not None and time.time() - (session or listen).start > duration
     return _time_elapsed
 
 
 # A helper used for testing.
-def print_processing_time():
+def print_processing_time(session=None):
     """ Prints time it took to process a single noise recognition. """
-    listen.processing_end = time.time()
+    session = session or listen
+    session.processing_end = time.time()
     print('Processing took {:.4f} sec\n'.format(
-        listen.processing_end - listen.processing_start))
+        session.processing_end - session.processing_start))
 
 
 # The main generic real-time listening function
-def listen_and_process(processing_function, device, stop_condition=time_elapsed(3),
-                    print_after_processing=None):
+def listen_and_process(processing_function, device, stop_condition=None,
+                    print_after_processing=None, source=None, max_in_flight=MAX_NOISES_IN_FLIGHT,
+                    align_onsets=ALIGN_ONSETS, batch_duration=BATCH_DURATION, partial_lengths=(),
+                    session=None):
     """ Listen continuously for noises until stop_condition() returns True (default: wait 3 sec).
-    As each noise is heard, processes using processing_function. Return all noises at the end. """
-
-    listen.reset()  # reinitialize helper variables
+    As each noise is heard, processes using processing_function. Each noise is a view of
+    the ring buffer, so the processing_function must copy it to keep it.
+    Audio comes from the input device, or from source if given (see src/audio/sources.py),
+    in which case listening also stops once the source runs out of audio.
+    Up to max_in_flight noises are collected at once, so noises in quick succession
+    each get their own (overlapping) window, starting at their own onset. If align_onsets
+    is True, a noise starts at the sample of its onset, otherwise at the start of the
+    batch with the onset. Audio arrives in batches of batch_duration (sec): shorter
+    batches let a noise be processed sooner after its audio is in. For streaming,
+    partial_lengths (a list of lengths, in samples, shorter than a noise) are also
+    processed as each noise's audio comes in: see process_noises.
+    The state of listening is kept in session (a ListenerSession, default: listen):
+    to listen to several streams at once, give each its own session. """
+
+    source = source or DeviceSource(device)
+    session = session or listen
+    if stop_condition is None:
+        stop_condition = time_elapsed(3, session)
 
     # get the block (batch) size in frames
-    samplerate = get_samplerate(device)
-    blocksize = int(samplerate * BATCH_DURATION)
-
-    with sd.InputStream(device=device, channels=1, callback=callback,
-                        blocksize=blocksize,
-                        samplerate=samplerate):
-        print('Listening...')
-        while True:
+    blocksize = int(source.samplerate * batch_duration)
 
-            # data collects if it meets the threshold. Process when enough data is in queue:
-            if listen.batches_collected >= BATCHES_PER_NOISE:
-                data = []
-                for _ in range(BATCHES_PER_NOISE):
-                    data.append(listen.q_batches.get_nowait())
-                listen.batches_collected -= BATCHES_PER_NOISE
+    # reinitialize helper variables
+    session.reset(source.samplerate, blocksize, max_in_flight, align_onsets, partial_lengths)
 
-                listen.current_noise = np.concatenate(data, axis=None)
+    # stop when asked, or when there is no audio left to process
+    def _stop_condition():
+        return stop_condition() or (source.finished() and not session.pending)
 
-                processing_function(listen.current_noise)
-
-                # print something after processing, if desired
-                print_after_processing() if print_after_processing else None
-
-            # listen until the condition is met
-            if stop_condition():
-                break
+    # an offline source waits for room in the ring buffer, rather than drop audio
+    with source.stream(session.callback, blocksize, ready=lambda: session.ring_has_room(blocksize)):
+        print('Listening...')
+        session.process_noises(processing_function, _stop_condition, print_after_processing)
         print('Done.')
+
+    if session.dropped_batches or session.overflows:
+        print('Dropped {} batches while processing fell behind, and {} input overflows.'.format(
+            session.dropped_batches, session.overflows))
@@ -1,24 +1,128 @@
 # Audio processing: preparing spectrograms
 
-# A function to create a spectrogram from a noise sample recording.
+# A function to create a spectrogram from a noise sample recording, and the
+# reusable spectrogram front end that does the work.
 
+import numpy as np
+import threading
 import torch
+import torch.nn.functional as F
 import torchaudio.transforms
 
 
 N_MELS = 28                # PARAMETER: the number of mel filterbanks in each spectrogram
+N_FFT = 400                # the window length (in frames) of each FFT. Same as the torchaudio default
+CHUNK_SIZE = 256           # the number of samples transformed at once when batching spectrograms
+
+
+class SpectrogramFrontEnd:
+    """ Computes log2 mel spectrograms, equal to those of torchaudio's MelSpectrogram.
+    The window and mel filterbank are built once, and buffers are reused between calls
+    for samples of the same length, so each spectrogram is just an FFT and a matmul. """
+
+    def __init__(self, samplerate, n_mels=N_MELS, n_fft=N_FFT):
+        self.samplerate = samplerate
+        self.n_mels = n_mels
+        self.n_fft = n_fft
+        self.hop_length = n_fft // 2  # torchaudio default
+
+        # borrow the window and filterbank from torchaudio, so the parameters match exactly
+        transform = torchaudio.transforms.MelSpectrogram(
+            sample_rate=samplerate, n_fft=n_fft, n_mels=n_mels)
+        self.window = transform.spectrogram.window.clone()
+        self.fb_T = transform.mel_scale.fb.T.contiguous()   # (n_mels, n_freqs)
+
+        self.sample_length = None
+        self.lock = threading.Lock()  # the buffers are shared, so one spectrogram at a time
+
+    def _allocate(self, sample_length):
+        """ (Re)allocate the buffers for samples of a given length. """
+        pad = self.n_fft // 2
+        n_frames = 1 + sample_length // self.hop_length
+        n_freqs = self.n_fft // 2 + 1
+
+        # the sample is centered by reflection padding, as torch.stft(center=True) does
+        self.padded = torch.empty(sample_length + 2 * pad)
+        self.centered = self.padded[pad:pad + sample_length]
+        self.left_index = torch.arange(pad, 0, -1)
+        self.right_index = torch.arange(sample_length - 2, sample_length - pad - 2, -1)
+        # the frames are overlapping views into the padded sample
+        self.frames = self.padded.unfold(0, self.n_fft, self.hop_length)
+
+        self.windowed = torch.empty(n_frames, self.n_fft)
+        self.spectrum = torch.empty(n_frames, n_freqs, dtype=torch.complex64)
+        self.power = torch.empty(n_frames, n_freqs)
+        self.mel = torch.empty(self.n_mels, n_frames)
+        self.sample_length = sample_length
+
+    def __call__(self, noise_sample):
+        """ Takes a noise_sample as a flattened numpy.array,
+        and returns a mel spectrogram as a 2D torch.tensor """
+        with self.lock:
+            if len(noise_sample) != self.sample_length:
+                self._allocate(len(noise_sample))
+            pad = self.n_fft // 2
+
+            # normalize to have unit mean, and pad the ends
+            torch.div(torch.from_numpy(noise_sample), noise_sample.mean(), out=self.centered)
+            torch.index_select(self.centered, 0, self.left_index, out=self.padded[:pad])
+            torch.index_select(self.centered, 0, self.right_index, out=self.padded[-pad:])
+
+            # the power spectrum of each windowed frame, then the mel scale
+            torch.mul(self.frames, self.window, out=self.windowed)
+            torch.fft.rfft(self.windowed, out=self.spectrum)
+            torch.abs(self.spectrum, out=self.power).square_()
+            torch.matmul(self.fb_T, self.power.T, out=self.mel)
+
+            return torch.log2(self.mel)
+
+    def batch(self, noise_samples, chunk_size=CHUNK_SIZE):
+        """ Takes a sequence of equal-length noise samples (flattened numpy.arrays),
+        and returns their mel spectrograms as one (N, 1, n_mels, frames) torch.tensor,
+        with a channel dimension as needed for the CNN. Samples are transformed
+        chunk_size at a time, to bound the memory used. """
+
+        num_samples = len(noise_samples)
+        if num_samples == 0:
+            return torch.empty(0, 1, self.n_mels, 0)
+
+        pad = self.n_fft // 2
+        n_frames = 1 + len(noise_samples[0]) // self.hop_length
+        spectrograms = torch.empty(num_samples, 1, self.n_mels, n_frames)
+
+        for start in range(0, num_samples, chunk_size):
+            stop = min(start + chunk_size, num_samples)
+            chunk = torch.from_numpy(np.stack(noise_samples[start:stop]).astype(np.float32, copy=False))
+
+            # normalize each sample to have unit mean, and pad the ends
+            chunk = chunk / chunk.mean(dim=1, keepdim=True)
+            padded = F.pad(chunk[:, None, :], (pad, pad), mode='reflect')[:, 0, :]
+
+            # the power spectrum of each windowed frame, then the mel scale
+            frames = padded.unfold(1, self.n_fft, self.hop_length) * self.window
+            power = torch.fft.rfft(frames).abs().square_()
+            torch.matmul(self.fb_T, power.transpose(1, 2), out=spectrograms[start:stop, 0])
+
+        return spectrograms.log2_()
+
+
+# front ends are shared by everything using the same settings
+_front_ends = {}
+
+
+def get_front_end(samplerate, n_mels=N_MELS, n_fft=N_FFT):
+    """ Return the spectrogram front end for these settings, creating it on first use. """
+    key = (samplerate, n_mels, n_fft)
+    if key not in _front_ends:
+        _front_ends[key] = SpectrogramFrontEnd(samplerate, n_mels, n_fft)
+    return _front_ends[key]
 
 
 def generate_spectrogram(noise_sample, samplerate, n_mels=N_MELS):
     """ Takes a noise_sample as a flattened numpy.array,
     and returns a mel spectrogram as a 2D torch.tensor """
 
-    # normalize to have unit mean, and compute the spectrogram
-    normed_sample = torch.from_numpy(noise_sample) / noise_sample.mean()
-    mel = torchaudio.transforms.MelSpectrogram(
-        sample_rate=samplerate, n_mels=n_mels)(normed_sample)
-
-    return mel.log2()
+    return get_front_end(samplerate, n_mels)(noise_sample)
 
 
 # # TESTING
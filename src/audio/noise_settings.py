@@ -0,0 +1,9 @@
+# The length of a noise: the settings shared by listening (src/audio/listen.py)
+# and the code that works on recorded noises without listening (e.g.,
+# src/model/sweep.py). Kept apart, with no imports, so that code doesn't need
+# an audio device library.
+
+# listen for noises BATCH_DURATION (seconds) at a time
+BATCH_DURATION = 0.02
+# collect BATCHES_PER_NOISE batches (of BATCH_DURATION) of audio input per detected noise
+BATCHES_PER_NOISE = 3
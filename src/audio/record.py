@@ -29,7 +29,7 @@ def record_model_data(device, starting_noise_data={}):
         def _gather_and_progress(rec):
             nonlocal noise_count
 
-            listen.all_noises.append(rec)
+            listen.all_noises.append(rec.copy())  # rec is a view of the ring buffer
             noise_count += 1
             sys.stdout.write(str(noise_count) + ', ')
             sys.stdout.flush()
@@ -72,10 +72,13 @@ def record_model_data(device, starting_noise_data={}):
         print('Please start recording.\n')
         print('"{}" noises recorded (out of {}): '.format(label, num))
         noise_count = 0
+        # one noise at a time: a second transient within a noise (e.g., a "tsk") would
+        # otherwise start another, shifted window, and be saved as a sample of its own
         listen_and_process(processing_function=gather_and_progress(label, num),
                            device=device,
                            stop_condition=lambda: noise_count >= num,
-                           print_after_processing=None)
+                           print_after_processing=None,
+                           max_in_flight=1)
         print('')
 
         # save the list of recorded noises
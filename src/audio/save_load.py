@@ -1,31 +1,161 @@
 # Functions to save (and load) recordings, if desired.
 
+# Recordings are saved in a columnar .noises file: a small JSON header (with the
+# labels and samplerate), then an offsets array marking where each noise sample
+# starts, a label index giving each sample's label, and all the audio as one
+# float32 array, with the samples for each label stored together. Loading
+# memory-maps the file, so opening a large library is near-instant, and each
+# noise sample is a view into the file rather than a copy.
+
+# Older recordings were saved as a pickled dictionary in a .npy file. These can
+# still be loaded, or converted once with convert_noise_samples. Loading a
+# .noises file that doesn't exist loads the .npy file of the same name, if any.
+
 from src.utils.save_load import save_file, load_file
+import json
 import numpy as np
+import os
 
 # Save or load noise sample dictionaries, with audio data:
 DICT_BASEPATH = 'output/saved_noise_samples/'
+EXTENSION = '.noises'
+LEGACY_EXTENSION = '.npy'
+
+MAGIC = b'BBNOISES'
+ALIGNMENT = 64  # byte alignment of each array in the file
+
+
+class NoiseLibrary(dict):
+    """ A dictionary of noise sample recordings, with labels as keys and lists of
+    flattened numpy arrays (one array per noise sample) as values, along with the
+    samplerate they were recorded at (None if unknown). """
+
+    def __init__(self, noise_data_dict=(), samplerate=None):
+        super().__init__(noise_data_dict)
+        self.samplerate = samplerate
+
+    def subset(self, labels):
+        """ A library with only the given labels. The noise samples are shared, not copied. """
+        return NoiseLibrary({k: v for k, v in self.items() if k in labels}, self.samplerate)
+
+
+def _aligned(position):
+    return -(-position // ALIGNMENT) * ALIGNMENT
+
+
+def write_noise_library(noise_data_dict, path, samplerate=None):
+    """ Write a dictionary of noise samples to path in the columnar format. """
+
+    labels = list(noise_data_dict.keys())
+    samples = [np.asarray(s, dtype=np.float32).ravel()
+               for label in labels for s in noise_data_dict[label]]
+    counts = [len(noise_data_dict[label]) for label in labels]
+
+    offsets = np.zeros(len(samples) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(s) for s in samples])
+    label_index = np.repeat(np.arange(len(labels), dtype=np.int32), counts)
+
+    # lay out the arrays after a fixed-size header, each aligned for memory-mapping
+    header = {'samplerate': samplerate, 'labels': labels, 'num_samples': len(samples)}
+    header_size = _aligned(len(MAGIC) + 8 + len(json.dumps(header)) + 256)
+    header['offsets_start'] = header_size
+    header['label_index_start'] = _aligned(header['offsets_start'] + offsets.nbytes)
+    header['samples_start'] = _aligned(header['label_index_start'] + label_index.nbytes)
+    header_bytes = json.dumps(header).encode()
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(len(header_bytes).to_bytes(8, 'little'))
+        f.write(header_bytes)
+        f.seek(header['offsets_start'])
+        f.write(offsets.tobytes())
+        f.seek(header['label_index_start'])
+        f.write(label_index.tobytes())
+        f.seek(header['samples_start'])
+        for s in samples:
+            f.write(s.tobytes())
 
 
-def save_noise_samples(noise_data_dict, filename=None, rewrite=False, basepath=DICT_BASEPATH):
-    """ Save the dictionary of noise sample recordings """
+def read_noise_library(path):
+    """ Memory-map a columnar noise sample file as a NoiseLibrary. """
+
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a noise sample file.'.format(path))
+        header_length = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(header_length))
+
+    num_samples = header['num_samples']
+    library = NoiseLibrary({label: [] for label in header['labels']}, header['samplerate'])
+    if num_samples == 0:
+        return library
+
+    offsets = np.memmap(path, dtype=np.int64, mode='r',
+                        offset=header['offsets_start'], shape=(num_samples + 1,))
+    label_index = np.memmap(path, dtype=np.int32, mode='r',
+                            offset=header['label_index_start'], shape=(num_samples,))
+
+    # copy-on-write, so the samples are writable arrays without changing the file
+    audio = np.asarray(np.memmap(path, dtype=np.float32, mode='c',
+                                 offset=header['samples_start'], shape=(int(offsets[-1]),)))
+
+    for i, s in zip(label_index, np.split(audio, offsets[1:-1])):
+        library[header['labels'][i]].append(s)
+
+    return library
+
+
+def save_noise_samples(noise_data_dict, filename=None, rewrite=False, basepath=DICT_BASEPATH,
+                       samplerate=None):
+    """ Save the dictionary of noise sample recordings. The samplerate is taken
+    from noise_data_dict if it's a NoiseLibrary and none is given. """
+
+    if samplerate is None:
+        samplerate = getattr(noise_data_dict, 'samplerate', None)
 
     def save_function(data, path):
-        np.save(path, data)
+        write_noise_library(data, path, samplerate)
 
     return save_file(data=noise_data_dict, filename=filename, rewrite=rewrite,
-                     basepath=basepath, extension=".npy", save_function=save_function)
+                     basepath=basepath, extension=EXTENSION, save_function=save_function)
 
 
 def load_noise_samples(filename=None, basepath=DICT_BASEPATH):
-    """ Load a dictionary of noise sample recordings """
+    """ Load a dictionary (NoiseLibrary) of noise sample recordings.
+    Files saved in the older .npy format are loaded into memory, including in
+    place of a missing .noises file of the same name. """
+
+    if filename is not None and filename.endswith(EXTENSION):
+        legacy_filename = filename[:-len(EXTENSION)] + LEGACY_EXTENSION
+        if (not os.path.exists(os.path.join(basepath, filename)) and
+                os.path.exists(os.path.join(basepath, legacy_filename))):
+            print('Loading {} (the older format). Convert it with convert_noise_samples '
+                  'to load it faster.'.format(legacy_filename))
+            filename = legacy_filename
 
     def load_function(path):
-        return np.load(path, allow_pickle=True).item()
+        if path.endswith(LEGACY_EXTENSION):
+            return NoiseLibrary(np.load(path, allow_pickle=True).item())
+        return read_noise_library(path)
 
     return load_file(filename=filename, basepath=basepath, load_function=load_function)
 
+
+def convert_noise_samples(filename, samplerate=None, rewrite=False, basepath=DICT_BASEPATH):
+    """ Convert a recordings file from the older .npy format to a .noises file
+    of the same name. The samplerate isn't recorded in .npy files, so give it if known. """
+
+    noise_data_dict = load_noise_samples(filename, basepath=basepath)
+    if noise_data_dict is None:
+        return
+
+    if filename.endswith(LEGACY_EXTENSION):
+        filename = filename[:-len(LEGACY_EXTENSION)]
+    return save_noise_samples(noise_data_dict, filename=filename, rewrite=rewrite,
+                              basepath=basepath, samplerate=samplerate)
+
 # # TESTING
-# save_noise_samples(my_recordings)
-# my_loaded_file = load_noise_samples(filename='my_recordings.npy')
+# save_noise_samples(my_recordings, samplerate=samplerate)
+# my_loaded_file = load_noise_samples(filename='my_recordings.noises')
 # my_loaded_file
+# convert_noise_samples('my_old_recordings.npy', samplerate=samplerate)
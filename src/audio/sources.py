@@ -0,0 +1,215 @@
+# Audio sources for the listener
+
+# The listener gets audio from a source: live from a sounddevice input device,
+# or offline from a recording (a WAV file, .npy file, or numpy array). Either way,
+# the audio arrives at the same callback in blocks of the same size. Offline
+# audio can be replayed at real-time pace, or as fast as possible to test and
+# benchmark detection and recognition without a microphone. Replaying in real
+# time can also mimic a device's limited buffering, losing audio (an input
+# overflow) whenever the callback is held up for too long.
+
+from src.audio.device_settings import get_samplerate
+from collections import namedtuple
+import sounddevice as sd
+import numpy as np
+import threading
+import time
+import wave
+
+# while replaying faster than real time, how often (sec) to check if the listener is ready
+READY_POLL_INTERVAL = 0.0005
+
+# the stream time info passed to the callback, like sounddevice's
+TimeInfo = namedtuple('TimeInfo', ['inputBufferAdcTime', 'currentTime', 'outputBufferDacTime'])
+
+
+class StreamStatus:
+    """ The status flags passed to the callback, like sounddevice's CallbackFlags """
+
+    def __init__(self, input_overflow=False):
+        self.input_overflow = input_overflow
+
+    def __bool__(self):
+        return self.input_overflow
+
+    def __str__(self):
+        return 'input overflow' if self.input_overflow else ''
+
+
+class DeviceSource:
+    """ Live audio from a sounddevice input device """
+
+    def __init__(self, device):
+        self.device = device
+        self.samplerate = get_samplerate(device)
+
+    def finished(self):
+        """ A live device never runs out of audio. """
+        return False
+
+    def stream(self, callback, blocksize, ready=None):
+        """ A context manager that sends audio to callback while open. A live device
+        can't wait for the listener to be ready for more audio, so ready is ignored. """
+        return sd.InputStream(device=self.device, channels=1, callback=callback,
+                              blocksize=blocksize, samplerate=self.samplerate)
+
+
+def load_audio(path, samplerate=None):
+    """ Load a recording as a flattened float32 numpy.array, and its samplerate.
+    WAV files are mixed down to mono. A .npy file holds just the audio, so its
+    samplerate must be given. """
+
+    if path.endswith('.npy'):
+        if samplerate is None:
+            raise ValueError('The samplerate of {} must be given.'.format(path))
+        return np.load(path).astype(np.float32).ravel(), samplerate
+
+    with wave.open(path, 'rb') as w:
+        samplerate = w.getframerate()
+        channels = w.getnchannels()
+        width = w.getsampwidth()
+        raw = w.readframes(w.getnframes())
+
+    # convert the PCM integers to floats in [-1, 1)
+    if width == 1:
+        audio = (np.frombuffer(raw, dtype=np.uint8).astype(np.float32) - 128) / 128
+    elif width == 3:
+        b = np.frombuffer(raw, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        ints = (b[:, 0] | (b[:, 1] << 8) | (b[:, 2] << 16)) << 8  # sign-extend via the top byte
+        audio = ints.astype(np.float32) / 2**31
+    else:
+        dtype = {2: np.int16, 4: np.int32}[width]
+        audio = np.frombuffer(raw, dtype=dtype).astype(np.float32) / -np.iinfo(dtype).min
+
+    return audio.reshape(-1, channels).mean(axis=1), samplerate
+
+
+class FileSource:
+    """ Offline audio from a recording: a path to a WAV or .npy file, or a numpy.array
+    (with its samplerate). If realtime is True the blocks are paced like a live
+    device. Otherwise they are sent as fast as they can be processed. Replaying in
+    real time, if device_buffer (in blocks) is given, blocks that wait longer than
+    that for the callback are lost, as with a device. """
+
+    def __init__(self, audio, samplerate=None, realtime=False, device_buffer=None):
+        if isinstance(audio, str):
+            audio, samplerate = load_audio(audio, samplerate)
+        elif samplerate is None:
+            raise ValueError('The samplerate of the audio must be given.')
+
+        self.audio = np.asarray(audio, dtype=np.float32).ravel()
+        self.samplerate = samplerate
+        self.realtime = realtime
+        self.device_buffer = device_buffer
+        self.done = threading.Event()
+
+    def __getstate__(self):
+        # an Event can't be pickled (e.g., to stream from another process)
+        state = self.__dict__.copy()
+        del state['done']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.done = threading.Event()
+
+    def duration(self):
+        """ The length of the recording, in seconds """
+        return len(self.audio) / self.samplerate
+
+    def finished(self):
+        """ True once all the audio has been sent. """
+        return self.done.is_set()
+
+    def stream(self, callback, blocksize, ready=None):
+        """ A context manager that sends audio to callback while open. If given,
+        ready() is checked before each block, and the block waits until it's True
+        (e.g., while the listener has no room for it), unless replaying in real time. """
+        return _FileStream(self, callback, blocksize, ready)
+
+
+class _FileStream:
+    """ Sends a FileSource's audio to callback, one block at a time, from a separate
+    thread, as a sounddevice stream would. """
+
+    def __init__(self, source, callback, blocksize, ready=None):
+        self.source = source
+        self.callback = callback
+        self.blocksize = blocksize
+        self.ready = ready
+        self.closing = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        audio = self.source.audio
+        block_duration = self.blocksize / self.source.samplerate
+        start = time.perf_counter()
+
+        n_blocks = len(audio) // self.blocksize
+        i = 0
+        while i < n_blocks and not self.closing.is_set():
+            status = None
+
+            # a device only buffers so many blocks: if the callback fell further
+            # behind than that, the oldest blocks are lost
+            if self.source.realtime and self.source.device_buffer:
+                behind = int((time.perf_counter() - start) / block_duration) - i
+                if behind > self.source.device_buffer:
+                    i += behind - self.source.device_buffer
+                    status = StreamStatus(input_overflow=True)
+                    if i >= n_blocks:
+                        break
+            block = audio[i * self.blocksize:(i + 1) * self.blocksize, None]
+
+            # as fast as possible, but no faster than the listener can keep up with
+            if not self.source.realtime and self.ready is not None:
+                while not self.ready() and not self.closing.is_set():
+                    time.sleep(READY_POLL_INTERVAL)
+
+            # in real time, the block would have taken block_duration to capture
+            now = time.perf_counter()
+            captured = now - block_duration if self.source.realtime else now
+            self.callback(block, self.blocksize, TimeInfo(captured, now, 0), status)
+
+            # keep to the schedule of a live device, if desired
+            if self.source.realtime:
+                delay = start + (i + 1) * block_duration - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            i += 1
+
+        self.source.done.set()
+
+    def __enter__(self):
+        self.source.done.clear()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.closing.set()
+        self.thread.join()
+        return False
+
+
+def synthetic_recording(duration, samplerate, noise_every=0.5, noise_samples=None, seed=0):
+    """ Make a recording of quiet background audio, with a noise every noise_every
+    seconds. Noises are drawn from noise_samples (e.g., recorded noises), or are
+    short bursts of white noise if none are given. """
+    rng = np.random.default_rng(seed)
+    audio = 1e-4 * rng.standard_normal(int(duration * samplerate), dtype=np.float32)
+
+    burst = int(0.005 * samplerate)
+    for start in range(int(noise_every * samplerate), len(audio) - 4 * burst,
+                       int(noise_every * samplerate)):
+        if noise_samples:
+            noise = noise_samples[rng.integers(len(noise_samples))][:len(audio) - start]
+        else:
+            noise = 0.5 * rng.standard_normal(burst, dtype=np.float32)
+        audio[start:start + len(noise)] += noise
+
+    return audio
+
+
+# # TESTING
+# my_source = FileSource('my_session.wav', realtime=False)
+# listen_recognize_and_respond(my_model, print_noise, device=None, duration=None, source=my_source)
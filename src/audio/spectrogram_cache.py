@@ -0,0 +1,140 @@
+# Audio processing: caching spectrograms on disk
+
+# Spectrograms for unchanged recordings are the same every time, so keep them on
+# disk rather than recomputing them for every dataset. Each spectrogram is
+# addressed by a hash of its noise sample and the spectrogram settings. New
+# spectrograms are saved together as one .npy file, which is memory-mapped when
+# read back. The least recently used files are evicted when the cache grows too big.
+
+import hashlib
+import json
+import os
+import numpy as np
+import torch
+
+CACHE_BASEPATH = 'output/spectrogram_cache/'
+CACHE_MAX_BYTES = 256 * 2**20   # evict old spectrograms beyond this total size
+INDEX_FILENAME = 'index.json'
+
+
+def sample_keys(noise_samples, front_end):
+    """ A content hash for each noise sample, combined with the front end settings. """
+    settings = '{}/{}/{}'.format(front_end.samplerate, front_end.n_mels, front_end.n_fft)
+    keys = []
+    for s in noise_samples:
+        h = hashlib.blake2b(settings.encode(), digest_size=16)
+        h.update(str(s.dtype).encode())
+        h.update(np.ascontiguousarray(s).data)
+        keys.append(h.hexdigest())
+    return keys
+
+
+class SpectrogramCache:
+    """ A content-addressed store of spectrograms. The index maps each sample key to
+    the file and row holding its spectrogram. """
+
+    def __init__(self, basepath=CACHE_BASEPATH, max_bytes=CACHE_MAX_BYTES):
+        self.basepath = basepath
+        self.max_bytes = max_bytes
+        self.index_path = os.path.join(basepath, INDEX_FILENAME)
+
+    def _read_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self, index):
+        # write then rename, so an interrupted write can't corrupt the index
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def get_spectrograms(self, noise_samples, front_end):
+        """ Return the spectrograms of noise_samples as one (N, 1, n_mels, frames)
+        torch.tensor, as front_end.batch would. Only samples missing from the
+        cache are computed, and those are then added to it. """
+
+        if len(noise_samples) == 0:
+            return front_end.batch(noise_samples)
+
+        os.makedirs(self.basepath, exist_ok=True)
+        index = self._read_index()
+        keys = sample_keys(noise_samples, front_end)
+
+        # gather the rows to read from each cached file
+        hits = {}
+        missing = []
+        for i, key in enumerate(keys):
+            entry = index.get(key)
+            if entry and os.path.exists(os.path.join(self.basepath, entry[0])):
+                hits.setdefault(entry[0], []).append((i, entry[1]))
+            else:
+                missing.append(i)
+
+        n_frames = 1 + len(noise_samples[0]) // front_end.hop_length
+        spectrograms = torch.empty(len(noise_samples), 1, front_end.n_mels, n_frames)
+
+        for filename, rows in hits.items():
+            path = os.path.join(self.basepath, filename)
+            cached = np.load(path, mmap_mode='r')
+            sample_indices, file_rows = zip(*rows)
+            spectrograms[list(sample_indices)] = torch.from_numpy(cached[list(file_rows)])
+            os.utime(path)  # mark as recently used
+
+        # compute the rest, and save them together as a new file
+        if missing:
+            new_spectrograms = front_end.batch([noise_samples[i] for i in missing])
+            spectrograms[missing] = new_spectrograms
+
+            new_keys = [keys[i] for i in missing]
+            filename = hashlib.blake2b(''.join(new_keys).encode(), digest_size=16).hexdigest() + '.npy'
+            np.save(os.path.join(self.basepath, filename), new_spectrograms.numpy())
+            for row, key in enumerate(new_keys):
+                index[key] = [filename, row]
+
+            self._evict(index, keep=filename)
+            self._write_index(index)
+
+        print('Spectrograms: {} cached, {} computed'.format(
+            len(noise_samples) - len(missing), len(missing)))
+
+        return spectrograms
+
+    def _evict(self, index, keep=None):
+        """ Delete the least recently used files until the cache fits in max_bytes,
+        and drop their entries from the index. """
+        with os.scandir(self.basepath) as entries:
+            files = [(e.stat().st_mtime, e.stat().st_size, e.name) for e in entries
+                     if e.name.endswith('.npy')]
+        total = sum(size for _, size, _ in files)
+
+        evicted = set()
+        for _, size, name in sorted(files):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            os.remove(os.path.join(self.basepath, name))
+            evicted.add(name)
+            total -= size
+
+        if evicted:
+            for key in [k for k, (name, _) in index.items() if name in evicted]:
+                del index[key]
+
+    def clear(self):
+        """ Delete every cached spectrogram. """
+        if not os.path.exists(self.basepath):
+            return
+        with os.scandir(self.basepath) as entries:
+            for entry in entries:
+                if entry.name.endswith('.npy') or entry.name == INDEX_FILENAME:
+                    os.remove(entry.path)
+
+
+# # TESTING
+# my_cache = SpectrogramCache()
+# my_spectrograms = my_cache.get_spectrograms(my_recordings['t'], get_front_end(samplerate))
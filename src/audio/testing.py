@@ -40,7 +40,7 @@ if __name__ == "__main__":
 
     # audio/save_load.py
 
-    save_noise_samples(my_recordings, filename='my_recordings.npy', rewrite=True)
+    save_noise_samples(my_recordings, filename='my_recordings.noises', rewrite=True)
     time.sleep(0.5)
-    my_loaded_file = load_noise_samples(filename='my_recordings.npy')
+    my_loaded_file = load_noise_samples(filename='my_recordings.noises')
     print(my_loaded_file)
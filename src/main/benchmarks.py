@@ -0,0 +1,264 @@
+# --------- Pretend we're in the root directory ---------
+import sys
+import os
+
+ROOT_DIR = '../..'
+os.chdir(ROOT_DIR)
+sys.path.insert(0, os.getcwd())
+# -------------------------------------------------------
+
+from src.main.listen_and_recognize import listen_recognize_and_respond, listen_concurrently
+from src.main.latency import LatencyTracker, STAGES, PERCENTILES
+from src.model.save_load import load_model
+from src.audio.sources import FileSource, synthetic_recording
+from src.utils.save_load import save_file
+from collections import Counter
+import json
+import numpy as np
+import subprocess
+import time
+
+# Benchmarks for listening and recognizing together. These need no microphone:
+# recordings are replayed through the listener as fast as they can be processed.
+
+SAMPLERATE = 44100
+STARTUP_BASEPATH = 'output/startup/'
+
+# How each kind of saved model is imported and loaded to run it. The start-up
+# benchmark runs these in a fresh interpreter, as a play session would.
+STARTUP_ENTRY_POINTS = {
+    'numpy': ('from src.model.numpy_runtime import load_numpy_model', "load_numpy_model('{}')"),
+    'torch': ('from src.model.save_load import load_model', "load_model('{}')"),
+}
+
+
+def benchmark_offline_throughput(model, duration=600, noise_every=0.25, source=None):
+    """ Run a recording (default: duration sec of synthetic noises) through
+    listen_recognize_and_respond, and report how much faster than real time it runs. """
+
+    source = source or FileSource(synthetic_recording(duration, SAMPLERATE, noise_every),
+                                  SAMPLERATE)
+    predictions = Counter()
+
+    start = time.perf_counter()
+    listen_recognize_and_respond(model, lambda pred: predictions.update([pred]),
+                                 device=None, duration=None, source=source)
+    wall = time.perf_counter() - start
+
+    num_noises = sum(predictions.values())
+    print('{:.0f} sec of audio in {:.2f} sec ({:.0f}x real time), {} noises ({:.0f} per sec): {}'.format(
+        source.duration(), wall, source.duration() / wall,
+        num_noises, num_noises / wall, dict(predictions)))
+
+
+def benchmark_latency(model, duration=20, noise_every=0.25):
+    """ Replay duration (sec) of synthetic noises at real-time pace, and report
+    the latency of each stage from capture to response. """
+
+    source = FileSource(synthetic_recording(duration, SAMPLERATE, noise_every),
+                        SAMPLERATE, realtime=True)
+    tracker = LatencyTracker()
+    listen_recognize_and_respond(model, lambda pred: None, device=None, duration=None,
+                                 source=source, latency_tracker=tracker)
+    tracker.report(recent=False)
+    return tracker
+
+
+def benchmark_dispatch(model, response_sec=0.1, duration=20, noise_every=0.08):
+    """ Replay duration (sec) of synthetic noises at real-time pace, with a response
+    that takes response_sec (like pyautogui's pause after a key press), and compare
+    how long recognition takes from capture when responding inline versus through a
+    ResponseDispatcher. """
+
+    def slow_response(pred):
+        time.sleep(response_sec)
+
+    for dispatch in [None, True]:
+        source = FileSource(synthetic_recording(duration, SAMPLERATE, noise_every),
+                            SAMPLERATE, realtime=True)
+        tracker = LatencyTracker()
+        listen_recognize_and_respond(model, slow_response, device=None, duration=None,
+                                     source=source, latency_tracker=tracker, dispatch=dispatch)
+        latencies = np.array([l for _, l in tracker.all])
+        to_model = np.percentile(latencies[:, STAGES.index('model')], PERCENTILES)
+        print('{}: {} noises, capture to recognition (ms): '.format(
+            'dispatched' if dispatch else 'inline', len(latencies))
+            + ', '.join('p{} {:.1f}'.format(p, v) for p, v in zip(PERCENTILES, to_model)))
+
+
+def benchmark_early_exit(model, early_exits=(None, 0.99, 0.9), duration=20, noise_every=0.25):
+    """ Replay duration (sec) of synthetic noises at real-time pace, and compare the
+    latency from capture to response, and the predictions, with streaming recognition
+    at each early_exit confidence (None recognizes full noises only). """
+    audio = synthetic_recording(duration, SAMPLERATE, noise_every)
+    baseline = None
+    for early_exit in early_exits:
+        tracker = LatencyTracker()
+        listen_recognize_and_respond(model, lambda pred: None, device=None, duration=None,
+                                     source=FileSource(audio, SAMPLERATE, realtime=True),
+                                     latency_tracker=tracker, early_exit=early_exit)
+        labels = [label for label, _ in tracker.all]
+        latencies = np.array([l for _, l in tracker.all])[:, -1]
+        baseline = baseline or labels
+        agreement = np.mean([a == b for a, b in zip(labels, baseline)]) * 100
+        print('early_exit {}: {} noises, {:.0f}% agree with full noises, capture to response (ms): '.format(
+            early_exit, len(labels), agreement)
+            + ', '.join('p{} {:.1f}'.format(p, v) for p, v in zip(PERCENTILES, np.percentile(latencies, PERCENTILES))))
+
+
+def benchmark_sessions(model, max_sessions=2, duration=20, noise_every=0.25):
+    """ Replay duration (sec) of synthetic noises at real-time pace to 1 up to
+    max_sessions listeners at once (as if from several devices, each with its own
+    ListenerSession and model), and compare the CPU time used per second of audio,
+    and whether each listener recognized the same noises as one listening alone. """
+    audio = synthetic_recording(duration, SAMPLERATE, noise_every)
+    alone = None
+    for n_sessions in range(1, max_sessions + 1):
+        heard = [Counter() for _ in range(n_sessions)]
+        listeners = [{'model': model, 'act_on_noise': lambda pred, c=c: c.update([pred]), 'device': None,
+                      'source': FileSource(audio, SAMPLERATE, realtime=True)} for c in heard]
+
+        cpu_start, start = time.process_time(), time.perf_counter()
+        listen_concurrently(listeners, duration=None)
+        cpu, elapsed = time.process_time() - cpu_start, time.perf_counter() - start
+
+        alone = alone or heard[0]
+        print('{} sessions: CPU {:.1f} ms per sec of audio ({:.1f}% of a core), '
+              'same noises as alone: {}'.format(
+                  n_sessions, 1000 * cpu / duration, 100 * cpu / elapsed,
+                  all(counter == alone for counter in heard)))
+
+
+def benchmark_batching(model, budgets=(None, 0, 0.001, 0.002, 0.005), n_listeners=4,
+                       duration=20, noise_every=0.05):
+    """ Replay duration (sec) of dense synthetic noises to n_listeners at once, as fast
+    as they can be processed, recognizing their noises one at a time (budget None) or
+    in batches through an InferenceScheduler with each budget (sec). Compare the noises
+    recognized per second, and check that the predictions are the same. """
+    audio = synthetic_recording(duration, SAMPLERATE, noise_every)
+    one_at_a_time = None
+    for budget in budgets:
+        heard = [Counter() for _ in range(n_listeners)]
+        listeners = [{'model': model, 'act_on_noise': lambda pred, c=c: c.update([pred]), 'device': None,
+                      'source': FileSource(audio, SAMPLERATE)} for c in heard]
+
+        start = time.perf_counter()
+        listen_concurrently(listeners, duration=None, batch_budget=budget)
+        elapsed = time.perf_counter() - start
+
+        one_at_a_time = one_at_a_time or heard[0]
+        noises = sum(sum(counter.values()) for counter in heard)
+        print('{}: {} noises in {:.2f} sec, {:.0f} noises/sec, same predictions: {}'.format(
+            'one at a time' if budget is None else 'budget {:.1f} ms'.format(1000 * budget),
+            noises, elapsed, noises / elapsed, all(counter == one_at_a_time for counter in heard)))
+
+
+def startup_statement(entry_point, model_filename, listen=True):
+    """ The code to start a play session with a saved model, as for beatbot_necrodancer.py.
+    If listen is False, only the imports. Listening replays a second of quiet. """
+    import_line, load = STARTUP_ENTRY_POINTS[entry_point]
+    lines = ['from src.main.build_run_beatbot import run_beatbot', import_line]
+    if listen:
+        lines += ['from src.audio.sources import FileSource',
+                  'import numpy as np',
+                  'model = ' + load.format(model_filename),
+                  'source = FileSource(np.full({0}, 1e-4, dtype=np.float32), {0})'.format(SAMPLERATE),
+                  'run_beatbot(model, print, None, duration=None, source=source)']
+    return '\n'.join(lines)
+
+
+def import_time_breakdown(statement, top=10):
+    """ Run statement in a fresh interpreter with -X importtime, and return the total
+    import time (ms) and a dict of {package: ms} for the top packages. The time for a
+    package is that of its own modules, not counting what they import from other
+    packages. Our own code is broken down by subpackage (e.g., src.audio). """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            capture_output=True, text=True, check=True)
+    packages = Counter()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, _, name = line[len('import time:'):].split('|')
+        parts = name.strip().split('.')
+        package = '.'.join(parts[:2]) if parts[0] == 'src' and len(parts) > 1 else parts[0]
+        packages[package] += int(self_us) / 1000
+    return sum(packages.values()), dict(packages.most_common(top))
+
+
+def time_to_listening(statement):
+    """ Run statement in a fresh interpreter, and return the time (sec) from launch
+    until it prints 'Listening...' (or None if it never does). """
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-u', '-c', statement],
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    elapsed = None
+    for line in process.stdout:
+        if elapsed is None and 'Listening...' in line:
+            elapsed = time.perf_counter() - start
+    process.wait()
+    return elapsed
+
+
+def benchmark_startup(model_filename, entry_points=('numpy', 'torch'), repeats=3,
+                      save_filename=None, rewrite=False):
+    """ Report the cold start of a play session for each entry point (see
+    STARTUP_ENTRY_POINTS): the import time, broken down by package, and the time to
+    the first 'Listening...' (the best of repeats). Save the report (.json) to track
+    it across releases if save_filename is given. """
+
+    report = {}
+    for entry_point in entry_points:
+        import_ms, packages = import_time_breakdown(startup_statement(entry_point, model_filename, listen=False))
+        listening = [time_to_listening(startup_statement(entry_point, model_filename)) for _ in range(repeats)]
+        listening = min(listening) if None not in listening else None
+        report[entry_point] = {'import_ms': import_ms, 'packages_ms': packages,
+                               'time_to_listening_sec': listening}
+
+        print('\n{} model: {:.0f} ms of imports, {} to Listening...'.format(
+            entry_point, import_ms, 'failed' if listening is None else '{:.2f} sec'.format(listening)))
+        for package, ms in packages.items():
+            print('{:>24s}: {:7.1f} ms'.format(package, ms))
+
+    if save_filename:
+        def save_function_report(data, path):
+            with open(path, 'w') as f:
+                json.dump(data, f, indent=2)
+
+        save_file(data=report, filename=save_filename, rewrite=rewrite, basepath=STARTUP_BASEPATH,
+                  extension='.json', save_function=save_function_report)
+    return report
+
+
+if __name__ == "__main__":
+
+    ###################### BENCHMARKING LISTENING + RECOGNIZING ######################
+
+    my_model = load_model('necrodancer_100each_t-k-p-tsk-cluck')
+
+    # main/listen_and_recognize.py: offline throughput
+
+    benchmark_offline_throughput(my_model)
+
+    # main/latency.py: latency from capture to response, replayed in real time
+
+    benchmark_latency(my_model)
+
+    # response/dispatch.py: recognition with a slow response, inline versus dispatched
+
+    benchmark_dispatch(my_model)
+
+    # main/listen_and_recognize.py: streaming recognition, with early exit on confident partial noises
+
+    benchmark_early_exit(my_model)
+
+    # audio/listen.py: CPU use with several listener sessions (device and model pairs) at once
+
+    benchmark_sessions(my_model)
+
+    # main/scheduler.py: throughput of batched inference, against the latency budget
+
+    benchmark_batching(my_model)
+
+    # main/build_run_beatbot.py: cold start of a play session, per kind of saved model
+
+    benchmark_startup('necrodancer_100each_t-k-p-tsk-cluck')
@@ -3,31 +3,112 @@
 # * `build_beatbot` to record training audio + train the model + evaluate the model, and
 # * `run_beatbot` to continuously listen + recognize noises + act on them.
 
-from src.main.listen_and_recognize import listen_recognize_and_respond
-from src.audio.device_settings import get_samplerate
-from src.audio.record import record_model_data
-from src.model.prepare_datasets import NoisesDataset, prepare_even_data_loaders
-from src.model.define_model import Net
-from src.model.train_model import train_net
-from src.model.evaluate_model import accuracy_rating, plot_confusion_matrix
-from src.audio.save_load import save_noise_samples
-from src.model.save_load import save_model
-
-
-def run_beatbot(model, act_on_noise, device, duration):
+# Running a saved model needs only the listener, so the recording, training, and
+# evaluation modules (with torch, sklearn, and matplotlib) are imported by
+# build_beatbot when it's called, not here. This keeps the start-up of a play
+# session short (see benchmark_startup in src/main/benchmarks.py).
+
+from src.main.listen_and_recognize import listen_recognize_and_respond, recognition_threads
+import os
+import time
+
+
+def run_beatbot(model, act_on_noise, device, duration,
+                latency_tracker=None, save_latency_filename=None, source=None, dispatch=None,
+                early_exit=None, capture_process=False):
+    """ Listen for duration (sec), recognizing noises with the model and responding
+    with act_on_noise. To measure the latency of each noise, pass a LatencyTracker
+    (see src/main/latency.py): a summary is printed at the end, and the latencies
+    are saved if save_latency_filename is given. Audio comes from the input device,
+    or from source if given (see src/audio/sources.py). If dispatch is True (or a
+    dict of options, see src/response/dispatch.py), act_on_noise runs on a worker
+    thread, so a slow response (e.g., a key press) doesn't delay recognition. If
+    early_exit is given (a confidence), respond to a noise as soon as its start is
+    recognized that confidently (see src/main/listen_and_recognize.py). If
+    capture_process is True, audio is captured in a separate process (see
+    src/audio/capture_process.py). """
     noises = ', '.join(list(model.noise_int_to_str.values()))
     print(f'This model recognizes the noises: {noises}')
     
-    listen_recognize_and_respond(model, act_on_noise, device, duration)
+    with recognition_threads([model]):
+        listen_recognize_and_respond(model, act_on_noise, device, duration,
+                                     source=source, latency_tracker=latency_tracker,
+                                     dispatch=dispatch, early_exit=early_exit,
+                                     capture_process=capture_process)
+
+    if latency_tracker:
+        latency_tracker.report(recent=False)
+        if save_latency_filename:
+            latency_tracker.export(save_latency_filename)
 
 def build_beatbot(device, starting_noise_data={},
                   skip_recording=False,
                   batch_size=8, epochs=10, batch_progress=100,
                   skip_testing_model=False,
                   save_recordings_filename=None, rewrite_recordings_file=False,
-                  save_model_filename=None,      rewrite_model_file=False):
+                  save_model_filename=None,      rewrite_model_file=False,
+                  save_quantized=False, tensor_resident=False,
+                  warm_start_model=None, known_noise_counts=None, replay_fraction=None,
+                  known_test_indices=None, patience=None, validation_fraction=None, lr_schedule=None):
     """ Record audio data, train a model, evaluate it, and optionally save the results.
-    If skip_testing_model is True, use all data for training and skip the model testing."""
+    If skip_testing_model is True, use all data for training and skip the model testing.
+    If save_quantized is True, also save an int8 variant of the model alongside it
+    (see save_quantized_model), to load for lower CPU use during play.
+    If tensor_resident is True, train from the dataset held as one tensor pair
+    (see TensorLoader), which is faster than a DataLoader for small datasets.
+    If warm_start_model is given (a trained Net, or the filename to load it from),
+    fine-tune it rather than training a new model: on the new recordings, plus
+    replay_fraction of the old ones (see src/model/incremental.py). The model's
+    fc2 layer is widened for any new labels. known_noise_counts is the number of
+    samples of each label it was trained on, and defaults to the number in
+    starting_noise_data before recording. It is tested only on recordings it has
+    never seen: some of the new ones, and the old ones at known_test_indices (among
+    the samples it was trained from, e.g., the test indices of their split), if given.
+    If patience is given, hold out validation_fraction of the training data, and
+    stop training once the validation loss hasn't improved for patience epochs
+    (epochs is then the most to run), keeping the best epoch's model. lr_schedule
+    is a learning-rate schedule for training (see src/model/train_model.py): 'plateau'
+    needs patience, and is replaced by 'cosine' if there are too few recordings to
+    hold out validation data."""
+    from src.audio.device_settings import get_samplerate
+    from src.audio.record import record_model_data
+    from src.audio.listen import get_noise_length
+    from src.audio.make_spectrograms import generate_spectrogram
+    from src.model.prepare_datasets import (NoisesDataset, VALIDATION_FRACTION, dataset_labels,
+                                            stratified_split, validation_split, prepare_data_loaders,
+                                            prepare_validation_loader)
+    from src.model.define_model import Net
+    from src.model.train_model import LR_SCHEDULES, train_net, print_training_curve
+    from src.model.evaluate_model import accuracy_rating, plot_confusion_matrix
+    from src.audio.save_load import save_noise_samples
+    from src.model.save_load import save_model, save_quantized_model, load_model
+    from src.model.incremental import (REPLAY_FRACTION, widen_model, new_sample_mask, held_out_mask,
+                                       incremental_split)
+    import numpy as np
+
+    # Check the training options before recording, so bad ones don't lose the recordings
+    if lr_schedule is not None and lr_schedule not in LR_SCHEDULES:
+        raise ValueError('Unknown learning-rate schedule "{}". Options: {}'.format(lr_schedule, LR_SCHEDULES))
+    if lr_schedule == 'plateau' and patience is None:
+        raise ValueError('The "plateau" learning-rate schedule needs patience (and validation data).')
+
+    samplerate = get_samplerate(device)
+
+    if isinstance(warm_start_model, str):
+        warm_start_model = load_model(warm_start_model)
+    if known_noise_counts is None:
+        known_noise_counts = {label: len(samples) for label, samples in starting_noise_data.items()}
+
+    # Check that the model takes spectrograms of the recordings, before recording more
+    if warm_start_model:
+        lengths = {len(sample) for samples in starting_noise_data.values() for sample in samples}
+        if not skip_recording:
+            lengths.add(get_noise_length(samplerate))
+        for length in sorted(lengths):
+            image_size = (1,) + tuple(generate_spectrogram(np.zeros(length, dtype=np.float32), samplerate).size())
+            if tuple(warm_start_model.image_size) != image_size:
+                raise ValueError('The spectrograms of the recordings are {}, but the model takes {}.'.format(
+                    image_size, tuple(warm_start_model.image_size)))
 
     # Record training data and construct the dataset
     if skip_recording:
@@ -37,40 +118,90 @@ def build_beatbot(device, starting_noise_data={},
             device=device, starting_noise_data=starting_noise_data)
     
     print('Building model from recordings ...')
+    build_start = time.perf_counter()
 
-    samplerate = get_samplerate(device)
-
-    dataset = NoisesDataset(noise_data_dict, samplerate)
+    dataset = NoisesDataset(noise_data_dict, samplerate,
+                            noise_int_to_str=warm_start_model.noise_int_to_str if warm_start_model else None)
 
     # Prepare the dataloader. Use all data as training data if skip_testing_model is True.
     if skip_testing_model:
         training_fraction = 1
     else:
         training_fraction = 0.8
-    train_loader, test_loader, _, _ = prepare_even_data_loaders(dataset, samplerate, batch_size=batch_size,
-                                                                training_fraction=training_fraction)
+    labels = dataset_labels(dataset)
+    if warm_start_model:
+        is_new = new_sample_mask(noise_data_dict, known_noise_counts, warm_start_model.noise_int_to_str.values())
+        print('Fine-tuning on {} new recordings ...'.format(is_new.sum()))
+        held_out = None
+        if known_test_indices is not None and not skip_testing_model:
+            held_out = held_out_mask(is_new, known_test_indices)
+        elif not skip_testing_model:
+            print('Testing on new recordings only: the old ones may have been trained on.')
+        train_indices, test_indices = incremental_split(
+            labels, is_new, training_fraction,
+            REPLAY_FRACTION if replay_fraction is None else replay_fraction, held_out=held_out)
+    else:
+        train_indices, test_indices = stratified_split(labels, training_fraction)
 
-    # Build and train the neural net
-    image_size = dataset[0][0].size()
-    model = Net(image_size, dataset.noise_int_to_str)
-    train_net(model, epochs, train_loader, batch_progress=batch_progress)
+    # Hold out validation data for early stopping
+    val_loader = None
+    if patience is not None:
+        train_indices, val_indices = validation_split(
+            labels, train_indices, VALIDATION_FRACTION if validation_fraction is None else validation_fraction)
+        if len(val_indices):
+            val_loader = prepare_validation_loader(dataset, val_indices, tensor_resident=tensor_resident)
+        else:
+            print('Warning: too few recordings to hold out validation data. Training for {} epochs '
+                  'without early stopping.'.format(epochs))
+            if lr_schedule == 'plateau':
+                print('Using the "cosine" learning-rate schedule instead of "plateau".')
+                lr_schedule = 'cosine'
+
+    train_loader, test_loader, _, _ = prepare_data_loaders(dataset, train_indices, test_indices,
+                                                           batch_size=batch_size,
+                                                           tensor_resident=tensor_resident)
+
+    # Build (or widen) and train the neural net
+    if warm_start_model:
+        model = widen_model(warm_start_model, dataset.noise_int_to_str)
+    else:
+        model = Net(dataset[0][0].size(), dataset.noise_int_to_str)
+    history = train_net(model, epochs, train_loader, batch_progress=batch_progress,
+                        val_loader=val_loader, patience=patience, lr_schedule=lr_schedule)
+    print('Model built in {:.2f} sec'.format(time.perf_counter() - build_start))
+    if val_loader is not None:
+        print_training_curve(history)
 
     # Evaluate the model and show the confusion matrix, or skip testing altogether.
-    if not skip_testing_model:
+    if not skip_testing_model and not len(test_indices):
+        print('No recordings left to test the model on.')
+    elif not skip_testing_model:
         preds, targets = accuracy_rating(model, test_loader, 'test')
         plot_confusion_matrix(preds, targets, dataset.noise_int_to_str)
 
     # Offer to save the recordings and model
     print('\nWould you like to save your audio data?')
     save_noise_samples(
-        noise_data_dict, filename=save_recordings_filename, rewrite=rewrite_recordings_file)
+        noise_data_dict, filename=save_recordings_filename, rewrite=rewrite_recordings_file,
+        samplerate=samplerate)
     print('\nWould you like to save your model?')
-    save_model(model, filename=save_model_filename, rewrite=rewrite_model_file)
+    saved_paths = save_model(model, filename=save_model_filename, rewrite=rewrite_model_file)
+    if save_quantized and saved_paths:
+        save_quantized_model(model, filename=os.path.basename(saved_paths[0]),
+                             rewrite=rewrite_model_file,
+                             calibration_loader=train_loader,
+                             test_loader=None if skip_testing_model or not len(test_indices) else test_loader)
 
     return model, noise_data_dict
 
 
 # # TESTING
 # my_model, my_recordings = build_beatbot(device=0, starting_noise_data=my_recordings)
+# # TESTING: add recordings (or noises) to a saved model
+# my_model, my_recordings = build_beatbot(device=0, starting_noise_data=my_recordings,
+#                                         warm_start_model='necrodancer_100each_t-k-p-tsk-cluck')
+# # TESTING: train until the validation loss stops improving
+# my_model, my_recordings = build_beatbot(device=0, starting_noise_data=my_recordings, skip_recording=True,
+#                                         epochs=50, patience=3, lr_schedule='plateau')
 # # TESTING
 # listen_recognize_and_respond(my_model, print_noise, device=0, duration=20)
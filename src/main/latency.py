@@ -0,0 +1,89 @@
+# Latency instrumentation: how long from making a noise to the response?
+
+# Each recognized noise is timestamped (on the time.perf_counter() clock) at each
+# stage of the pipeline. The full chain, from the audio being captured to the
+# response returning, is what matters for rhythm games.
+
+from src.utils.save_load import save_file
+from collections import deque
+import numpy as np
+
+# the stages timestamped for each noise, in order:
+STAGES = ['adc',          # the audio block with the onset was captured (ADC time from the stream)
+          'onset',        # the callback detected the onset
+          'window',       # all the audio for the noise was collected
+          'spectrogram',  # the spectrogram was computed
+          'model',        # the model's forward pass finished
+          'response']     # act_on_noise returned
+PERCENTILES = [50, 95, 99]
+
+LATENCY_BASEPATH = 'output/latency/'
+
+
+class LatencyTracker:
+    """ Collects the stage timestamps of each noise, and summarizes the latencies
+    over the most recent `window` noises (or all of them). If report_every is
+    set, prints a summary every report_every noises. """
+
+    def __init__(self, window=500, report_every=None):
+        self.recent = deque(maxlen=window)
+        self.all = []
+        self.report_every = report_every
+
+    def record(self, times, label=None):
+        """ Record the timestamps (a dict of stage: time) of one noise. """
+        # latencies in ms, from capture to each stage
+        latencies = np.array([times[stage] - times['adc'] for stage in STAGES]) * 1000
+        self.recent.append(latencies)
+        self.all.append((label, latencies))
+
+        if self.report_every and len(self.all) % self.report_every == 0:
+            self.report()
+
+    def percentiles(self, recent=True):
+        """ Return a dict of {stage: [p50, p95, p99]} in ms, for the time taken by each
+        stage (since the previous one), and for the total from capture to response. """
+        latencies = np.array(self.recent if recent else [l for _, l in self.all])
+        if len(latencies) == 0:
+            return {}
+
+        stage_times = np.diff(latencies, axis=1)
+        summary = {stage: np.percentile(stage_times[:, i], PERCENTILES)
+                   for i, stage in enumerate(STAGES[1:])}
+        summary['total'] = np.percentile(latencies[:, -1], PERCENTILES)
+        return summary
+
+    def histogram(self, bins=20, recent=True):
+        """ Return a histogram (counts, bin edges in ms) of the total latency. """
+        latencies = np.array(self.recent if recent else [l for _, l in self.all])
+        return np.histogram(latencies[:, -1] if len(latencies) else [], bins=bins)
+
+    def report(self, recent=True):
+        """ Print the latency percentiles of each stage. """
+        summary = self.percentiles(recent)
+        if not summary:
+            print('No latencies recorded.')
+            return
+        count = len(self.recent) if recent else len(self.all)
+        print('\nLatency (ms) over the last {} noises:'.format(count))
+        print('{:>12s} '.format('') + ' '.join('{:>7s}'.format('p{}'.format(p)) for p in PERCENTILES))
+        for stage, values in summary.items():
+            print('{:>12s} '.format(stage) + ' '.join('{:7.2f}'.format(v) for v in values))
+
+    def export(self, filename=None, rewrite=False, basepath=LATENCY_BASEPATH):
+        """ Save every noise's latencies (ms since capture, per stage) to a .csv file. """
+
+        def save_function(data, path):
+            with open(path, 'w') as f:
+                f.write(','.join(['label'] + STAGES) + '\n')
+                for label, latencies in data:
+                    f.write(','.join([str(label)] + ['{:.3f}'.format(l) for l in latencies]) + '\n')
+
+        return save_file(data=self.all, filename=filename, rewrite=rewrite,
+                         basepath=basepath, extension='.csv', save_function=save_function)
+
+
+# # TESTING
+# my_tracker = LatencyTracker(report_every=20)
+# run_beatbot(my_model, print_noise, device=0, duration=30, latency_tracker=my_tracker)
+# my_tracker.export('my_latencies')
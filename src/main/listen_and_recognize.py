@@ -2,10 +2,27 @@
 # With the trained model in hand, make a listener to recognize noises and act on them.
 
 
-from src.audio.device_settings import get_samplerate
-from src.audio.make_spectrograms import N_MELS, generate_spectrogram
-from src.audio.listen import listen_and_process, time_elapsed
-import torch
+from src.audio.listen import listen, listen_and_process, time_elapsed, get_noise_length, ListenerSession
+from src.audio.sources import DeviceSource
+from src.audio.capture_process import SharedMemorySource
+from src.response.dispatch import ResponseDispatcher
+from src.main.scheduler import InferenceScheduler
+import contextlib
+import numpy as np
+import threading
+import time
+
+# This module doesn't import torch itself, so that a model for the NumPy runtime
+# (a NumpyModel, see src/model/numpy_runtime.py) can be run without it. The torch
+# front end and InferenceModel are only imported for a torch model.
+
+# In streaming mode (early_exit), each noise is also recognized from its first
+# EARLY_EXIT_FRACTIONS of audio, padded with silence to the full length. If the
+# model is confident enough in one of those predictions, it responds without
+# waiting for the rest of the noise. Otherwise it falls back to the full noise.
+# (Padding with quiet noise rather than zeros keeps the log spectrogram finite.)
+EARLY_EXIT_FRACTIONS = (1/3, 2/3)
+PAD_LEVEL = 1e-3   # level of the quiet noise that pads partial noises, relative to their RMS
 
 # Note this supposes that the samplerate and n_mels for get_prediction are the
 # same as those used for the training dataset. This could be made more robust by
@@ -13,35 +30,284 @@ import torch
 # array, and by recording the n_mels used in the dataset the model was trained
 # on.
 
-def get_prediction(model, noise_sample, device, n_mels=N_MELS):
-    """ Build the spectrogram and use our model to recognize the noise """
+def get_prediction(model, noise_sample, front_end, times=None, return_confidence=False):
+    """ Build the spectrogram with the front_end (see get_front_end) and use our
+    model to recognize the noise. If given a dict of times, add the times each
+    step finished (see src/main/latency.py). If return_confidence is True, also
+    return the model's confidence in the prediction (its softmax probability). """
 
-    samplerate = get_samplerate(device)
-    mel = generate_spectrogram(noise_sample, samplerate, n_mels)
+    mel = front_end(noise_sample)
+    if times is not None:
+        times['spectrogram'] = time.perf_counter()
 
-    # change from torch.Size([A, B]) to torch.Size([1, 1, A, B])
+    # change from size [A, B] to size [1, 1, A, B]
     mel = mel[None, None, :, :]
 
-    # run through the model and get prediction
+    # run through the model and get prediction (output is a tensor or numpy.array)
     output = model(mel)
-    energy, label = torch.max(output.data, 1)
+    label = int(output.argmax(1)[0])
+    if times is not None:
+        times['model'] = time.perf_counter()
 
     # return the string label of the noise
-    return model.noise_int_to_str[label.item()]
+    if return_confidence:
+        output = np.asarray(output[0], dtype=np.float64)
+        probabilities = np.exp(output - output.max())
+        return model.noise_int_to_str[label], probabilities[label] / probabilities.sum()
+    return model.noise_int_to_str[label]
+
+
+def prepare_model(model):
+    """ Return the model ready for recognition: an InferenceModel for a trained Net,
+    or the model itself if it's already an InferenceModel or a NumpyModel """
+    if hasattr(model, 'front_end'):
+        return model
+    from src.model.inference import prepare_for_inference
+    return prepare_for_inference(model)
+
+
+def recognition_threads(models):
+    """ A context manager that pins torch's thread count while recognizing with the
+    models (see inference_threads), unless none of them runs on torch """
+    if all(hasattr(model, 'front_end') for model in models):
+        return contextlib.nullcontext()
+    from src.model.inference import inference_threads
+    return inference_threads()
+
+
+def prepare_recognition(model, samplerate, n_mels=None):
+    """ Return the model ready for recognition, and the front end for its spectrograms,
+    both warmed up. The model is a trained Net (or InferenceModel), or a NumpyModel,
+    which brings its own front end. n_mels defaults to N_MELS for a Net. """
+    model = prepare_model(model)
+    if hasattr(model, 'front_end'):
+        front_end = model.front_end
+        if front_end.samplerate != samplerate:
+            print('Warning: the model expects a sample rate of {}, but the input is {}.'.format(
+                front_end.samplerate, samplerate))
+    else:
+        from src.audio.make_spectrograms import N_MELS, get_front_end
+        front_end = get_front_end(samplerate, n_mels or N_MELS)
+    front_end(np.ones(get_noise_length(samplerate), dtype=np.float32))
+    return model, front_end
+
+
+def get_partial_lengths(samplerate, fractions=EARLY_EXIT_FRACTIONS):
+    """ The lengths (in samples) of the partial noises to recognize in streaming mode """
+    return [int(fraction * get_noise_length(samplerate)) for fraction in fractions]
 
 
-def listen_recognize_and_respond(model, act_on_noise, device, duration=5):
+def get_padding(samplerate):
+    """ A buffer for padded noises, and the unit noise to pad them with (see pad_noise) """
+    noise_length = get_noise_length(samplerate)
+    floor = np.random.default_rng(0).standard_normal(noise_length).astype(np.float32)
+    return np.zeros(noise_length, dtype=np.float32), floor
+
+
+def pad_noise(noise_sample, padded, floor):
+    """ Copy a (partial) noise_sample into padded, and fill the rest with the floor
+    noise at PAD_LEVEL of its RMS, as near silence """
+    n = len(noise_sample)
+    padded[:n] = noise_sample
+    level = PAD_LEVEL * np.sqrt(np.mean(np.square(noise_sample))) + np.finfo(np.float32).tiny
+    np.multiply(floor[n:], level, out=padded[n:])
+    return padded
+
+
+def listen_recognize_and_respond(model, act_on_noise, device, duration=5, n_mels=None,
+                                 source=None, latency_tracker=None, dispatch=None,
+                                 early_exit=None, capture_process=False, session=None,
+                                 scheduler=None):
     """ Continuously listen for noises for duration (sec), then recognize them
-    with the model and respond with the function act_on_noise. """
+    with the model and respond with the function act_on_noise. Audio comes from
+    the input device, or from source if given (e.g., a FileSource to replay a
+    recording). A duration of None listens until the source runs out.
+    If given a LatencyTracker, the latency of each noise is recorded to it.
+    The model is a trained Net (or InferenceModel), or a NumpyModel, which brings
+    its own front end for spectrograms. n_mels defaults to N_MELS for a Net.
+    If dispatch is True (or a dict of options for ResponseDispatcher), act_on_noise
+    runs on a worker thread, so a slow response doesn't delay recognizing the next
+    noise. Its stats are printed at the end, and returned.
+    If early_exit is given (a confidence, between 0 and 1), recognize in streaming
+    mode: respond to a noise as soon as a partial noise is recognized with at
+    least that confidence (see EARLY_EXIT_FRACTIONS).
+    If capture_process is True, audio is captured in a separate process, so
+    recognition can't hold up the stream (see src/audio/capture_process.py).
+    The listener's state is kept in session (a ListenerSession, default: listen):
+    see listen_concurrently to run several listeners at once. If given a running
+    InferenceScheduler, noises are recognized in batches (with those of other
+    listeners sharing it) by its model, on its worker thread, which then responds.
+    Partial noises are still recognized as they come. """
 
-    def processing_function(noise_sample):
-        pred = get_prediction(model, noise_sample, device)
+    # look up the sample rate and set up the spectrograms and model once, not per
+    # noise, and warm them up so the first noise isn't slower than the rest
+    source = source or DeviceSource(device)
+    session = session or listen
+    if capture_process:
+        source = SharedMemorySource(source)
+    if scheduler:
+        model = scheduler.model
+    model, front_end = prepare_recognition(model, source.samplerate, n_mels)
+    noise_length = get_noise_length(source.samplerate)
+    partial_lengths = get_partial_lengths(source.samplerate) if early_exit else []
+    padded, floor = get_padding(source.samplerate)
+    early_exits = []   # the audio (sec) not waited for, for each noise recognized early
+
+    def record_latency(pred, times):
+        latency_tracker.record(times, pred)
+
+    dispatcher = None
+    if dispatch:
+        options = {} if dispatch is True else dispatch
+        dispatcher = ResponseDispatcher(act_on_noise, on_response=record_latency if latency_tracker else None,
+                                        **options)
+
+    def respond(pred, times):
+        if dispatcher:
+            dispatcher(pred, times)  # responds on the worker thread
+            return
         act_on_noise(pred)
+        if latency_tracker:
+            times['response'] = time.perf_counter()
+            record_latency(pred, times)
+
+    def processing_function(noise_sample):
+        times = session.current_times if latency_tracker else None
+
+        # a partial noise: respond only if the model is confident enough
+        if len(noise_sample) < noise_length:
+            pred, confidence = get_prediction(model, pad_noise(noise_sample, padded, floor), front_end,
+                                              times, return_confidence=True)
+            if confidence < early_exit:
+                return False
+            early_exits.append((noise_length - len(noise_sample)) / source.samplerate)
+        elif scheduler:
+            mel = front_end(noise_sample)
+            if times is not None:
+                times['spectrogram'] = time.perf_counter()
+            scheduler.submit(mel, respond, times)  # responds on the scheduler's thread
+            return True
+        else:
+            pred = get_prediction(model, noise_sample, front_end, times)
+
+        respond(pred, times)
+        return True
+
+    with dispatcher or contextlib.nullcontext():
+        listen_and_process(processing_function=processing_function,
+                           stop_condition=time_elapsed(duration, session),
+                           device=device,
+                           print_after_processing=None,
+                           source=source,
+                           partial_lengths=partial_lengths,
+                           session=session)
+        if scheduler:
+            scheduler.drain()
+
+    if early_exit:
+        print('\nRecognized {} noises early, {:.1f} ms sooner on average.'.format(
+            len(early_exits), 1000 * np.mean(early_exits) if early_exits else 0))
+    if dispatcher:
+        dispatcher.report()
+        return dispatcher.stats()
+
+
+def listen_concurrently(listeners, duration=5, batch_budget=None):
+    """ Run several listeners at once in this process, e.g., one per input device,
+    each with its own model and response. Each listener is a dict of the arguments
+    for listen_recognize_and_respond (model, act_on_noise, device, and any options),
+    and gets its own ListenerSession unless one is given (e.g., with its own
+    thresholds). If batch_budget (sec) is given, listeners with the same model
+    share an InferenceScheduler with that budget, so noises that are ready at about
+    the same time are recognized in one batch. Returns what each listener returned,
+    in order. """
+    results = [None] * len(listeners)
+
+    # one scheduler per model
+    schedulers = {}
+    if batch_budget is not None:
+        for kwargs in listeners:
+            if id(kwargs['model']) not in schedulers:
+                schedulers[id(kwargs['model'])] = InferenceScheduler(prepare_model(kwargs['model']),
+                                                                     budget=batch_budget)
+
+    def run(i, kwargs):
+        kwargs = {'duration': duration, 'session': ListenerSession(),
+                  'scheduler': schedulers.get(id(kwargs['model'])), **kwargs}
+        results[i] = listen_recognize_and_respond(**kwargs)
+
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(recognition_threads([kwargs['model'] for kwargs in listeners]))
+        for scheduler in schedulers.values():
+            stack.enter_context(scheduler)
+        threads = [threading.Thread(target=run, args=(i, kwargs)) for i, kwargs in enumerate(listeners)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    for scheduler in schedulers.values():
+        scheduler.report()
+    return results
+
+
+def evaluate_early_exit(model, noise_data_dict, samplerate, early_exit, fractions=EARLY_EXIT_FRACTIONS,
+                        n_mels=None):
+    """ Like accuracy_rating, for streaming mode: recognize each noise sample in a dict of
+    {label: [noise samples]} as the listener would with early_exit (a confidence), and
+    print the accuracy per label with and without streaming, how often each label is
+    recognized early, and the audio (ms) not waited for. Returns the results as a dict. """
+
+    model, front_end = prepare_recognition(model, samplerate, n_mels)
+    noise_length = get_noise_length(samplerate)
+    partial_lengths = get_partial_lengths(samplerate, fractions)
+    padded, floor = get_padding(samplerate)
+
+    results = {}
+    for label, noise_samples in noise_data_dict.items():
+        full_correct, streaming_correct, saved = 0, 0, []
+        for noise_sample in noise_samples:
+            noise_sample = np.asarray(noise_sample, dtype=np.float32)[:noise_length]
+            full_pred = get_prediction(model, noise_sample, front_end)
+            full_correct += full_pred == label
+
+            pred = full_pred
+            for length in partial_lengths:
+                partial_pred, confidence = get_prediction(model, pad_noise(noise_sample[:length], padded, floor),
+                                                          front_end, return_confidence=True)
+                if confidence >= early_exit:
+                    pred = partial_pred
+                    saved.append(1000 * (noise_length - length) / samplerate)
+                    break
+            streaming_correct += pred == label
+
+        total = len(noise_samples)
+        results[label] = {'noises': total,
+                          'accuracy': 100 * full_correct / total if total else 0,
+                          'streaming_accuracy': 100 * streaming_correct / total if total else 0,
+                          'early': 100 * len(saved) / total if total else 0,
+                          'saved_ms': float(np.sum(saved) / total) if total else 0}
+
+    print('Streaming recognition, with a confidence of at least {:.2f} to respond early:'.format(early_exit))
+    print('{:>10s} {:>7s} {:>9s} {:>10s} {:>7s} {:>9s}'.format(
+        'label', 'noises', 'accuracy', 'streaming', 'early', 'saved ms'))
+    for label, result in results.items():
+        print('{:>10s} {:7d} {:8.0f}% {:9.0f}% {:6.0f}% {:9.1f}'.format(
+            label, result['noises'], result['accuracy'], result['streaming_accuracy'],
+            result['early'], result['saved_ms']))
+    return results
 
-    listen_and_process(processing_function=processing_function,
-                       stop_condition=time_elapsed(duration),
-                       device=device,
-                       print_after_processing=None)
 
 # # TESTING
 # listen_recognize_and_respond(my_net, print_noise, device=2, duration=20)
+# listen_recognize_and_respond(my_net, press_key, device=2, duration=20,
+#                              dispatch={'order': 'lifo', 'coalesce': True})
+# # TESTING
+# evaluate_early_exit(my_net, my_recordings, samplerate=44100, early_exit=0.95)
+# listen_recognize_and_respond(my_net, print_noise, device=2, duration=20, early_exit=0.95)
+# # TESTING
+# listen_concurrently([{'model': my_net, 'act_on_noise': press_key, 'device': 2},
+#                      {'model': my_other_net, 'act_on_noise': print_noise, 'device': 3,
+#                       'session': ListenerSession(threshold_absolute=0.01)}], duration=20)
+# listen_concurrently([{'model': my_net, 'act_on_noise': press_key, 'device': device}
+#                      for device in [2, 3]], duration=20, batch_budget=0.002)
@@ -0,0 +1,165 @@
+# Recognize the noises of several listeners together, in batches.
+
+# With several listeners (see listen_concurrently), or noises in quick
+# succession, more than one noise can be ready for the model at once. Running
+# them one [1, 1, A, B] spectrogram at a time repeats the per-call overhead of
+# the model for each. An InferenceScheduler gathers the spectrograms submitted
+# within a small latency budget of each other, stacks them into one batch, runs
+# a single forward pass, and hands each label back to the listener that
+# submitted it, on the scheduler's worker thread.
+
+from collections import deque
+import numpy as np
+import threading
+import time
+
+BATCH_BUDGET = 0.002   # sec to wait after the first spectrogram for more to batch with it
+MAX_BATCH = 16         # spectrograms per forward pass
+
+
+def stack_spectrograms(mels):
+    """ Stack [A, B] spectrograms (numpy.arrays or tensors) into a [N, 1, A, B] batch """
+    if isinstance(mels[0], np.ndarray):
+        return np.stack(mels)[:, None]
+    import torch
+    return torch.stack(mels).unsqueeze(1)
+
+
+class InferenceScheduler:
+    """ Runs the model on batches of the spectrograms submitted to it, on a worker
+    thread. The model must be ready for recognition, and take batches: a NumpyModel
+    or an InferenceModel (see prepare_model). A batch is run once budget (sec) has
+    passed since its first spectrogram was submitted, or once it has max_batch.
+    Use it as a context manager, or call start() and stop(). """
+
+    def __init__(self, model, budget=BATCH_BUDGET, max_batch=MAX_BATCH):
+        self.model = model
+        self.budget = budget
+        self.max_batch = max_batch
+
+        self.pending = deque()     # (spectrogram, on_prediction, times, time submitted)
+        self.condition = threading.Condition()
+        self.worker = None
+        self.stopping = False
+
+        # stats
+        self.submitted = 0
+        self.completed = 0
+        self.batches = 0
+        self.predictions = 0
+        self.max_batch_seen = 0
+        self.errors = 0            # failed batches and responses
+        self.waits = []            # sec from submitted to the forward pass, per spectrogram
+        self.model_time = 0        # total sec in forward passes
+
+    def start(self):
+        self.stopping = False
+        self.worker = threading.Thread(target=self._work, daemon=True)
+        self.worker.start()
+        return self
+
+    def stop(self):
+        """ Stop the worker, after recognizing any spectrograms still waiting """
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def submit(self, mel, on_prediction, times=None):
+        """ Queue a spectrogram, shaped [A, B], and return without waiting for it. Once
+        it's recognized, on_prediction(label, times) is called on the worker thread,
+        with times['model'] set if times (see src/main/latency.py) is given. """
+        with self.condition:
+            self.pending.append((mel, on_prediction, times, time.perf_counter()))
+            self.submitted += 1
+            self.condition.notify_all()
+
+    def drain(self):
+        """ Wait until every spectrogram submitted so far has been recognized """
+        with self.condition:
+            target = self.submitted
+            self.condition.wait_for(lambda: self.completed >= target or self.worker is None)
+
+    def _work(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending or self.stopping)
+                if not self.pending:
+                    return
+
+                # wait for more spectrograms, until the budget runs out or the batch is full
+                deadline = self.pending[0][3] + self.budget
+                while len(self.pending) < self.max_batch and not self.stopping:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                batch = [self.pending.popleft() for _ in range(min(len(self.pending), self.max_batch))]
+
+            # an error in the model or a response is reported, and the worker keeps
+            # going, so the batch is always counted as completed for drain()
+            try:
+                self._run_batch(batch)
+            except Exception as e:
+                self.errors += 1
+                print('Inference failed for a batch of {}: {!r}'.format(len(batch), e))
+            finally:
+                with self.condition:
+                    self.completed += len(batch)
+                    self.condition.notify_all()
+
+    def _run_batch(self, batch):
+        start = time.perf_counter()
+        output = self.model(stack_spectrograms([mel for mel, _, _, _ in batch]))
+        labels = output.argmax(1).tolist()
+        end = time.perf_counter()
+
+        self.batches += 1
+        self.predictions += len(batch)
+        self.max_batch_seen = max(self.max_batch_seen, len(batch))
+        self.model_time += end - start
+        self.waits.extend(start - submitted for _, _, _, submitted in batch)
+
+        for (_, on_prediction, times, _), label in zip(batch, labels):
+            if times is not None:
+                times['model'] = end
+            try:
+                on_prediction(self.model.noise_int_to_str[label], times)
+            except Exception as e:
+                self.errors += 1
+                print('Responding to "{}" failed: {!r}'.format(self.model.noise_int_to_str[label], e))
+
+    def stats(self):
+        """ Return a dict of counts, batch sizes, and waits (ms) """
+        waits = 1000 * np.array(self.waits)
+        return {'predictions': self.predictions,
+                'batches': self.batches,
+                'mean_batch': self.predictions / self.batches if self.batches else 0,
+                'max_batch': self.max_batch_seen,
+                'errors': self.errors,
+                'wait_ms': np.percentile(waits, [50, 95, 99]).tolist() if len(waits) else [],
+                'model_ms': 1000 * self.model_time / self.batches if self.batches else 0}
+
+    def report(self):
+        """ Print a summary of the stats """
+        stats = self.stats()
+        print('\nInference: {predictions} noises in {batches} batches ({mean_batch:.2f} mean, '
+              '{max_batch} max), {model_ms:.2f} ms per batch'.format(**stats))
+        if stats['errors']:
+            print('{} failed batches or responses'.format(stats['errors']))
+        if stats['wait_ms']:
+            print('Wait for a batch (ms): p50 {:.2f}, p95 {:.2f}, p99 {:.2f}'.format(*stats['wait_ms']))
+
+
+# # TESTING
+# with InferenceScheduler(prepare_model(my_net), budget=0.002) as my_scheduler:
+#     listen_recognize_and_respond(my_net, press_key, device=0, duration=20, scheduler=my_scheduler)
+# my_scheduler.report()
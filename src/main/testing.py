@@ -30,7 +30,7 @@ if __name__ == "__main__":
     # model/build_run_beatbot.py
 
     # load if we've previously made some test recordings
-    my_recordings = load_noise_samples('my_test_recordings.npy') or {}
+    my_recordings = load_noise_samples('my_test_recordings.noises') or {}
     my_model, my_recordings = build_beatbot(device,
                                             starting_noise_data=my_recordings,
                                             skip_recording=False,
@@ -0,0 +1,310 @@
+# --------- Pretend we're in the root directory ---------
+import sys
+import os
+
+ROOT_DIR = '../..'
+os.chdir(ROOT_DIR)
+sys.path.insert(0, os.getcwd())
+# -------------------------------------------------------
+
+from src.model.save_load import load_model, numpy_bundle
+from src.model.inference import InferenceModel, inference_threads
+from src.model.numpy_runtime import NumpyModel
+from src.model.prepare_datasets import (NoisesDataset, prepare_even_data_loaders, dataset_labels,
+                                       stratified_split, validation_split, prepare_data_loaders,
+                                       prepare_validation_loader)
+from torch.utils.data import Subset, ConcatDataset, random_split
+from src.model.define_model import Net
+from src.model.train_model import train_net, time_to_accuracy, print_training_curve
+from src.model.incremental import widen_model, new_sample_mask, held_out_mask, incremental_split
+from src.model.sweep import configuration_grid, run_sweep, print_sweep
+from src.model.evaluate_model import accuracy_rating
+from src.audio.make_spectrograms import get_front_end
+import copy
+import numpy as np
+import time
+import torch
+
+# Benchmarks for the model code.
+
+
+def time_per_call(function, spectrograms, repeats=2000):
+    """ Return the wall-clock and CPU time (us) per call of function(spectrograms),
+    with torch's thread count pinned as for recognition. """
+    with inference_threads():
+        function(spectrograms)  # warm up
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        for _ in range(repeats):
+            function(spectrograms)
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+    return 1e6 * wall / repeats, 1e6 * cpu / repeats
+
+
+def benchmark_inference(model, repeats=2000):
+    """ Compare the per-noise cost of recognition: the model as loaded (eager,
+    with autograd), versus in eval mode without autograd, versus an InferenceModel. """
+    spectrograms = torch.randn(1, 1, *model.image_size[-2:])
+    eval_model = copy.deepcopy(model).eval()
+
+    def eval_no_grad(x):
+        with torch.no_grad():
+            return eval_model(x)
+
+    candidates = [('eager, autograd', model),
+                  ('eval, no_grad', eval_no_grad),
+                  ('InferenceModel', InferenceModel(model))]
+
+    print('Per-call cost of recognizing one [1, 1, {}, {}] spectrogram:'.format(*model.image_size[-2:]))
+    for name, function in candidates:
+        wall, cpu = time_per_call(function, spectrograms, repeats)
+        print('{:>16s}: {:6.1f} us wall, {:6.1f} us CPU'.format(name, wall, cpu))
+
+
+def benchmark_numpy_runtime(model, samplerate=44100, noise_length=2646, repeats=2000):
+    """ Compare the NumPy runtime with the torch path, for a spectrogram and one model
+    call, and check that both give the same predictions on random spectrograms. """
+    numpy_model = NumpyModel(numpy_bundle(model, samplerate))
+    inference_model = InferenceModel(model)
+    front_end = get_front_end(samplerate)
+
+    spectrograms = torch.randn(256, 1, *model.image_size[-2:])
+    agree = np.mean(inference_model.predict(spectrograms) == np.array(numpy_model.predict(spectrograms.numpy())))
+    print('NumPy runtime agrees with the torch model on {:.1f}% of predictions'.format(100 * agree))
+
+    noise_sample = np.random.rand(noise_length).astype(np.float32)
+    candidates = [('torch spectrogram', front_end, noise_sample),
+                  ('NumPy spectrogram', numpy_model.front_end, noise_sample),
+                  ('InferenceModel', inference_model, spectrograms[:1]),
+                  ('NumpyModel', numpy_model, spectrograms[:1].numpy())]
+    for name, function, data in candidates:
+        wall, cpu = time_per_call(function, data, repeats)
+        print('{:>18s}: {:6.1f} us wall, {:6.1f} us CPU'.format(name, wall, cpu))
+
+
+def synthetic_noise_data(labels=('t', 'k', 'p', 'tsk', 'cluck'), per_label=100, samplerate=44100,
+                         noise_length=2646, seed=0):
+    """ A dict of synthetic recordings, {label: [noise samples]}: each label is a
+    decaying tone at its own pitch (an octave above the previous label's), with some
+    background noise. Past 7 labels the pitches alias, which only matters for accuracy. """
+    rng = np.random.default_rng(seed)
+    t = np.arange(noise_length) / samplerate
+    noise_data_dict = {}
+    for i, label in enumerate(labels):
+        frequency = 300 * 2 ** i
+        noise_data_dict[label] = [
+            (0.5 * np.exp(-t * rng.uniform(40, 80)) * np.sin(2 * np.pi * frequency * rng.uniform(0.9, 1.1) * t)
+             + 0.02 * rng.standard_normal(noise_length)).astype(np.float32)
+            for _ in range(per_label)]
+    return noise_data_dict
+
+
+def benchmark_training(noise_data_dict, samplerate=44100, epochs=10, batch_size=8):
+    """ Train a model on noise_data_dict from DataLoaders and from TensorLoaders (the
+    tensor-resident path), and compare the time per epoch, the time from dataset to
+    trained model (making the loaders, and training), and the test accuracy """
+    dataset = NoisesDataset(noise_data_dict, samplerate, use_cache=False)
+
+    # torch initializes lazily on the first training step, so neither path should pay for it
+    warmup_loader, _, _, _ = prepare_even_data_loaders(dataset, samplerate, tensor_resident=True, seed=0)
+    train_net(Net(dataset[0][0].size(), dataset.noise_int_to_str), 1, warmup_loader, batch_progress=10**6)
+
+    for tensor_resident in [False, True]:
+        torch.manual_seed(0)
+        start = time.perf_counter()
+        train_loader, test_loader, _, _ = prepare_even_data_loaders(
+            dataset, samplerate, batch_size=batch_size, tensor_resident=tensor_resident, seed=0)
+        model = Net(dataset[0][0].size(), dataset.noise_int_to_str)
+        epoch_times = train_net(model, epochs, train_loader, batch_progress=10**6)['epoch_time']
+        to_model = time.perf_counter() - start
+
+        print('{}: {:.3f} sec per epoch (first {:.3f}), {:.2f} sec to model'.format(
+            'tensor-resident' if tensor_resident else 'DataLoader',
+            np.mean(epoch_times), epoch_times[0], to_model))
+        accuracy_rating(model, test_loader, 'test')
+
+
+def benchmark_early_stopping(noise_data_dict, samplerate=44100, epochs=30, patience=3,
+                             target_accuracy=0.95, batch_size=8):
+    """ Train on noise_data_dict for build_beatbot's default 10 epochs, and for up to
+    epochs with validation: without stopping early, then with patience, with and
+    without learning-rate schedules. Compare the epochs run, the training time, the
+    time until the validation accuracy first reached target_accuracy, and the test
+    accuracy. The split is the same for all (for the fixed 10 epochs, the validation
+    data is unused). """
+    dataset = NoisesDataset(noise_data_dict, samplerate, use_cache=False)
+    labels = dataset_labels(dataset)
+    train_indices, test_indices = stratified_split(labels, seed=0)
+    train_indices, val_indices = validation_split(labels, train_indices, seed=0)
+    train_loader, test_loader, _, _ = prepare_data_loaders(dataset, train_indices, test_indices,
+                                                           batch_size=batch_size, tensor_resident=True)
+    val_loader = prepare_validation_loader(dataset, val_indices, tensor_resident=True)
+
+    configurations = [('10 epochs', 10, None, None, None),
+                      ('{} epochs, validated'.format(epochs), epochs, val_loader, None, None),
+                      ('patience {}'.format(patience), epochs, val_loader, patience, None),
+                      ('patience {}, plateau'.format(patience), epochs, val_loader, patience, 'plateau'),
+                      ('patience {}, cosine'.format(patience), epochs, val_loader, patience, 'cosine')]
+    results = []
+    for name, max_epochs, val, configuration_patience, lr_schedule in configurations:
+        print('\n' + name)
+        torch.manual_seed(0)
+        model = Net(dataset[0][0].size(), dataset.noise_int_to_str)
+        history = train_net(model, max_epochs, train_loader, batch_progress=10**6,
+                            val_loader=val, patience=configuration_patience, lr_schedule=lr_schedule)
+        if val is not None and configuration_patience is None:
+            print_training_curve(history)
+        preds, targets = accuracy_rating(model, test_loader, 'test')
+        results.append((name, len(history['epoch_time']), sum(history['epoch_time']),
+                        time_to_accuracy(history, target_accuracy) if val is not None else None,
+                        (preds == targets).float().mean().item()))
+
+    print('\n{:<24} {:>6} {:>10} {:>16} {:>9}'.format(
+        'training', 'epochs', 'time (s)', 'to {:.0f} % (s)'.format(100 * target_accuracy), 'test acc.'))
+    for name, epochs_run, total_time, to_accuracy, test_accuracy in results:
+        print('{:<24} {:>6} {:>10.2f} {:>16} {:>8.0f}%'.format(
+            name, epochs_run, total_time, '-' if to_accuracy is None else '{:.2f}'.format(to_accuracy),
+            100 * test_accuracy))
+
+
+def benchmark_incremental(samplerate=44100, labels=('t', 'k', 'p', 'tsk', 'cluck'), new_label='x',
+                          per_label=100, new_per_label=20, epochs=10, batch_size=8):
+    """ Train a model on a library of per_label samples of each label, then add
+    new_per_label more of each, and per_label of new_label. Compare retraining a new
+    model on everything with fine-tuning the trained one (see src/model/incremental.py):
+    the time from dataset to model, and the accuracy on old and new labels. Both are
+    tested on the same samples, none of which the first model was trained on: its
+    testing split of the old library, and a testing split of the new samples. """
+    full_data = synthetic_noise_data(labels + (new_label,), per_label + new_per_label, samplerate)
+    old_data = {label: full_data[label][:per_label] for label in labels}
+    known_counts = {label: per_label for label in labels}
+    new_data = {label: full_data[label] for label in labels}
+    new_data[new_label] = full_data[new_label][:per_label]
+
+    # the model trained on the old library
+    torch.manual_seed(0)
+    old_dataset = NoisesDataset(old_data, samplerate, use_cache=False)
+    old_train_indices, old_test_indices = stratified_split(dataset_labels(old_dataset), seed=0)
+    old_loader, _, _, _ = prepare_data_loaders(old_dataset, old_train_indices, old_test_indices,
+                                               batch_size=batch_size, tensor_resident=True)
+    old_model = Net(old_dataset[0][0].size(), old_dataset.noise_int_to_str)
+    train_net(old_model, epochs, old_loader, batch_progress=10**6)
+
+    dataset = NoisesDataset(new_data, samplerate, use_cache=False, noise_int_to_str=old_model.noise_int_to_str)
+    is_new = new_sample_mask(new_data, known_counts, old_model.noise_int_to_str.values())
+
+    # the old samples keep their order in dataset, so the old model's split carries over
+    all_labels = dataset_labels(dataset)
+    warm_train_indices, test_indices = incremental_split(all_labels, is_new, seed=0,
+                                                         held_out=held_out_mask(is_new, old_test_indices))
+    train_indices = np.setdiff1d(np.arange(len(dataset)), test_indices)
+
+    for warm_start in [False, True]:
+        torch.manual_seed(0)
+        start = time.perf_counter()
+        if warm_start:
+            train_loader, test_loader, train_dataset, _ = prepare_data_loaders(
+                dataset, warm_train_indices, test_indices, batch_size=batch_size, tensor_resident=True)
+            model = widen_model(old_model, dataset.noise_int_to_str)
+        else:
+            train_loader, test_loader, train_dataset, _ = prepare_data_loaders(
+                dataset, train_indices, test_indices, batch_size=batch_size, tensor_resident=True)
+            model = Net(dataset[0][0].size(), dataset.noise_int_to_str)
+        train_net(model, epochs, train_loader, batch_progress=10**6)
+        to_model = time.perf_counter() - start
+
+        print('{}: {} training samples, {:.2f} sec to model'.format(
+            'warm start' if warm_start else 'full retraining', len(train_dataset), to_model))
+        preds, targets = accuracy_rating(model, test_loader, 'test')
+        correct = (preds == targets).numpy()
+        on_new = (targets == dataset.noise_str_to_int[new_label]).numpy()
+        print('Accuracy on the old labels: {:.0f} %, on the new label: {:.0f} % ({} test samples)'.format(
+            100 * correct[~on_new].mean(), 100 * correct[on_new].mean(), len(test_indices)))
+
+
+def benchmark_sweep(noise_data_dict, samplerate=44100, epochs=10, workers=(1, None)):
+    """ Sweep the front end and network sizes on noise_data_dict (see src/model/sweep.py),
+    with each number of workers (None for one per core), to compare the wall-clock time
+    of the sweep, and print the table of results """
+    configurations = configuration_grid(n_mels=[16, 28, 40], channels=[(16, 8), (32, 10)],
+                                        hidden=[(20, 10), (50, 10)])
+    for n_workers in workers:
+        results = run_sweep(noise_data_dict, samplerate, configurations, epochs=epochs, workers=n_workers)
+    print_sweep(results)
+
+
+def nested_split(full_dataset, samplerate, training_fraction=0.8):
+    """ The previous split, kept here as a baseline: reads every item for its label,
+    and nests a ConcatDataset per label """
+    train_dataset = NoisesDataset({}, samplerate)
+    test_dataset = NoisesDataset({}, samplerate)
+    dataset_element_labels = np.array([d[1] for d in full_dataset])
+    for i in list(set(full_dataset.labels)):
+        i_indices = np.nonzero(dataset_element_labels == i)[0]
+        train_size = int(training_fraction * len(i_indices))
+        i_train_dataset, i_test_dataset = random_split(
+            Subset(full_dataset, i_indices), [train_size, len(i_indices) - train_size])
+        train_dataset = ConcatDataset([train_dataset, i_train_dataset])
+        test_dataset = ConcatDataset([test_dataset, i_test_dataset])
+    return train_dataset, test_dataset
+
+
+def index_split(full_dataset, samplerate, training_fraction=0.8):
+    """ The stratified split on the label indices, as in prepare_even_data_loaders """
+    train_indices, test_indices = stratified_split(dataset_labels(full_dataset), training_fraction)
+    return Subset(full_dataset, train_indices), Subset(full_dataset, test_indices)
+
+
+def benchmark_splitting(samplerate=44100, label_counts=(5, 20), per_label=100, n_mels_list=(32, 64)):
+    """ For datasets with more labels and bigger spectrograms, compare the time to
+    split them into training and testing datasets, and to read every item of the
+    training dataset, for the previous nested split and the index-based split """
+    for n_labels in label_counts:
+        for n_mels in n_mels_list:
+            noise_data_dict = synthetic_noise_data([str(i) for i in range(n_labels)], per_label, samplerate)
+            dataset = NoisesDataset(noise_data_dict, samplerate, n_mels=n_mels, use_cache=False)
+            for split in [nested_split, index_split]:
+                start = time.perf_counter()
+                train_dataset, _ = split(dataset, samplerate)
+                split_time = time.perf_counter() - start
+                start = time.perf_counter()
+                for i in range(len(train_dataset)):
+                    train_dataset[i]
+                read_time = time.perf_counter() - start
+                print('{} labels, {} mels, {}: split {:.2f} ms, read {:.2f} us per item'.format(
+                    n_labels, n_mels, split.__name__, 1000 * split_time,
+                    1e6 * read_time / len(train_dataset)))
+
+
+if __name__ == "__main__":
+
+    ###################### BENCHMARKING MODELS ######################
+
+    my_model = load_model('necrodancer_100each_t-k-p-tsk-cluck')
+
+    # model/inference.py: per-call latency and CPU time
+
+    benchmark_inference(my_model)
+
+    # model/numpy_runtime.py: the torch-free runtime versus torch
+
+    benchmark_numpy_runtime(my_model)
+
+    # model/train_model.py: training from DataLoaders versus tensor-resident loaders
+
+    benchmark_training(synthetic_noise_data())
+
+    # model/train_model.py: early stopping on a validation split, versus a fixed number of epochs
+
+    benchmark_early_stopping(synthetic_noise_data())
+
+    # model/sweep.py: accuracy, size, latency, and training time per configuration, serially and in parallel
+
+    benchmark_sweep(synthetic_noise_data())
+
+    # model/incremental.py: fine-tuning a trained model on new recordings versus retraining
+
+    benchmark_incremental()
+
+    # model/prepare_datasets.py: splitting into training and testing datasets
+
+    benchmark_splitting()
@@ -7,8 +7,15 @@
 import torch.nn as nn
 import torch.nn.functional as F
 
+# the default architecture: the (square) kernel size and number of output channels
+# of each convolution layer, and the number of nodes of the hidden dense layers.
+# The numbers chosen do not have deep thought behind them (see src/model/sweep.py).
+KERNELS = (3, 3)
+CHANNELS = (32, 10)
+HIDDEN = (50, 10)
+
 class Net(nn.Module):
-    def __init__(self, image_size, noise_int_to_str):
+    def __init__(self, image_size, noise_int_to_str, kernels=KERNELS, channels=CHANNELS, hidden=HIDDEN):
         super(Net, self).__init__()
         
         # the spectrogram image size is needed to compute layer sizes
@@ -16,6 +23,9 @@ class Net(nn.Module):
         
         # the dictionary of noise labels is needed for translating predictions in the final layer
         self.noise_int_to_str = noise_int_to_str
+
+        # the layer sizes, two of each, needed to rebuild the model (see architecture)
+        self.kernels, self.channels, self.hidden = tuple(kernels), tuple(channels), tuple(hidden)
         
         
         # image_size is a 2-tuple, the expected dimensions of each spectrogram
@@ -25,9 +35,7 @@ class Net(nn.Module):
         elif len(image_size) == 3:
             channel, h, w = image_size
         
-        # number of output nodes, (square) kernel size, and pool size per convolution layer,
-        # assuming the stride for pooling is the same as the pool size
-        kernels = [3, 3]
+        # pool size per convolution layer, assuming the stride for pooling is the same as the pool size
         pool = 2
         
         # compute the number of input nodes for the first dense layer
@@ -42,24 +50,31 @@ class Net(nn.Module):
             w_out = int( (w_out - pool) / pool + 1 )
             
         self.image_out = h_out * w_out
+        if h_out <= 0 or w_out <= 0:
+            raise ValueError('Spectrograms of size {} are too small for kernels of size {}.'.format(
+                (h, w), self.kernels))
         
-        # define the layers. The numbers of nodes chosen do not have deep thought behind them.
-        self.conv0 = nn.Conv2d(1, 32, kernels[0])
+        # define the layers
+        self.conv0 = nn.Conv2d(1, channels[0], kernels[0])
         self.pool = nn.MaxPool2d(2)
-        self.conv1 = nn.Conv2d(32, 10, kernels[1])
-        self.fc0 = nn.Linear(10 * self.image_out, 50)
-        self.fc1 = nn.Linear(50, 10)
+        self.conv1 = nn.Conv2d(channels[0], channels[1], kernels[1])
+        self.fc0 = nn.Linear(channels[1] * self.image_out, hidden[0])
+        self.fc1 = nn.Linear(hidden[0], hidden[1])
         # number of output nodes for final dense layer: the number of noise types        
-        self.fc2 = nn.Linear(10, len(noise_int_to_str))
+        self.fc2 = nn.Linear(hidden[1], len(noise_int_to_str))
         
     def forward(self, x):
         x = self.pool(F.relu(self.conv0(x)))
         x = self.pool(F.relu(self.conv1(x)))
-        x = x.view(-1, 10 * self.image_out)
+        x = x.view(-1, self.channels[1] * self.image_out)
         x = F.relu(self.fc0(x))
         x = F.relu(self.fc1(x))
         x = self.fc2(x)
         return x
 
+    def architecture(self):
+        """ The layer sizes, as keyword arguments for Net """
+        return {'kernels': self.kernels, 'channels': self.channels, 'hidden': self.hidden}
+
 # # TESTING
 # my_net = Net(my_spectrogram.size(), my_dataset.noise_int_to_str)
\ No newline at end of file
@@ -0,0 +1,120 @@
+# Warm-start training: update a trained model with new recordings, rather than
+# training a new one from random initialization.
+
+# When a library of recordings grows by a few samples, or by a new noise, most
+# of what the trained model knows still holds. Instead of retraining on all the
+# data, the trained model (e.g., from src/model/save_load.load_model) is copied,
+# with its final layer (fc2) widened by one output per new label, and fine-tuned
+# on the new samples only, plus a replay subset of the samples it was trained on
+# before, so it doesn't forget the noises it already recognizes. The testing
+# data is only samples the trained model has never seen: a split of the new
+# samples, and the old samples it was tested on, if they are known (e.g., its
+# test_indices). The other old samples may have been trained on, so testing on
+# them would flatter it.
+
+from src.model.define_model import Net
+from src.model.prepare_datasets import prepare_data_loaders, dataset_labels, stratified_split
+import numpy as np
+import torch
+
+REPLAY_FRACTION = 0.25   # fraction of the old training samples (of each label) to fine-tune on again
+
+
+def widen_model(model, noise_int_to_str):
+    """ Return a copy of the trained model (a Net) that recognizes the labels of
+    noise_int_to_str, which must keep the integers of the model's labels (see
+    NoisesDataset). Each new label gets a new output, with initial weights. """
+    for i, label in model.noise_int_to_str.items():
+        if noise_int_to_str.get(i) != label:
+            raise ValueError('Label {} ("{}") of the model has a different integer in noise_int_to_str.'.format(i, label))
+
+    widened = Net(model.image_size, noise_int_to_str, **model.architecture())
+    state_dict = model.state_dict()
+    known = len(model.noise_int_to_str)
+    with torch.no_grad():
+        for name in ['fc2.weight', 'fc2.bias']:
+            parameter = widened.state_dict()[name]
+            parameter[:known] = state_dict.pop(name)
+            state_dict[name] = parameter
+    widened.load_state_dict(state_dict)
+    return widened
+
+
+def new_sample_mask(noise_data_dict, known_counts, known_labels=None):
+    """ Whether each sample of noise_data_dict (in the order of a NoisesDataset) is
+    new. known_counts is the number of samples of each label the model was trained
+    on: the first ones of its list. All samples of a label not in known_labels
+    (e.g., a model's noise_int_to_str values) are new. """
+    mask = []
+    for label, samples in noise_data_dict.items():
+        known = known_counts.get(label, 0)
+        if known_labels is not None and label not in known_labels:
+            known = 0
+        known = min(known, len(samples))
+        mask += [False] * known + [True] * (len(samples) - known)
+    return np.array(mask, dtype=bool)
+
+
+def replay_indices(labels, train_indices, is_new, replay_fraction=REPLAY_FRACTION, seed=None):
+    """ Of the training indices, keep the new samples (where is_new is True), and
+    replay_fraction of the old ones, of each label """
+    rng = np.random.default_rng(seed)
+    new = train_indices[is_new[train_indices]]
+    old = train_indices[~is_new[train_indices]]
+    replay = []
+    for label in np.unique(labels[old]):
+        indices = old[labels[old] == label]
+        replay_size = int(np.ceil(replay_fraction * len(indices)))
+        replay.append(rng.choice(indices, replay_size, replace=False))
+    return np.concatenate([new] + replay)
+
+
+def held_out_mask(is_new, known_test_indices):
+    """ Whether each sample (in the order of a NoisesDataset, see new_sample_mask) is
+    one of the old samples the trained model was tested on. known_test_indices are
+    their indices among the old samples (e.g., the test indices of the split of the
+    library it was trained from). """
+    held_out = np.zeros(len(is_new), dtype=bool)
+    held_out[np.flatnonzero(~is_new)[np.asarray(known_test_indices, dtype=np.int64)]] = True
+    return held_out
+
+
+def incremental_split(labels, is_new, training_fraction=0.8, replay_fraction=REPLAY_FRACTION, seed=None,
+                      held_out=None):
+    """ Split the indices of labels (integer labels) into training and testing
+    indices for fine-tuning a trained model. The new samples are split as
+    stratified_split does. The old samples marked in held_out (see held_out_mask),
+    which the model wasn't trained on, are for testing, and replay_fraction of the
+    rest for training (see replay_indices). """
+    new_indices = np.flatnonzero(is_new)
+    if held_out is None:
+        held_out = np.zeros(len(is_new), dtype=bool)
+    if len(new_indices):
+        new_train, new_test = stratified_split(labels[new_indices], training_fraction, seed)
+        new_train, new_test = new_indices[new_train], new_indices[new_test]
+    else:
+        new_train, new_test = new_indices, new_indices
+    train_indices = np.concatenate([new_train, np.flatnonzero(~is_new & ~held_out)])
+    test_indices = np.concatenate([new_test, np.flatnonzero(~is_new & held_out)])
+    return replay_indices(labels, train_indices, is_new, replay_fraction, seed), test_indices
+
+
+def prepare_incremental_data_loaders(full_dataset, is_new, training_fraction=0.8,
+                                     replay_fraction=REPLAY_FRACTION, batch_size=8,
+                                     tensor_resident=False, seed=None, held_out=None):
+    """ Prepare data loaders for fine-tuning a trained model, and for testing it on
+    samples it has never seen (see incremental_split) """
+    train_indices, test_indices = incremental_split(dataset_labels(full_dataset), is_new,
+                                                    training_fraction, replay_fraction, seed, held_out)
+    return prepare_data_loaders(full_dataset, train_indices, test_indices, batch_size, tensor_resident)
+
+
+# # TESTING
+# my_model = load_model('necrodancer_100each_t-k-p-tsk-cluck')
+# my_known_counts = {label: len(samples) for label, samples in my_recordings.items()}
+# my_recordings = record_model_data(device=0, starting_noise_data=my_recordings)
+# my_dataset = NoisesDataset(my_recordings, samplerate, noise_int_to_str=my_model.noise_int_to_str)
+# my_is_new = new_sample_mask(my_recordings, my_known_counts, my_model.noise_int_to_str.values())
+# my_train_loader, my_test_loader, _, _ = prepare_incremental_data_loaders(my_dataset, my_is_new)
+# my_model = widen_model(my_model, my_dataset.noise_int_to_str)
+# train_net(my_model, 10, my_train_loader)
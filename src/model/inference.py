@@ -0,0 +1,114 @@
+# Prepare a trained model for fast recognition of one noise at a time.
+
+# Training needs autograd, but recognition doesn't. For recognition the model is
+# put in eval mode, its parameters are frozen, and it's traced with TorchScript
+# so each call skips the Python overhead of the eager forward pass. Each call
+# runs in inference mode. A single small spectrogram doesn't benefit from
+# several threads, so during play the intra-op thread count is pinned (see
+# inference_threads). The thread count applies to torch in the whole process,
+# so it's pinned only while recognizing, and restored after, so that training
+# later in the same process still uses every core. The first few calls are made
+# at setup (warm-up), so the first real noise doesn't pay for lazy initialization.
+
+import contextlib
+import copy
+import warnings
+import torch
+
+INFERENCE_THREADS = 1      # intra-op threads while recognizing: one is plenty for a single spectrogram
+WARMUP_CALLS = 10          # calls made at setup, before any noise is recognized
+
+
+def trace_model(model):
+    """ Trace a model with TorchScript, on an example input with the expected
+    dimensions, [1, 1, A, B]. """
+    example = torch.zeros(1, 1, *model.image_size[-2:])
+    with torch.no_grad(), warnings.catch_warnings():
+        # newer torch versions deprecate TorchScript, but it's still the fastest option here
+        warnings.simplefilter('ignore', FutureWarning)
+        return torch.jit.trace(model.eval(), example)
+
+
+@contextlib.contextmanager
+def inference_threads(threads=INFERENCE_THREADS):
+    """ A context manager that pins torch's intra-op thread count to threads (for
+    the whole process) while open, and restores the previous count after. """
+    previous = torch.get_num_threads()
+    torch.set_num_threads(threads)
+    try:
+        yield
+    finally:
+        torch.set_num_threads(previous)
+
+
+def freeze_traced(traced):
+    """ Freeze a traced model, inlining its parameters as constants. """
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', FutureWarning)
+        return torch.jit.freeze(traced.eval())
+
+
+class InferenceModel:
+    """ Wraps a trained Net for recognition. Call it with a [N, 1, A, B] batch of
+    spectrograms to get the model output, like the Net itself. If threads is given,
+    the thread count is set (for torch in the whole process, and left set): to pin
+    it only while recognizing, use inference_threads instead. """
+
+    def __init__(self, model, threads=None, warmup_calls=WARMUP_CALLS):
+        # work on a copy, so the original can still be trained
+        model = copy.deepcopy(model).eval()
+        for parameter in model.parameters():
+            parameter.requires_grad_(False)
+
+        # trace and freeze the model, or just use it as is if that isn't possible
+        try:
+            forward = freeze_traced(trace_model(model))
+        except Exception as e:
+            print('Could not trace the model ({}). Using it untraced.'.format(e))
+            forward = model
+
+        self._setup(forward, model.image_size, model.noise_int_to_str, threads, warmup_calls)
+
+    @classmethod
+    def from_scripted(cls, scripted, image_size, noise_int_to_str,
+                      threads=None, warmup_calls=WARMUP_CALLS):
+        """ An InferenceModel for a model that has already been traced, e.g., one
+        loaded with torch.jit.load. """
+        inference_model = cls.__new__(cls)
+        inference_model._setup(freeze_traced(scripted), image_size, noise_int_to_str,
+                               threads, warmup_calls)
+        return inference_model
+
+    def _setup(self, forward, image_size, noise_int_to_str, threads, warmup_calls):
+        self.forward = forward
+        self.image_size = image_size
+        self.noise_int_to_str = noise_int_to_str
+
+        if threads:
+            torch.set_num_threads(threads)
+
+        example = torch.zeros(1, 1, *image_size[-2:])
+        for _ in range(warmup_calls):
+            self(example)
+
+    def __call__(self, spectrograms):
+        with torch.inference_mode():
+            return self.forward(spectrograms)
+
+    def predict(self, spectrograms):
+        """ Return the string label for each spectrogram in the batch """
+        labels = torch.argmax(self(spectrograms), dim=1)
+        return [self.noise_int_to_str[label] for label in labels.tolist()]
+
+
+def prepare_for_inference(model, **kwargs):
+    """ Return an InferenceModel for the model, unless it already is one. """
+    if isinstance(model, InferenceModel):
+        return model
+    return InferenceModel(model, **kwargs)
+
+
+# # TESTING
+# my_inference_model = prepare_for_inference(my_net)
+# with inference_threads():
+#     my_inference_model.predict(my_spectrograms)
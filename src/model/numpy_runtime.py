@@ -0,0 +1,142 @@
+# A NumPy-only runtime for recognizing noises with a trained model.
+
+# Running a saved model doesn't need torch: the network is two convolutions and
+# three dense layers on a small spectrogram. A model exported with
+# export_numpy_model (in src/model/save_load.py) is a bundle of plain arrays: the
+# layer weights, plus the window and mel filterbank for its spectrograms. This
+# module reproduces the spectrograms and predictions from that bundle with NumPy
+# alone, and must not import torch.
+
+from src.utils.save_load import load_file
+import numpy as np
+
+MODEL_BASEPATH = 'output/trained_models/'  # the same as in src/model/save_load.py
+NUMPY_EXTENSION = '.npz'
+
+
+class NumpyFrontEnd:
+    """ Computes log2 mel spectrograms from a noise sample, like SpectrogramFrontEnd. """
+
+    def __init__(self, samplerate, window, fb_T, hop_length):
+        self.samplerate = samplerate
+        self.window = window
+        self.fb_T = fb_T                   # (n_mels, n_freqs)
+        self.n_mels = fb_T.shape[0]
+        self.n_fft = len(window)
+        self.hop_length = hop_length
+
+    def __call__(self, noise_sample):
+        """ Takes a noise_sample as a flattened numpy.array,
+        and returns a mel spectrogram as a 2D numpy.array """
+
+        # normalize to have unit mean, and pad the ends by reflection
+        normed_sample = (noise_sample / noise_sample.mean()).astype(np.float32)
+        padded = np.pad(normed_sample, self.n_fft // 2, mode='reflect')
+
+        # the power spectrum of each windowed frame, then the mel scale
+        frames = np.lib.stride_tricks.sliding_window_view(padded, self.n_fft)[::self.hop_length]
+        power = np.abs(np.fft.rfft(frames * self.window)) ** 2
+        mel = self.fb_T @ power.T.astype(np.float32)
+
+        return np.log2(mel)
+
+
+# The network runs with channels last, [N, H, W, C], so that each convolution is
+# one matrix multiplication of the image patches (im2col) with the kernels.
+
+def conv2d(x, kernels, bias, kernel_size):
+    """ A 2D convolution (stride 1, no padding) of x, shaped [N, H, W, C], with
+    kernels shaped [C * kernel_size**2, O] """
+    n, h, w, _ = x.shape
+    h, w = h - kernel_size + 1, w - kernel_size + 1
+    patches = np.lib.stride_tricks.sliding_window_view(x, (kernel_size, kernel_size), axis=(1, 2))
+    out = patches.reshape(n * h * w, -1) @ kernels + bias
+    return out.reshape(n, h, w, -1)
+
+
+def max_pool2d(x, pool):
+    """ Max pooling of x, shaped [N, H, W, C], with stride equal to the pool size """
+    _, h, w, _ = x.shape
+    h, w = h // pool * pool, w // pool * pool
+    out = x[:, 0:h:pool, 0:w:pool].copy()
+    for i in range(pool):
+        for j in range(pool):
+            np.maximum(out, x[:, i:h:pool, j:w:pool], out=out)
+    return out
+
+
+def relu(x):
+    return np.maximum(x, 0, out=x)
+
+
+class NumpyNet:
+    """ The forward pass of Net, from its exported weights (its state_dict as
+    numpy.arrays) and image_size """
+
+    def __init__(self, weights, image_size, pool=2):
+        self.pool = pool
+
+        # rearrange the convolution kernels for channels-last im2col, and track
+        # the size of the image after each convolution and pool
+        h, w = image_size[-2:]
+        self.convs = []
+        for name in ['conv0', 'conv1']:
+            kernels = weights[name + '.weight']
+            out_channels, _, kernel_size, _ = kernels.shape
+            kernels = np.ascontiguousarray(kernels.reshape(out_channels, -1).T)
+            self.convs.append((kernels, weights[name + '.bias'], kernel_size))
+            h, w = (h - kernel_size + 1) // pool, (w - kernel_size + 1) // pool
+
+        # Net flattens channels first, so reorder the inputs of fc0 to match
+        fc0 = weights['fc0.weight'].reshape(-1, out_channels, h, w).transpose(0, 2, 3, 1)
+        self.dense = [(np.ascontiguousarray(fc0.reshape(len(fc0), -1).T), weights['fc0.bias'])]
+        for name in ['fc1', 'fc2']:
+            self.dense.append((np.ascontiguousarray(weights[name + '.weight'].T), weights[name + '.bias']))
+
+    def __call__(self, x):
+        """ Takes a batch of spectrograms shaped [N, 1, A, B] """
+        x = x.transpose(0, 2, 3, 1)
+        for kernels, bias, kernel_size in self.convs:
+            x = max_pool2d(relu(conv2d(x, kernels, bias, kernel_size)), self.pool)
+        x = x.reshape(len(x), -1)
+        for weight, bias in self.dense[:-1]:
+            x = relu(x @ weight + bias)
+        weight, bias = self.dense[-1]
+        return x @ weight + bias
+
+
+class NumpyModel:
+    """ A model for recognition without torch. Call it with a [N, 1, A, B] batch of
+    spectrograms (numpy.arrays) to get the model output, like an InferenceModel.
+    Spectrograms for the model are made by its front_end. """
+
+    def __init__(self, bundle):
+        self.image_size = tuple(int(i) for i in bundle['image_size'])
+        self.noise_int_to_str = {i: str(label) for i, label in enumerate(bundle['labels'])}
+        self.front_end = NumpyFrontEnd(float(bundle['samplerate']), bundle['window'],
+                                       bundle['fb_T'], int(bundle['hop_length']))
+        self.net = NumpyNet({k: bundle[k] for k in bundle if '.' in k}, self.image_size)
+
+    def __call__(self, spectrograms):
+        return self.net(np.asarray(spectrograms, dtype=np.float32))
+
+    def predict(self, spectrograms):
+        """ Return the string label for each spectrogram in the batch """
+        return [self.noise_int_to_str[label] for label in self(spectrograms).argmax(axis=1)]
+
+
+def load_numpy_model(filename=None, basepath=MODEL_BASEPATH):
+    """ Load a model exported with export_numpy_model """
+
+    def load_function(path):
+        with np.load(path) as bundle:
+            return NumpyModel({k: bundle[k] for k in bundle.files})
+
+    if filename is not None and not filename.endswith(NUMPY_EXTENSION):
+        filename += NUMPY_EXTENSION
+    return load_file(filename=filename, basepath=basepath, load_function=load_function)
+
+
+# # TESTING
+# my_numpy_model = load_numpy_model('my_model')
+# my_numpy_model.predict(my_numpy_model.front_end(my_recordings['t'][0])[None, None])
@@ -9,9 +9,13 @@
 # Data loaders partly adapted from
 # https://stackoverflow.com/questions/53916594/typeerror-object-of-type-numpy-int64-has-no-len
 
-from src.audio.make_spectrograms import N_MELS, generate_spectrogram
-from torch.utils.data import Dataset, DataLoader, Subset, ConcatDataset, random_split
+from src.audio.make_spectrograms import N_MELS, get_front_end
+from src.audio.spectrogram_cache import SpectrogramCache
+from torch.utils.data import Dataset, DataLoader, Subset, ConcatDataset
 import numpy as np
+import torch
+
+VALIDATION_FRACTION = 0.2   # of the training data, held out for early stopping
 
 # Prepare the noise data for handing to the convolutional neural network, for training and testing
 
@@ -20,19 +24,23 @@ class NoisesDataset(Dataset):
     """ Noises dataset. Takes a dictionary of recordings and returns spectrograms when data is requested. 
     A channel dimension is added to each spectrogram, as needed for the CNN. """
 
-    def __init__(self, noise_data_dict, samplerate, n_mels=N_MELS):
+    def __init__(self, noise_data_dict, samplerate, n_mels=N_MELS, use_cache=True, noise_int_to_str=None):
         """ Initialization: 
         Takes a dictionary of noise samples, with labels as keys and lists of
         flattened numpy arrays (one array per noise sample) as values. 
-        Computes spectrograms for each. """
+        Computes spectrograms for each, reusing those saved in the spectrogram
+        cache (see SpectrogramCache) unless use_cache is False. If noise_int_to_str
+        is given (e.g., a trained model's), its labels keep their integers, and
+        any new labels are numbered after them. """
 
         self.noise_data_dict = noise_data_dict
         self.noise_samples = []
         self.labels = []
 
-        self.noise_str_to_int = {}  # correspondences between integer and string labels
-        self.noise_int_to_str = {}
-        i = 0
+        # correspondences between integer and string labels
+        self.noise_int_to_str = dict(noise_int_to_str or {})
+        self.noise_str_to_int = {label: i for i, label in self.noise_int_to_str.items()}
+        i = len(self.noise_int_to_str)
 
         for label, list_of_arrays in noise_data_dict.items():
             # extract samples and labels from the dictionary
@@ -46,9 +54,13 @@ class NoisesDataset(Dataset):
                 self.noise_int_to_str[i] = label
                 i += 1
 
-        # compute spectrograms, and convert labels to integers
-        self.spectrograms = [generate_spectrogram(s, samplerate, n_mels)
-                             for s in self.noise_samples]
+        # compute spectrograms in batches, as one (N, 1, n_mels, frames) tensor,
+        # and convert labels to integers
+        front_end = get_front_end(samplerate, n_mels)
+        if use_cache and self.noise_samples:
+            self.spectrograms = SpectrogramCache().get_spectrograms(self.noise_samples, front_end)
+        else:
+            self.spectrograms = front_end.batch(self.noise_samples)
         self.labels = [self.noise_str_to_int[L] for L in self.labels]
 
     def __len__(self):
@@ -58,43 +70,139 @@ class NoisesDataset(Dataset):
     def __getitem__(self, sample_index):
         " Return one sample of data "
         # Load data and get (integer) label
-        # Note the CNN will expect the first tensor dimension to be the channel, hence the unsqueeze
-        X = self.spectrograms[sample_index].unsqueeze(0)
+        # Note the CNN expects the first tensor dimension to be the channel, which is already included
+        X = self.spectrograms[sample_index]
         y = self.labels[sample_index]
 
         return X, y
 
 
-def prepare_even_data_loaders(full_dataset, samplerate, training_fraction=0.8, batch_size=8):
-    """ Prepare data loaders for training and testing of the model, including 
-    training_fraction of each type in the training dataset. """
-
-    train_dataset = NoisesDataset({}, samplerate)
-    test_dataset = NoisesDataset({}, samplerate)
-
-    # iterate through noise labels, adding training_fraction of each
-    # to the training dataset/loader
-
-    unique_int_labels = list(set(full_dataset.labels))
-    dataset_element_labels = np.array([d[1] for d in full_dataset])
-
-    for i in unique_int_labels:
-        # get an array of indices, of noise samples with label i
-        i_indices = np.nonzero(dataset_element_labels == i)[0]
-        num_samples = len(i_indices)
-        train_size = int(training_fraction * num_samples)
-        test_size = num_samples - train_size
+# The whole dataset is a few MB of spectrograms, so it can be held as one tensor
+# of spectrograms and one of labels. A TensorLoader does that: each epoch is a
+# permutation of the indices, and each batch a slice, instead of a DataLoader's
+# worker process and __getitem__ and collate per sample.
+
+def dataset_tensors(dataset):
+    """ Return the spectrograms and labels of a dataset (a NoisesDataset, or Subsets and
+    ConcatDatasets of them) as two tensors, gathered by index rather than item by item """
+    if isinstance(dataset, NoisesDataset):
+        return dataset.spectrograms, torch.tensor(dataset.labels, dtype=torch.long)
+    if isinstance(dataset, Subset):
+        spectrograms, labels = dataset_tensors(dataset.dataset)
+        indices = torch.as_tensor(dataset.indices, dtype=torch.long)
+        return spectrograms[indices], labels[indices]
+    if isinstance(dataset, ConcatDataset):
+        parts = [dataset_tensors(d) for d in dataset.datasets if len(d)]
+        return torch.cat([X for X, _ in parts]), torch.cat([y for _, y in parts])
+
+    # any other dataset, item by item
+    spectrograms, labels = zip(*[dataset[i] for i in range(len(dataset))])
+    return torch.stack(spectrograms), torch.tensor(labels, dtype=torch.long)
+
+
+class TensorLoader:
+    """ A data loader for a dataset held as one tensor pair (see dataset_tensors).
+    Iterate over it for batches of [spectrograms, labels], like a DataLoader. If
+    shuffle is True, each pass is in a new random order. """
+
+    def __init__(self, dataset, batch_size=1, shuffle=False):
+        self.dataset = dataset
+        self.spectrograms, self.labels = dataset_tensors(dataset)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
 
-        # make datasets for just that noise label
-        i_dataset = Subset(full_dataset, i_indices)
-        i_train_dataset, i_test_dataset = random_split(
-            i_dataset, [train_size, test_size])
-
-        # add these datasets to the overall collections
-        train_dataset = ConcatDataset([train_dataset, i_train_dataset])
-        test_dataset = ConcatDataset([test_dataset,  i_test_dataset])
+    def __len__(self):
+        return -(-len(self.labels) // self.batch_size)
+
+    def __iter__(self):
+        spectrograms, labels = self.spectrograms, self.labels
+        if self.shuffle:
+            order = torch.randperm(len(labels))
+            spectrograms, labels = spectrograms[order], labels[order]
+        for start in range(0, len(labels), self.batch_size):
+            yield [spectrograms[start:start + self.batch_size], labels[start:start + self.batch_size]]
+
+
+# Splits are made on the array of integer labels alone, so they cost the same
+# whatever the size of the spectrograms. Each split is a pair of index arrays,
+# and the datasets for it are flat Subsets of the full dataset.
+
+def dataset_labels(dataset):
+    """ The integer label of each item of a dataset, as a numpy.array, without
+    loading the spectrograms of a NoisesDataset """
+    if isinstance(dataset, NoisesDataset):
+        return np.asarray(dataset.labels, dtype=np.int64)
+    return np.array([d[1] for d in dataset], dtype=np.int64)
+
+
+def stratified_split(labels, training_fraction=0.8, seed=None):
+    """ Split the indices of labels (integer labels) into training and testing
+    indices, with training_fraction of each label for training, in random order.
+    Give a seed to make the split repeatable. """
+    rng = np.random.default_rng(seed)
+    train_indices, test_indices = [], []
+    for label in np.unique(labels):
+        indices = rng.permutation(np.flatnonzero(labels == label))
+        train_size = int(training_fraction * len(indices))
+        train_indices.append(indices[:train_size])
+        test_indices.append(indices[train_size:])
+    return np.concatenate(train_indices), np.concatenate(test_indices)
+
+
+def stratified_k_fold(labels, k=5, seed=None):
+    """ Split the indices of labels (integer labels) into k folds, with each label
+    spread evenly between them. Returns k pairs of (training, testing) indices:
+    each fold is used once for testing, and the rest for training. """
+    rng = np.random.default_rng(seed)
+    folds = [[] for _ in range(k)]
+    for label in np.unique(labels):
+        indices = rng.permutation(np.flatnonzero(labels == label))
+        for fold, fold_indices in zip(folds, np.array_split(indices, k)):
+            fold.append(fold_indices)
+    folds = [np.concatenate(fold) for fold in folds]
+    return [(np.concatenate(folds[:i] + folds[i + 1:]), folds[i]) for i in range(k)]
+
+
+def validation_split(labels, train_indices, validation_fraction=VALIDATION_FRACTION, seed=None):
+    """ Hold out validation_fraction of each label of the training indices (e.g.,
+    from stratified_split), for early stopping. Returns the remaining training
+    indices and the validation indices. At least one sample of each label is held
+    out, unless the label has only one for training. """
+    rng = np.random.default_rng(seed)
+    train_labels = labels[train_indices]
+    kept_indices, val_indices = [], []
+    for label in np.unique(train_labels):
+        indices = rng.permutation(train_indices[train_labels == label])
+        val_size = int(validation_fraction * len(indices))
+        if val_size == 0 and validation_fraction > 0 and len(indices) >= 2:
+            val_size = 1
+        val_indices.append(indices[:val_size])
+        kept_indices.append(indices[val_size:])
+    return np.concatenate(kept_indices), np.concatenate(val_indices)
+
+
+def prepare_validation_loader(full_dataset, val_indices, tensor_resident=False):
+    """ Prepare a data loader of the validation indices of the full dataset (see
+    validation_split), in batches as large as the dataset for evaluating quickly """
+    val_dataset = Subset(full_dataset, val_indices)
+    if tensor_resident:
+        return TensorLoader(val_dataset, batch_size=max(len(val_dataset), 1))
+    return DataLoader(dataset=val_dataset, batch_size=max(len(val_dataset), 1))
+
+
+def prepare_data_loaders(full_dataset, train_indices, test_indices, batch_size=8, tensor_resident=False):
+    """ Prepare data loaders for training and testing of the model, from the indices
+    of the full dataset for each (e.g., from stratified_split or stratified_k_fold).
+    If tensor_resident is True, the loaders are TensorLoaders, rather than DataLoaders. """
+    train_dataset = Subset(full_dataset, train_indices)
+    test_dataset = Subset(full_dataset, test_indices)
 
     # create the data loaders
+    if tensor_resident:
+        train_loader = TensorLoader(train_dataset, batch_size=batch_size, shuffle=True)
+        test_loader = TensorLoader(test_dataset)
+        return train_loader, test_loader, train_dataset, test_dataset
+
     train_params = {
         'batch_size': batch_size,
         'shuffle': True,
@@ -106,9 +214,26 @@ def prepare_even_data_loaders(full_dataset, samplerate, training_fraction=0.8, b
     return train_loader, test_loader, train_dataset, test_dataset
 
 
+def prepare_even_data_loaders(full_dataset, samplerate, training_fraction=0.8, batch_size=8,
+                              tensor_resident=False, seed=None):
+    """ Prepare data loaders for training and testing of the model, including 
+    training_fraction of each type in the training dataset. If tensor_resident is
+    True, the loaders are TensorLoaders, rather than DataLoaders. Give a seed to
+    make the split repeatable. (The samplerate is no longer needed.) """
+    train_indices, test_indices = stratified_split(dataset_labels(full_dataset), training_fraction, seed)
+    return prepare_data_loaders(full_dataset, train_indices, test_indices, batch_size, tensor_resident)
+
+
 # # TESTING prepare_even_data_loaders
 # my_dataset = NoisesDataset(my_recordings, samplerate)
 # my_train_loader, my_test_loader, my_train_dataset, my_test_dataset = prepare_even_data_loaders(my_dataset, samplerate, batch_size=8)
+# # k-fold cross validation
+# for my_train_indices, my_test_indices in stratified_k_fold(dataset_labels(my_dataset), k=5, seed=0):
+#     my_train_loader, my_test_loader, _, _ = prepare_data_loaders(my_dataset, my_train_indices, my_test_indices)
+# # hold out validation data, for early stopping (see train_net)
+# my_train_indices, my_test_indices = stratified_split(dataset_labels(my_dataset))
+# my_train_indices, my_val_indices = validation_split(dataset_labels(my_dataset), my_train_indices)
+# my_val_loader = prepare_validation_loader(my_dataset, my_val_indices)
 
 # # get some random training spectrograms
 # my_train_dataiter = iter(my_train_loader)
@@ -0,0 +1,118 @@
+# Reduced-precision (int8) models, for lower CPU use during play.
+
+# The dense layers (fc0, fc1, fc2) are quantized dynamically: int8 weights, with
+# activations quantized on the fly. The convolution layers are quantized
+# statically, which needs some example spectrograms (calibration data) to choose
+# the activation scales. That's only done if calibration data is given and the
+# platform has a quantized backend. Otherwise the convolutions stay float.
+
+from src.model.inference import InferenceModel, inference_threads
+import copy
+import time
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.ao import quantization as tq
+
+
+def static_quantization_supported():
+    """ True if torch has a quantized backend (for int8 convolutions) on this platform """
+    engine = torch.backends.quantized.engine
+    return engine != 'none' and engine in torch.backends.quantized.supported_engines
+
+
+class QuantizableNet(nn.Module):
+    """ The layers of a trained Net, rearranged for eager-mode quantization:
+    the convolutions (with their ReLUs) sit between quantize and dequantize stubs. """
+
+    def __init__(self, net):
+        super(QuantizableNet, self).__init__()
+        net = copy.deepcopy(net)
+        self.image_size = net.image_size
+        self.noise_int_to_str = net.noise_int_to_str
+        self.image_out = net.image_out
+        self.channels = net.channels
+
+        self.quant = tq.QuantStub()
+        self.conv0, self.relu0 = net.conv0, nn.ReLU()
+        self.conv1, self.relu1 = net.conv1, nn.ReLU()
+        self.pool = net.pool
+        self.dequant = tq.DeQuantStub()
+        self.fc0, self.fc1, self.fc2 = net.fc0, net.fc1, net.fc2
+
+    def forward(self, x):
+        x = self.quant(x)
+        x = self.pool(self.relu0(self.conv0(x)))
+        x = self.pool(self.relu1(self.conv1(x)))
+        x = self.dequant(x)
+        x = x.reshape(-1, self.channels[1] * self.image_out)
+        x = F.relu(self.fc0(x))
+        x = F.relu(self.fc1(x))
+        x = self.fc2(x)
+        return x
+
+
+def quantize_model(model, calibration_loader=None):
+    """ Return an int8 copy of a trained Net. The convolutions are quantized only
+    if calibration_loader (e.g., the training data loader) is given and supported. """
+
+    quantized = QuantizableNet(model).eval()
+
+    if calibration_loader is not None and static_quantization_supported():
+        tq.fuse_modules(quantized, [['conv0', 'relu0'], ['conv1', 'relu1']], inplace=True)
+        qconfig = tq.get_default_qconfig(torch.backends.quantized.engine)
+        for name in ['quant', 'conv0', 'conv1', 'dequant']:
+            getattr(quantized, name).qconfig = qconfig
+        tq.prepare(quantized, inplace=True)
+
+        # observe typical activations to choose the int8 scales
+        with torch.no_grad():
+            for spectrograms, _ in calibration_loader:
+                quantized(spectrograms)
+        tq.convert(quantized, inplace=True)
+    elif calibration_loader is not None:
+        print('No quantized backend available for the convolutions. Quantizing the dense layers only.')
+
+    return tq.quantize_dynamic(quantized, {nn.Linear}, dtype=torch.qint8)
+
+
+def compare_models(models, test_loader, repeats=1000):
+    """ Return a dict of {name: {'accuracy': %, 'latency_us': per call}} for a dict of
+    {name: model}, using accuracy_rating on test_loader and timing a single spectrogram.
+    Each model is timed as an InferenceModel, as it would be used for recognition.
+    Each result also has its change from the first model (e.g., the float one):
+    'accuracy_change' (percentage points) and 'latency_change' (% of its latency). """
+    from src.model.evaluate_model import accuracy_rating
+
+    spectrograms = next(iter(test_loader))[0][:1]
+    results = {}
+    for name, model in models.items():
+        model = InferenceModel(model)
+        predictions, targets = accuracy_rating(model, test_loader, '{} test'.format(name))
+        accuracy = 100 * (predictions == targets).float().mean().item()
+
+        with inference_threads():
+            start = time.perf_counter()
+            for _ in range(repeats):
+                model(spectrograms)
+            latency_us = 1e6 * (time.perf_counter() - start) / repeats
+
+        results[name] = {'accuracy': accuracy, 'latency_us': latency_us}
+
+    baseline = next(iter(results.values()))
+    for result in results.values():
+        result['accuracy_change'] = result['accuracy'] - baseline['accuracy']
+        result['latency_change'] = 100 * (result['latency_us'] / baseline['latency_us'] - 1)
+
+    print('\n{:>10s} {:>10s} {:>10s} {:>14s} {:>10s}'.format(
+        'model', 'accuracy', 'change', 'latency (us)', 'change'))
+    for name, result in results.items():
+        print('{:>10s} {:>9.1f}% {:>+8.1f}pt {:>14.1f} {:>+9.1f}%'.format(
+            name, result['accuracy'], result['accuracy_change'], result['latency_us'], result['latency_change']))
+
+    return results
+
+
+# # TESTING
+# my_quantized_net = quantize_model(my_net, my_train_loader)
+# compare_models({'float': my_net, 'int8': my_quantized_net}, my_test_loader)
@@ -1,42 +1,59 @@
 # Save or load trained models. This required saving (or loading) both the
-# trained model parameters, as well as the image_size and noise_int_to_str
-# dictionary needed to instantiate the model. These are done in tandem, so that
-# loading a model automatically returns the fully restored model.
+# trained model parameters, as well as the image_size, noise_int_to_str
+# dictionary, and layer sizes needed to instantiate the model. These are done in
+# tandem, so that loading a model automatically returns the fully restored model.
+
+# A model can also be saved in a quantized (int8) variant, for lower CPU use
+# during play. This is saved as a traced TorchScript (.pt) file instead of the
+# parameters (.pth), with a report comparing its accuracy and latency to the
+# original (.json).
+
+# A model can also be exported for the NumPy runtime (src/model/numpy_runtime.py),
+# which runs it without torch: the weights, labels, and spectrogram parameters are
+# saved together as plain arrays (.npz). Load with load_numpy_model.
 
 from src.utils.save_load import save_file, load_file
 from src.model.define_model import Net
+from src.model.inference import InferenceModel, trace_model
+from src.model.numpy_runtime import NUMPY_EXTENSION
+from src.audio.make_spectrograms import N_MELS, get_front_end
+import json
 import numpy as np
 import torch
 
 MODEL_BASEPATH = 'output/trained_models/'
+QUANTIZED_EXTENSION = '.pt'
+QUANTIZED_SUFFIX = '_int8'  # added to the filenames of quantized models
 
 
-def get_paired_filenames(filename):
+def get_paired_filenames(filename, params_extension=".pth"):
     # If a filename is given, return the two associated files with appropriate extensions.
     if type(filename) is str:
-        if len(filename) > 4 and filename[-4:] == ".pth":
-            params_filename = filename
-            init_filename = filename[:-4] + ".npy"
-        elif len(filename) > 4 and filename[-4:] == ".npy":
-            params_filename = filename[:-4] + ".pth"
-            init_filename = filename
-        else:
-            params_filename = filename + ".pth"
-            init_filename = filename + ".npy"
-        return params_filename, init_filename
+        for extension in [params_extension, ".npy"]:
+            if len(filename) > len(extension) and filename.endswith(extension):
+                filename = filename[:-len(extension)]
+                break
+        return filename + params_extension, filename + ".npy"
     else:
         return None, None
 
 
+def save_function_init(data, path):
+    np.save(path, np.array([data.image_size, data.noise_int_to_str, data.architecture()], dtype=object))
+
+
+def load_function_init(path):
+    # files saved before the architecture could vary have the default one
+    image_size, noise_int_to_str, *architecture = np.load(path, allow_pickle=True)
+    return image_size, noise_int_to_str, (architecture[0] if architecture else {})
+
+
 def save_model(model, filename=None, rewrite=False, basepath=MODEL_BASEPATH):
     """ Save the trained model parameters, and also the image_size and noise_int_to_str dictionary """
 
     def save_function_parameters(data, path):
         torch.save(data.state_dict(), path)
 
-    def save_function_init(data, path):
-        np.save(path, np.array([data.image_size, data.noise_int_to_str], dtype=object))
-
     # save the neural net parameters
     print('Saving the model parameters (.pth) ...')
     parameters_path = save_file(data=model, filename=filename, rewrite=rewrite,
@@ -58,21 +75,25 @@ def save_model(model, filename=None, rewrite=False, basepath=MODEL_BASEPATH):
     return parameters_path, init_path
 
 
-def load_model(filename=None, basepath=MODEL_BASEPATH):
-    """ Load and initialize trained model """
+def load_model(filename=None, basepath=MODEL_BASEPATH, quantized=False):
+    """ Load and initialize trained model. If quantized is True, load a model saved
+    by save_quantized_model, ready for recognition (an InferenceModel). """
 
     def load_function_params(path):
         state_dict = torch.load(path)
         return state_dict
 
-    def load_function_init(path):
-        image_size, noise_int_to_str = np.load(path, allow_pickle=True)
-        return image_size, noise_int_to_str
+    def load_function_scripted(path):
+        return torch.jit.load(path)
+
+    params_extension = QUANTIZED_EXTENSION if quantized else ".pth"
+    if quantized:
+        load_function_params = load_function_scripted
 
     # If no filename is given, prompt for filenames. Otherwise, load the two associated files.
-    params_filename, init_filename = get_paired_filenames(filename)
+    params_filename, init_filename = get_paired_filenames(filename, params_extension)
     if (params_filename, init_filename) == (None, None):
-        print('Load the parameters file, with extension .pth\n')
+        print('Load the parameters file, with extension {}\n'.format(params_extension))
         state_dict = load_file(
             filename=None, basepath=basepath, load_function=load_function_params)
         if state_dict is None:
@@ -81,7 +102,7 @@ def load_model(filename=None, basepath=MODEL_BASEPATH):
         model_init = load_file(
             filename=None, basepath=basepath, load_function=load_function_init)
     else:
-        print('Loading the parameters file (.pth) ...')
+        print('Loading the parameters file ({}) ...'.format(params_extension))
         state_dict = load_file(
             filename=params_filename, basepath=basepath, load_function=load_function_params)
         print('\nLoading the initialization file (.npy) ...')
@@ -94,14 +115,109 @@ def load_model(filename=None, basepath=MODEL_BASEPATH):
         return
 
     # Build the model from the resulting data
-    image_size, noise_int_to_str = model_init
-    model = Net(image_size, noise_int_to_str)
+    image_size, noise_int_to_str, architecture = model_init
+    if quantized:
+        return InferenceModel.from_scripted(state_dict, image_size, noise_int_to_str)
+    model = Net(image_size, noise_int_to_str, **architecture)
     model.load_state_dict(state_dict)
 
     return model
 
+
+def save_quantized_model(model, filename=None, rewrite=False, basepath=MODEL_BASEPATH,
+                         calibration_loader=None, test_loader=None):
+    """ Quantize a trained model (see src/model/quantize.py) and save it with the
+    suffix _int8. Give calibration_loader (e.g., the training data loader) to quantize
+    the convolutions too. Give test_loader to compare the accuracy and latency of the
+    two variants, and save the comparison. Load with load_model(..., quantized=True). """
+    from src.model.quantize import quantize_model, compare_models
+
+    quantized = quantize_model(model, calibration_loader)
+
+    def save_function_scripted(data, path):
+        torch.jit.save(trace_model(data), path)
+
+    def save_function_report(data, path):
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2)
+
+    # name it after the original model, with the suffix
+    if filename is not None:
+        for extension in [".pth", QUANTIZED_EXTENSION, ".npy"]:
+            if filename.endswith(extension):
+                filename = filename[:-len(extension)]
+                break
+        if not filename.endswith(QUANTIZED_SUFFIX):
+            filename += QUANTIZED_SUFFIX
+
+    # save the traced model
+    print('Saving the quantized model ({}) ...'.format(QUANTIZED_EXTENSION))
+    scripted_path = save_file(data=quantized, filename=filename, rewrite=rewrite,
+                              basepath=basepath, extension=QUANTIZED_EXTENSION,
+                              save_function=save_function_scripted)
+    if scripted_path is None:
+        return
+
+    # save the image_size and noise_int_to_str dictionary, as for save_model
+    print('Saving the image_size and noise_int_to_str (.npy) ...')
+    filename = scripted_path[len(basepath):-len(QUANTIZED_EXTENSION)]
+    init_path = save_file(data=model, filename=filename, rewrite=rewrite,
+                          basepath=basepath, extension=".npy",
+                          save_function=save_function_init)
+
+    # compare the accuracy and latency of the original and quantized models
+    if test_loader is not None:
+        report = compare_models({'float': model, 'int8': quantized}, test_loader)
+        save_file(data=report, filename=filename, rewrite=rewrite, basepath=basepath,
+                  extension=".json", save_function=save_function_report)
+
+    return scripted_path, init_path
+
+
+def numpy_bundle(model, samplerate, n_mels=N_MELS):
+    """ Return a dict of the arrays for the NumPy runtime: the model parameters,
+    its image_size and labels, and the window and mel filterbank for its spectrograms """
+    front_end = get_front_end(samplerate, n_mels)
+    bundle = {name: parameter.detach().cpu().numpy()
+              for name, parameter in model.state_dict().items()}
+    bundle.update(image_size=np.array(model.image_size[-2:]),
+                  labels=np.array([model.noise_int_to_str[i] for i in range(len(model.noise_int_to_str))]),
+                  samplerate=np.array(samplerate),
+                  hop_length=np.array(front_end.hop_length),
+                  window=front_end.window.numpy(),
+                  fb_T=front_end.fb_T.numpy())
+    return bundle
+
+
+def export_numpy_model(model, samplerate, filename=None, rewrite=False,
+                       basepath=MODEL_BASEPATH, n_mels=N_MELS):
+    """ Export a trained model, with the window and mel filterbank for spectrograms
+    at samplerate, as a bundle of arrays for the NumPy runtime (load_numpy_model).
+    The samplerate and n_mels must be those the model was trained with. """
+
+    bundle = numpy_bundle(model, samplerate, n_mels)
+
+    def save_function_bundle(data, path):
+        np.savez(path, **data)
+
+    if filename is not None:
+        for extension in [".pth", ".npy"]:
+            if filename.endswith(extension):
+                filename = filename[:-len(extension)]
+                break
+
+    print('Saving the model for the NumPy runtime ({}) ...'.format(NUMPY_EXTENSION))
+    return save_file(data=bundle, filename=filename, rewrite=rewrite, basepath=basepath,
+                     extension=NUMPY_EXTENSION, save_function=save_function_bundle)
+
 # # TESTING
 # save_model(my_net, filename='my_model')
 # # TESTING
 # new_model = load_model(filename='my_model')
 # print(new_model)
+# # TESTING
+# save_quantized_model(my_net, filename='my_model', calibration_loader=my_train_loader,
+#                      test_loader=my_test_loader)
+# new_quantized_model = load_model(filename='my_model_int8', quantized=True)
+# # TESTING
+# export_numpy_model(my_net, samplerate=44100, filename='my_model')
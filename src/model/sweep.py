@@ -0,0 +1,220 @@
+# Sweep the settings that trade speed for accuracy: the spectrogram front end,
+# the noise length, and the size of the network.
+
+# These settings are constants spread over the code: N_MELS
+# (src/audio/make_spectrograms.py), BATCH_DURATION and BATCHES_PER_NOISE (their
+# product is the noise length, see src/audio/noise_settings.py), and the layer sizes of
+# Net (KERNELS, CHANNELS, and HIDDEN in src/model/define_model.py). A sweep trains
+# and evaluates a model for each configuration of them, from the same recordings,
+# on a pool of processes (one per core by default, each with one torch thread).
+# The noise length can only be swept down from the recorded length: each noise
+# sample is cut to its start. For each configuration, the results are the test
+# accuracy, the model size, the latency of recognizing one noise (its spectrogram
+# plus the model, as an InferenceModel), and the time from recordings to trained
+# model. The configurations on the Pareto front (no other configuration is at
+# least as good on all of these, and better on one) are marked.
+
+from src.audio.make_spectrograms import N_MELS, get_front_end
+from src.audio.noise_settings import BATCH_DURATION, BATCHES_PER_NOISE
+from src.model.define_model import Net, KERNELS, CHANNELS, HIDDEN
+from src.model.prepare_datasets import NoisesDataset, dataset_labels, stratified_split, prepare_data_loaders
+from src.model.train_model import train_net, evaluate_loss
+from src.model.inference import InferenceModel
+from src.utils.save_load import save_file
+from concurrent.futures import ProcessPoolExecutor
+import torch.nn as nn
+import numpy as np
+import itertools
+import json
+import os
+import time
+import torch
+
+SWEEP_BASEPATH = 'output/sweeps/'
+LATENCY_REPEATS = 200   # noises recognized to measure the latency of each configuration
+
+DEFAULT_CONFIGURATION = {
+    'n_mels': N_MELS,
+    'batch_duration': BATCH_DURATION,
+    'batches_per_noise': BATCHES_PER_NOISE,
+    'kernels': KERNELS,
+    'channels': CHANNELS,
+    'hidden': HIDDEN,
+}
+
+# the results compared for the Pareto front: +1 if higher is better, -1 if lower is
+PARETO_OBJECTIVES = {'accuracy': 1, 'size_kb': -1, 'latency_us': -1, 'training_sec': -1}
+
+
+def configuration_grid(**options):
+    """ Every combination of the given options, each a list of values for a key of
+    DEFAULT_CONFIGURATION (e.g., n_mels=[16, 28, 40]). The other keys keep their
+    default values. """
+    for key in options:
+        if key not in DEFAULT_CONFIGURATION:
+            raise ValueError('Unknown option "{}". Options: {}'.format(key, list(DEFAULT_CONFIGURATION)))
+    keys = list(options)
+    return [dict(DEFAULT_CONFIGURATION, **dict(zip(keys, values)))
+            for values in itertools.product(*[options[key] for key in keys])]
+
+
+def configuration_noise_length(configuration, samplerate):
+    """ The number of samples in a noise, as get_noise_length, for a configuration """
+    return configuration['batches_per_noise'] * int(samplerate * configuration['batch_duration'])
+
+
+def evaluate_configuration(configuration, noise_data_dict, samplerate, epochs=10, batch_size=8,
+                           seed=0, latency_repeats=LATENCY_REPEATS):
+    """ Train and test a model with the configuration (see DEFAULT_CONFIGURATION), on
+    noise_data_dict. Returns the configuration with the results added, or with an
+    error if it can't be trained (e.g., the spectrograms are too small for the kernels). """
+    result = dict(configuration)
+    try:
+        noise_length = configuration_noise_length(configuration, samplerate)
+        recorded_length = min(len(sample) for samples in noise_data_dict.values() for sample in samples)
+        if noise_length > recorded_length:
+            raise ValueError('The noises are {} samples long, but only {} were recorded.'.format(
+                noise_length, recorded_length))
+        noise_data_dict = {label: [sample[:noise_length] for sample in samples]
+                           for label, samples in noise_data_dict.items()}
+
+        # from recordings to trained model
+        start = time.perf_counter()
+        dataset = NoisesDataset(noise_data_dict, samplerate, n_mels=configuration['n_mels'], use_cache=False)
+        train_indices, test_indices = stratified_split(dataset_labels(dataset), seed=seed)
+        train_loader, test_loader, _, _ = prepare_data_loaders(dataset, train_indices, test_indices,
+                                                               batch_size=batch_size, tensor_resident=True)
+        torch.manual_seed(seed)
+        model = Net(dataset[0][0].size(), dataset.noise_int_to_str, kernels=configuration['kernels'],
+                    channels=configuration['channels'], hidden=configuration['hidden'])
+        train_net(model, epochs, train_loader, batch_progress=10**6)
+        result['training_sec'] = time.perf_counter() - start
+
+        _, result['accuracy'] = evaluate_loss(model, test_loader, nn.CrossEntropyLoss())
+        result['parameters'] = sum(parameter.numel() for parameter in model.parameters())
+        result['size_kb'] = 4 * result['parameters'] / 1024
+
+        # recognizing one noise at a time, as the listener does
+        front_end = get_front_end(samplerate, configuration['n_mels'])
+        inference_model = InferenceModel(model)
+        samples = [sample for samples in noise_data_dict.values() for sample in samples]
+        latencies = []
+        for i in range(latency_repeats):
+            recognize_start = time.perf_counter()
+            inference_model(front_end(samples[i % len(samples)])[None, None, :, :]).argmax(1)
+            latencies.append(time.perf_counter() - recognize_start)
+        result['latency_us'] = 1e6 * float(np.median(latencies))
+    except Exception as e:
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+    return result
+
+
+# the recordings for each process of the pool, sent once when it starts
+_worker_recordings = {}
+
+
+def _start_worker(noise_data_dict, samplerate, threads):
+    torch.set_num_threads(threads)
+    _worker_recordings.update(noise_data_dict=noise_data_dict, samplerate=samplerate)
+
+    # torch initializes lazily on the first training step, which no configuration should pay for
+    net = Net((N_MELS, 16), {0: 'warm-up'})
+    optimizer = torch.optim.Adam(net.parameters())
+    nn.CrossEntropyLoss()(net(torch.zeros(2, 1, N_MELS, 16)), torch.zeros(2, dtype=torch.long)).backward()
+    optimizer.step()
+
+
+def _evaluate_in_worker(configuration, **kwargs):
+    return evaluate_configuration(configuration, _worker_recordings['noise_data_dict'],
+                                  _worker_recordings['samplerate'], **kwargs)
+
+
+def run_sweep(noise_data_dict, samplerate, configurations, epochs=10, batch_size=8, seed=0,
+              workers=None, threads=1, latency_repeats=LATENCY_REPEATS):
+    """ Evaluate each configuration (see configuration_grid and evaluate_configuration)
+    on noise_data_dict, on a pool of workers processes (default: one per core), each
+    using threads torch threads. Returns the results in the order of configurations,
+    with the Pareto-optimal ones marked (see pareto_front). Call it from a script
+    guarded by if __name__ == "__main__", as the processes may import it. """
+    workers = min(workers or os.cpu_count() or 1, len(configurations))
+    noise_data_dict = {label: [np.asarray(sample) for sample in samples]
+                       for label, samples in noise_data_dict.items()}
+    kwargs = {'epochs': epochs, 'batch_size': batch_size, 'seed': seed, 'latency_repeats': latency_repeats}
+
+    print('Sweeping {} configurations with {} worker processes ...'.format(len(configurations), workers))
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_start_worker,
+                             initargs=(noise_data_dict, samplerate, threads)) as pool:
+        futures = [pool.submit(_evaluate_in_worker, configuration, **kwargs)
+                   for configuration in configurations]
+        results = [future.result() for future in futures]
+    print('Sweep finished in {:.1f} sec'.format(time.perf_counter() - start))
+
+    pareto_front(results)
+    return results
+
+
+def sweep_recordings(filename, configurations, **kwargs):
+    """ Run a sweep (see run_sweep) on the recordings saved in filename (see
+    src/audio/save_load.py), and print the results """
+    from src.audio.save_load import load_noise_samples
+    library = load_noise_samples(filename)
+    if library is None:
+        return
+    if library.samplerate is None:
+        raise ValueError('The samplerate of the recordings is unknown (see convert_noise_samples).')
+    results = run_sweep(library, library.samplerate, configurations, **kwargs)
+    print_sweep(results)
+    return results
+
+
+def pareto_front(results, objectives=PARETO_OBJECTIVES):
+    """ Mark each result (without an error) as Pareto-optimal or not, in its 'pareto'
+    key: optimal unless another is at least as good on all the objectives, and
+    better on one. Returns the optimal results. """
+    valid = [result for result in results if 'error' not in result]
+    scores = np.array([[sign * result[key] for key, sign in objectives.items()] for result in valid])
+    for result, score in zip(valid, scores):
+        dominated = np.any(np.all(scores >= score, axis=1) & np.any(scores > score, axis=1))
+        result['pareto'] = not dominated
+    return [result for result in valid if result['pareto']]
+
+
+def print_sweep(results, sort_by='accuracy'):
+    """ Print a table of the results of a sweep, best first by sort_by. Pareto-optimal
+    configurations are marked with a *. """
+    print('\n{:>6} {:>10} {:>8} {:>9} {:>9} {:>9} {:>9} {:>11} {:>10}'.format(
+        'n_mels', 'noise (ms)', 'kernels', 'channels', 'hidden',
+        'accuracy', 'size (KB)', 'latency (us)', 'train (s)'))
+    valid = [result for result in results if 'error' not in result]
+    valid.sort(key=lambda result: PARETO_OBJECTIVES.get(sort_by, 1) * result[sort_by], reverse=True)
+    for result in valid + [result for result in results if 'error' in result]:
+        layers = '{:>6} {:>10.0f} {:>8} {:>9} {:>9}'.format(
+            result['n_mels'], 1000 * result['batches_per_noise'] * result['batch_duration'],
+            '-'.join(map(str, result['kernels'])), '-'.join(map(str, result['channels'])),
+            '-'.join(map(str, result['hidden'])))
+        if 'error' in result:
+            print('{}   {}'.format(layers, result['error']))
+            continue
+        print('{} {:>8.1f}% {:>9.1f} {:>12.0f} {:>10.2f}{}'.format(
+            layers, 100 * result['accuracy'], result['size_kb'], result['latency_us'],
+            result['training_sec'], ' *' if result['pareto'] else ''))
+
+
+def export_sweep(results, filename=None, rewrite=False, basepath=SWEEP_BASEPATH):
+    """ Save the results of a sweep to a JSON file """
+
+    def save_function(data, path):
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=1)
+
+    return save_file(data=results, filename=filename, rewrite=rewrite, basepath=basepath,
+                     extension='.json', save_function=save_function)
+
+
+# # TESTING
+# if __name__ == "__main__":
+#     my_configurations = configuration_grid(n_mels=[16, 28, 40], batches_per_noise=[2, 3],
+#                                            channels=[(16, 8), (32, 10)])
+#     my_results = sweep_recordings('necrodancer_100each_t-k-p-tsk-cluck', my_configurations)
+#     export_sweep(my_results)
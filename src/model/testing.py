@@ -28,7 +28,7 @@ if __name__ == "__main__":
     import matplotlib.pyplot as plt
 
     my_recordings = load_noise_samples(
-        filename='necrodancer_100each_t-k-p-tsk-cluck.npy')
+        filename='necrodancer_100each_t-k-p-tsk-cluck.noises')
     my_dataset = NoisesDataset(my_recordings, samplerate)
     my_train_loader, my_test_loader, my_train_dataset, my_test_dataset = prepare_even_data_loaders(
         my_dataset, samplerate, batch_size=8)
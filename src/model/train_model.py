@@ -4,22 +4,77 @@
 # been adapted from a [pytorch
 # tutorial](https://pytorch.org/tutorials/beginner/blitz/cifar10_tutorial.html#sphx-glr-beginner-blitz-cifar10-tutorial-py).
 
+# With a validation loader (held out from the training data, see
+# validation_split), the loss and accuracy on it are measured after each epoch.
+# With patience, training stops once the validation loss hasn't improved for
+# that many epochs, and the parameters of the best epoch are restored, so epochs
+# is only the most to run. The history of each epoch (its time, losses, and
+# accuracy) shows what training really costs: see print_training_curve and
+# time_to_accuracy.
+
+import torch
 import torch.nn as nn
 import torch.optim as optim
+import time
+
+LR_SCHEDULES = ['plateau', 'cosine']
+MIN_DELTA = 0.01   # the least decrease in validation loss that counts as improving
+
+
+def evaluate_loss(net, dataloader, criterion):
+    """ Return the mean loss and the accuracy of net on a data loader (both nan if
+    it's empty) """
+    total_loss, correct, total = 0.0, 0, 0
+    with torch.no_grad():
+        for spectrograms, labels in dataloader:
+            outputs = net(spectrograms)
+            total_loss += criterion(outputs, labels).item() * len(labels)
+            correct += (outputs.argmax(1) == labels).sum().item()
+            total += len(labels)
+    if total == 0:
+        return float('nan'), float('nan')
+    return total_loss / total, correct / total
+
+
+def make_lr_scheduler(lr_schedule, optimizer, epochs):
+    """ A learning-rate scheduler for the optimizer: 'plateau' lowers the rate when
+    the validation loss stops improving, and 'cosine' anneals it over the epochs """
+    if lr_schedule == 'plateau':
+        return optim.lr_scheduler.ReduceLROnPlateau(optimizer, factor=0.5, patience=1)
+    if lr_schedule == 'cosine':
+        return optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=max(epochs, 1))
+    raise ValueError('Unknown learning-rate schedule "{}". Options: {}'.format(lr_schedule, LR_SCHEDULES))
+
 
-def train_net(net, epochs, train_loader, batch_progress=50):
+def train_net(net, epochs, train_loader, batch_progress=50,
+              val_loader=None, patience=None, lr_schedule=None, min_delta=MIN_DELTA):
     """ Use training data from train_loader to train net for a number of epochs,
-    using a cross entropy loss function and Adam as the optimizer. """
-    
+    using a cross entropy loss function and Adam as the optimizer. If val_loader is
+    given, evaluate on it after each epoch; then if patience is given, stop once
+    the validation loss hasn't improved (by min_delta) for patience epochs, and
+    restore the best epoch's parameters. lr_schedule can be one of LR_SCHEDULES
+    ('plateau' needs val_loader). Returns the history: a dict with a list of each
+    epoch's time (sec, with validation), training loss, validation loss and
+    accuracy, and learning rate, and the best epoch (counting from 1). """
+
     # the loss function and optimizing method
     criterion = nn.CrossEntropyLoss()
     optimizer = optim.Adam(net.parameters())
-    
+    if lr_schedule == 'plateau' and val_loader is None:
+        raise ValueError('The "plateau" learning-rate schedule needs a val_loader.')
+    scheduler = make_lr_scheduler(lr_schedule, optimizer, epochs) if lr_schedule else None
+
+    history = {'epoch_time': [], 'train_loss': [], 'val_loss': [], 'val_accuracy': [], 'lr': [],
+               'best_epoch': None}
+    best_loss, best_state, epochs_since_best = float('inf'), None, 0
+
     batch_num = 0
     for epoch in range(epochs):  # loop over the dataset multiple times
-        
+
+        epoch_start = time.perf_counter()
         batch_running_loss = 0.0
-        
+        epoch_loss, epoch_batches = 0.0, 0
+
         for i, data in enumerate(train_loader, 0):
             # get the inputs; data is a list of [inputs, labels]
             inputs, labels = data
@@ -35,18 +90,81 @@ def train_net(net, epochs, train_loader, batch_progress=50):
 
             # accrue loss for printing
             batch_running_loss += loss.item()
-            
+            epoch_loss += loss.item()
+            epoch_batches += 1
+
             # print progress every batch_progress batches
             if batch_num % batch_progress == batch_progress-1:
                 print('[{:d}, {:5d}] loss: {:.3f}'.format(
                   epoch + 1, i + 1, batch_running_loss / batch_progress))
                 batch_running_loss = 0.0
                 batch_num = 0
-            
+
             batch_num += 1
-        
-    print('Finished Training')
+
+        history['lr'].append(optimizer.param_groups[0]['lr'])
+        history['train_loss'].append(epoch_loss / epoch_batches if epoch_batches else float('nan'))
+
+        if val_loader is not None:
+            val_loss, val_accuracy = evaluate_loss(net, val_loader, criterion)
+            history['val_loss'].append(val_loss)
+            history['val_accuracy'].append(val_accuracy)
+            if val_loss < best_loss - min_delta:
+                best_loss, epochs_since_best = val_loss, 0
+                history['best_epoch'] = epoch + 1
+                if patience is not None:
+                    best_state = {name: value.clone() for name, value in net.state_dict().items()}
+            else:
+                epochs_since_best += 1
+
+        if lr_schedule == 'plateau':
+            scheduler.step(val_loss)
+        elif scheduler is not None:
+            scheduler.step()
+
+        history['epoch_time'].append(time.perf_counter() - epoch_start)
+
+        if patience is not None and val_loader is not None and epochs_since_best >= patience:
+            print('Stopping early after epoch {}: no improvement in {} epochs.'.format(epoch + 1, patience))
+            break
+
+    if best_state is not None:
+        net.load_state_dict(best_state)
+        print('Restored the best epoch ({}), with validation accuracy {:.0f} %'.format(
+            history['best_epoch'], 100 * history['val_accuracy'][history['best_epoch'] - 1]))
+
+    epochs_run = len(history['epoch_time'])
+    print('Finished Training ({} epochs, {:.3f} sec per epoch)'.format(
+        epochs_run, sum(history['epoch_time']) / epochs_run if epochs_run else 0))
+    return history
+
+
+def time_to_accuracy(history, accuracy):
+    """ The training time (sec) until the validation accuracy first reached accuracy
+    (a fraction), or None if it never did """
+    elapsed = 0
+    for epoch_time, val_accuracy in zip(history['epoch_time'], history['val_accuracy']):
+        elapsed += epoch_time
+        if val_accuracy >= accuracy:
+            return elapsed
+    return None
+
+
+def print_training_curve(history):
+    """ Print the time (sec) and validation accuracy after each epoch """
+    print('epoch   time (sec)   loss   val. loss   val. accuracy')
+    elapsed = 0
+    for epoch, (epoch_time, train_loss, val_loss, val_accuracy) in enumerate(zip(
+            history['epoch_time'], history['train_loss'], history['val_loss'], history['val_accuracy'])):
+        elapsed += epoch_time
+        best = ' *' if epoch + 1 == history['best_epoch'] else ''
+        print('{:5d}   {:10.2f}   {:.3f}   {:9.3f}   {:12.0f} %{}'.format(
+            epoch + 1, elapsed, train_loss, val_loss, 100 * val_accuracy, best))
+
 
 # # TESTING
 # my_net = Net(my_spectrogram.size(), my_dataset.noise_int_to_str)
-# train_net(my_net, 50, my_train_loader, batch_progress=100)
\ No newline at end of file
+# train_net(my_net, 50, my_train_loader, batch_progress=100)
+# # with early stopping
+# my_history = train_net(my_net, 50, my_train_loader, val_loader=my_val_loader, patience=3, lr_schedule='plateau')
+# print_training_curve(my_history)
@@ -0,0 +1,62 @@
+# --------- Pretend we're in the root directory ---------
+import sys
+import os
+
+ROOT_DIR = '../..'
+os.chdir(ROOT_DIR)
+sys.path.insert(0, os.getcwd())
+# -------------------------------------------------------
+
+from src.response.keyboard_control import (KEYBOARD_MAPPING, KEY_BACKENDS, PyAutoGUIBackend,
+                                           MockBackend, set_key_backend, press_key)
+
+# Benchmarks for responding to noises. Pressing keys injects them into whatever
+# window has focus, so these press a harmless key (shift) by default.
+
+BENCHMARK_KEY = 'shift'
+
+
+def benchmark_key_backends(presses=200, key=BENCHMARK_KEY):
+    """ Press key presses times with each available key backend, and compare the
+    latency per press. pyautogui is also timed with its default pause (0.1 sec). """
+    backends = [('pyautogui (default pause)', lambda: PyAutoGUIBackend(pause=0.1))]
+    backends += [(name, backend) for name, backend in KEY_BACKENDS.items()]
+
+    for name, make in backends:
+        try:
+            backend = make()
+        except Exception as e:
+            print('{}: not available ({})'.format(name, e))
+            continue
+        try:
+            for _ in range(presses if 'default pause' not in name else presses // 10):
+                backend.press(key)
+        except Exception as e:
+            print('{}: pressing "{}" failed ({!r})'.format(name, key, e))
+            continue
+        stats = backend.stats()
+        print('{}: {} presses, latency (ms) p50 {:.3f}, p95 {:.3f}, p99 {:.3f}'.format(
+            name, stats['presses'], *stats['latency_ms']))
+
+
+def check_key_mapping():
+    """ Respond to every mapped noise (and one unmapped one) with the mock backend,
+    and check that the expected keys were pressed, in order """
+    backend = set_key_backend(MockBackend())
+    for noise in KEYBOARD_MAPPING:
+        press_key(noise)
+    press_key('not a mapped noise')
+    print('\nKeys pressed as mapped: {}'.format(backend.pressed == list(KEYBOARD_MAPPING.values())))
+
+
+if __name__ == "__main__":
+
+    ###################### BENCHMARKING RESPONSES ######################
+
+    # response/keyboard_control.py: key mappings, without a display
+
+    check_key_mapping()
+
+    # response/keyboard_control.py: latency per key press, per backend
+
+    benchmark_key_backends()
@@ -0,0 +1,170 @@
+# Respond to noises on a separate thread, so a slow response doesn't hold up
+# recognition.
+
+# Responding can block: pressing a key through pyautogui waits for its pause
+# after every action. If the listener responds inline, the next noise waits for
+# that. A ResponseDispatcher takes the place of act_on_noise: calling it queues
+# the noise and returns at once, and a worker thread runs act_on_noise on the
+# queued noises. The queue is bounded, and what happens when it's full, which
+# noise is responded to next, and whether repeats are merged are configurable.
+
+from collections import deque
+import numpy as np
+import threading
+import time
+
+MAX_PENDING = 4            # noises waiting for a response before the overflow policy applies
+ORDERS = ['fifo',          # respond in the order the noises were heard
+          'lifo']          # respond to the most recent noise first
+OVERFLOWS = ['drop_oldest',   # discard the longest-waiting noise to make room
+             'drop_newest',   # discard the new noise
+             'block']         # wait for room, holding up recognition (as if inline)
+LAG_WINDOW = 1000          # number of recent dispatch lags kept for the stats
+
+
+class ResponseDispatcher:
+    """ Calls act_on_noise(noise_heard) on a worker thread, for each noise passed to
+    the dispatcher (call it like act_on_noise). Use it as a context manager, or call
+    start() and stop(). If coalesce is True, a noise that's the same as the last one
+    still waiting is merged into it. If on_response is given, it's called after each
+    response as on_response(noise_heard, times), with times['response'] set if times
+    (a dict of stage timestamps, see src/main/latency.py) was passed with the noise. """
+
+    def __init__(self, act_on_noise, max_pending=MAX_PENDING, order='fifo',
+                 overflow='drop_oldest', coalesce=False, on_response=None):
+        if order not in ORDERS:
+            raise ValueError('order must be one of {}'.format(ORDERS))
+        if overflow not in OVERFLOWS:
+            raise ValueError('overflow must be one of {}'.format(OVERFLOWS))
+
+        self.act_on_noise = act_on_noise
+        self.max_pending = max_pending
+        self.order = order
+        self.overflow = overflow
+        self.coalesce = coalesce
+        self.on_response = on_response
+
+        self.pending = deque()     # (noise_heard, times, time queued)
+        self.condition = threading.Condition()
+        self.worker = None
+        self.stopping = False
+
+        # stats
+        self.submitted = 0
+        self.dispatched = 0
+        self.errors = 0        # responses that raised an error
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self.depth_total = 0       # sum of queue depths seen by each noise as it's queued
+        self.lags = deque(maxlen=LAG_WINDOW)   # sec from queued to act_on_noise called
+        self.response_time = 0     # total sec spent in act_on_noise
+
+    def start(self):
+        self.stopping = False
+        self.worker = threading.Thread(target=self._work, daemon=True)
+        self.worker.start()
+        return self
+
+    def stop(self, drain=True):
+        """ Stop the worker, after responding to any noises still waiting if drain is True """
+        with self.condition:
+            if not drain:
+                self.dropped += len(self.pending)
+                self.pending.clear()
+            self.stopping = True
+            self.condition.notify_all()
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def __call__(self, noise_heard, times=None):
+        """ Queue a noise for a response, and return without waiting for it """
+        with self.condition:
+            self.submitted += 1
+
+            if self.coalesce and self.pending and self.pending[-1][0] == noise_heard:
+                self.coalesced += 1
+                return
+
+            if len(self.pending) >= self.max_pending:
+                if self.overflow == 'block':
+                    self.condition.wait_for(lambda: len(self.pending) < self.max_pending)
+                elif self.overflow == 'drop_oldest':
+                    self.pending.popleft()
+                    self.dropped += 1
+                else:
+                    self.dropped += 1
+                    return
+
+            self.depth_total += len(self.pending)
+            self.pending.append((noise_heard, times, time.perf_counter()))
+            self.max_depth = max(self.max_depth, len(self.pending))
+            self.condition.notify_all()
+
+    def _work(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending or self.stopping)
+                if not self.pending:
+                    return
+                if self.order == 'fifo':
+                    noise_heard, times, queued = self.pending.popleft()
+                else:
+                    noise_heard, times, queued = self.pending.pop()
+                self.condition.notify_all()   # there's room for a blocked noise
+
+            start = time.perf_counter()
+            self.lags.append(start - queued)
+            # an error in a response is reported, and the worker keeps going
+            try:
+                self.act_on_noise(noise_heard)
+            except Exception as e:
+                self.errors += 1
+                print('Responding to "{}" failed: {!r}'.format(noise_heard, e))
+            end = time.perf_counter()
+            self.response_time += end - start
+            self.dispatched += 1
+
+            if times is not None:
+                times['response'] = end
+            if self.on_response:
+                self.on_response(noise_heard, times)
+
+    def stats(self):
+        """ Return a dict of counts, queue depths, and dispatch lags (ms) """
+        queued = self.submitted - self.coalesced
+        lags = 1000 * np.array(self.lags)
+        return {'submitted': self.submitted,
+                'dispatched': self.dispatched,
+                'errors': self.errors,
+                'dropped': self.dropped,
+                'coalesced': self.coalesced,
+                'depth': len(self.pending),
+                'max_depth': self.max_depth,
+                'mean_depth': self.depth_total / queued if queued else 0,
+                'lag_ms': np.percentile(lags, [50, 95, 99]).tolist() if len(lags) else [],
+                'response_ms': 1000 * self.response_time / self.dispatched if self.dispatched else 0}
+
+    def report(self):
+        """ Print a summary of the stats """
+        stats = self.stats()
+        print('\nResponses: {dispatched} of {submitted} noises ({dropped} dropped, {coalesced} coalesced), '
+              'queue depth {mean_depth:.2f} mean, {max_depth} max, '
+              '{response_ms:.1f} ms per response'.format(**stats))
+        if stats['errors']:
+            print('{} responses failed'.format(stats['errors']))
+        if stats['lag_ms']:
+            print('Dispatch lag (ms): p50 {:.2f}, p95 {:.2f}, p99 {:.2f}'.format(*stats['lag_ms']))
+
+
+# # TESTING
+# with ResponseDispatcher(press_key, order='lifo', coalesce=True) as my_dispatcher:
+#     listen_recognize_and_respond(my_model, my_dispatcher, device=0, duration=20)
+# my_dispatcher.report()
@@ -1,8 +1,21 @@
 # Keyboard control: up down left right escape
 # We want to play a videogame, like Crypt of the Necrodancer, with this noise control. Let's introduce some basic keyboard control.
 
+# Keys are pressed through a backend. pyautogui works everywhere, but by default
+# it sleeps (pyautogui.PAUSE, 0.1 sec) after every action, which is far longer
+# than recognizing a noise takes. Its backend here presses without the pause.
+# On Linux, keys can also be injected directly: through the X server's XTEST
+# extension (needs python-xlib), or through the kernel's uinput device (needs
+# evdev, and permission to write /dev/uinput), which also works under Wayland.
+# The mock backend only records the keys, to test key mappings without a
+# display. Each backend times every press, for its latency stats.
+
 from .print_noise import print_noise
-import pyautogui
+from collections import deque
+import numpy as np
+import os
+import sys
+import time
 
 
 ########## NOISE-TO-KEYBOARD MAPPING ##########
@@ -15,20 +28,183 @@ KEYBOARD_MAPPING = {
     'cluck': 'escape',
 }
 
+LATENCY_WINDOW = 1000   # number of recent press latencies kept for the stats
+
+
+########## KEY INJECTION BACKENDS ##########
+
+class KeyBackend:
+    """ Presses keys, named as in pyautogui (e.g., 'up', 'escape', 'a'), and keeps
+    the latency of each press. Subclasses implement _press(key). """
+
+    name = None
+
+    def __init__(self):
+        self.latencies = deque(maxlen=LATENCY_WINDOW)   # sec per press
+
+    def press(self, key):
+        start = time.perf_counter()
+        self._press(key)
+        self.latencies.append(time.perf_counter() - start)
+
+    def stats(self):
+        """ Return the number of presses, and percentiles of their latency (ms) """
+        latencies = 1000 * np.array(self.latencies)
+        return {'presses': len(latencies),
+                'latency_ms': np.percentile(latencies, [50, 95, 99]).tolist() if len(latencies) else []}
+
+    def report(self):
+        """ Print a summary of the stats """
+        stats = self.stats()
+        print('\n{} key presses ({} backend)'.format(stats['presses'], self.name))
+        if stats['latency_ms']:
+            print('Press latency (ms): p50 {:.3f}, p95 {:.3f}, p99 {:.3f}'.format(*stats['latency_ms']))
+
+
+class PyAutoGUIBackend(KeyBackend):
+    """ Presses keys with pyautogui, pausing for pause (sec) after each press
+    rather than pyautogui.PAUSE """
+
+    name = 'pyautogui'
+
+    def __init__(self, pause=0):
+        super().__init__()
+        import pyautogui
+        self.pyautogui = pyautogui
+        self.pause = pause
+
+    def _press(self, key):
+        self.pyautogui.press(key, _pause=False)
+        if self.pause:
+            time.sleep(self.pause)
+
+
+class XlibBackend(KeyBackend):
+    """ Presses keys through the X server's XTEST extension (Linux, with X11) """
+
+    name = 'xlib'
+
+    # X keysym names, where they differ from the key names
+    KEYSYMS = {'up': 'Up', 'down': 'Down', 'left': 'Left', 'right': 'Right', 'escape': 'Escape',
+               'enter': 'Return', 'space': 'space', 'tab': 'Tab', 'backspace': 'BackSpace',
+               'shift': 'Shift_L', 'shiftleft': 'Shift_L', 'shiftright': 'Shift_R'}
+
+    def __init__(self):
+        super().__init__()
+        from Xlib import X, XK, display
+        from Xlib.ext import xtest
+        self.X, self.xtest = X, xtest
+        self.display = display.Display()
+        if not self.display.has_extension('XTEST'):
+            raise RuntimeError('The X server has no XTEST extension.')
+        self.keycodes = {}
+        self.keysym = lambda key: XK.string_to_keysym(self.KEYSYMS.get(key, key))
+
+    def _press(self, key):
+        keycode = self.keycodes.get(key)
+        if keycode is None:
+            keysym = self.keysym(key)
+            keycode = self.display.keysym_to_keycode(keysym) if keysym else 0
+            if not keycode:
+                raise ValueError('Unknown key "{}" for the {} backend.'.format(key, self.name))
+            self.keycodes[key] = keycode
+        self.xtest.fake_input(self.display, self.X.KeyPress, keycode)
+        self.xtest.fake_input(self.display, self.X.KeyRelease, keycode)
+        self.display.sync()
+
+
+class UinputBackend(KeyBackend):
+    """ Presses keys through a virtual keyboard made with the kernel's uinput
+    device (Linux, under X11 or Wayland) """
+
+    name = 'uinput'
+
+    # evdev key code names (after KEY_), where they differ from the key names
+    KEY_CODES = {'escape': 'ESC', 'shift': 'LEFTSHIFT', 'shiftleft': 'LEFTSHIFT', 'shiftright': 'RIGHTSHIFT'}
+
+    def __init__(self):
+        super().__init__()
+        from evdev import UInput, ecodes
+        self.ecodes = ecodes
+        self.device = UInput()
+
+    def _press(self, key):
+        code = getattr(self.ecodes, 'KEY_' + self.KEY_CODES.get(key, key).upper(), None)
+        if code is None:
+            raise ValueError('Unknown key "{}" for the {} backend.'.format(key, self.name))
+        self.device.write(self.ecodes.EV_KEY, code, 1)
+        self.device.write(self.ecodes.EV_KEY, code, 0)
+        self.device.syn()
+
+
+class MockBackend(KeyBackend):
+    """ Records the keys pressed, without pressing them, to test without a display """
+
+    name = 'mock'
+
+    def __init__(self):
+        super().__init__()
+        self.pressed = []
+
+    def _press(self, key):
+        self.pressed.append(key)
+
+
+KEY_BACKENDS = {backend.name: backend for backend in
+                [XlibBackend, UinputBackend, PyAutoGUIBackend, MockBackend]}
+
+
+def make_backend(name='auto'):
+    """ Make a key backend by name (see KEY_BACKENDS). 'auto' tries the direct
+    backends on Linux (xlib if there's an X display, then uinput), and falls back
+    to pyautogui without its pause. """
+    if name != 'auto':
+        return KEY_BACKENDS[name]()
+
+    candidates = []
+    if sys.platform.startswith('linux'):
+        candidates = ['xlib', 'uinput'] if os.environ.get('DISPLAY') else ['uinput']
+    for candidate in candidates:
+        try:
+            return KEY_BACKENDS[candidate]()
+        except Exception:
+            pass
+    return PyAutoGUIBackend()
+
+
+# the backend press_key uses, made on the first press unless set beforehand
+key_backend = None
+
+
+def set_key_backend(backend='auto'):
+    """ Set the backend for press_key: a KeyBackend, or the name of one (see make_backend) """
+    global key_backend
+    key_backend = make_backend(backend) if isinstance(backend, str) else backend
+    return key_backend
+
+
 # basic keyboard control
 
 
 def press_key(noise_heard):
     try:
-        pyautogui.press(KEYBOARD_MAPPING[noise_heard])
-    except:
+        key = KEYBOARD_MAPPING[noise_heard]
+    except KeyError:
         print('No keyboard mapping for "{}"'.format(noise_heard))
+    else:
+        (key_backend or set_key_backend()).press(key)
     print_noise(noise_heard)
 
 
 # For best performance, define a model that only recognizes these noises, even
 # if we recorded more earlier. E.g.,
-# my_recordings_subset = {
-#     k: v for k, v in my_recordings.items() if k in KEYBOARD_MAPPING.keys()}
+# my_recordings_subset = my_recordings.subset(KEYBOARD_MAPPING.keys())
 # necrodancer_model, _ = build_beatbot(
 #     device=device, skip_recording=True, starting_noise_data=my_recordings_subset)
+
+# # TESTING
+# my_keys = set_key_backend('mock')
+# for noise in ['t', 'k', 'p', 'tsk', 'cluck']:
+#     press_key(noise)
+# print(my_keys.pressed)
+# my_keys.report()
@@ -17,7 +17,7 @@ def save_file(data, filename, rewrite, basepath, extension, save_function):
             return
 
         # Add the extension if it isn't already included
-        if filename[-4:] != extension:
+        if not filename.endswith(extension):
             filename += extension
 
         # Make the base directory if it doesn't already exist